@@ -21,6 +21,8 @@ from datasets.forms_box_detect import FormsBoxDetect
 from datasets import forms_graph_pair
 from datasets.forms_feature_pair import FormsFeaturePair
 from datasets import forms_feature_pair
+from datasets.box_detect import AnchorAssignmentCollate
+import json
 #from torchvision import datasets, transforms
 from base import BaseDataLoader
 
@@ -91,9 +93,9 @@ def getDataLoader(config,split):
         shuffleValid = config['validation']['shuffle']
 
         if data_set_name=='FormsBoxDetect':
-            return withCollate(FormsBoxDetect,forms_box_detect.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
+            return withCollate(FormsBoxDetect,assigningAnchors(forms_box_detect.collate,config),batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
         elif data_set_name=='FormsGraphPair':
-            return withCollate(forms_graph_pair.FormsGraphPair,forms_graph_pair.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
+            return withCollate(forms_graph_pair.FormsGraphPair,assigningAnchors(forms_graph_pair.collate,config),batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
         elif data_set_name=='FormsFeaturePair':
             return withCollate(FormsFeaturePair,forms_feature_pair.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
         else:
@@ -102,6 +104,45 @@ def getDataLoader(config,split):
 
 
 
+def assigningAnchors(collateFunc,config):
+    """
+    If "anchor_assignment" is set in the data_loader config, wraps collateFunc so the DataLoader workers also
+    assign the GT boxes to the YoloLoss anchors. It can be true, or give "anchors_file", "scale" or "ignore_thresh"
+    which otherwise come from the detector's model config and the box loss params.
+    """
+    params = config['data_loader']['anchor_assignment'] if 'anchor_assignment' in config['data_loader'] else False
+    if not params:
+        return collateFunc
+    if type(params) is not dict:
+        params = {}
+    if 'anchors_file' not in params or 'scale' not in params:
+        #the detector's config, which the pairing model can have in its detector checkpoint
+        detector_config = config['model']
+        if 'detector_config' in detector_config:
+            detector_config = detector_config['detector_config']
+            if type(detector_config) is str:
+                detector_config = json.load(open(detector_config))['model']
+        elif 'detector_checkpoint' in detector_config:
+            detector_config = torch.load(detector_config['detector_checkpoint'],map_location='cpu')['config']['model']
+    if 'anchors_file' in params:
+        anchors_file = params['anchors_file']
+    else:
+        anchors_file = detector_config['anchors_file']
+    with open(anchors_file) as f:
+        anchors = json.loads(f.read())
+    if 'scale' in params:
+        scale = params['scale']
+    else:
+        from model.yolo_box_detector import downScale, default_down_layers_cfg
+        scale = downScale(detector_config['down_layers_cfg'] if 'down_layers_cfg' in detector_config else default_down_layers_cfg)
+    if 'ignore_thresh' in params:
+        ignore_thresh = params['ignore_thresh']
+    elif 'loss_params' in config and 'box' in config['loss_params'] and 'ignore_thresh' in config['loss_params']['box']:
+        ignore_thresh = config['loss_params']['box']['ignore_thresh']
+    else:
+        ignore_thresh = 0.5 #YoloLoss's default
+    return AnchorAssignmentCollate(collateFunc,anchors,scale,ignore_thresh)
+
 def basic(setObj,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config):
     if split=='train':
         trainData = setObj(dirPath=data_dir, split='train', config=config['data_loader'])
@@ -25,6 +25,7 @@ from utils.crop_transform import CropBoxTransform
 from utils import augmentation
 from collections import defaultdict, OrderedDict
 from utils.forms_annotations import fixAnnotations, convertBBs, getBBWithPoints, getStartEndGT
+from utils.yolo_tools import anchorAssignment
 import timeit
 
 import cv2
@@ -184,6 +185,23 @@ def collate(batch):
         'pairs': pairs #this is only used to save a new json
     }
 
+class AnchorAssignmentCollate(object):
+    """
+    Wraps a collate function (this one or the graph pair one) to also compute YoloLoss's assignment of
+    the GT boxes to anchors ('anchor_assignment'), so the DataLoader workers do it instead of the training loop.
+    """
+    def __init__(self,collate,anchors,scale,ignore_thresh):
+        self.collate=collate
+        self.anchors=anchors
+        self.scale=scale
+        self.ignore_thresh=ignore_thresh
+
+    def __call__(self,batch):
+        batch = self.collate(batch)
+        if batch is not None and batch['bb_gt'] is not None:
+            batch['anchor_assignment'] = anchorAssignment(batch['bb_gt'],self.anchors,self.scale,self.ignore_thresh)
+        return batch
+
 
 class BoxDetectDataset(torch.utils.data.Dataset):
     """
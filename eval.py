@@ -24,12 +24,22 @@ from data_loader import getDataLoader
 from evaluators import *
 import math
 from collections import defaultdict
+from utils.metric_aggregator import MetricAggregator
 
 
 logging.basicConfig(level=logging.INFO, format='')
 
+def printMetrics(val_metrics):
+    for typ in [key[0] for key in val_metrics.keys() if len(key)==1]:
+        print('{} overall mean: {}, std {}'.format(typ,val_metrics.mean((typ,)), val_metrics.std((typ,))))
+        if val_metrics.reservoirSize>0:
+            print('{} overall median: {}'.format(typ,val_metrics.quantile((typ,),0.5)))
+        for key in val_metrics.keys():
+            if len(key)==2 and key[0]==typ:
+                print('{} {} mean: {}, std {}'.format(typ,key[1],val_metrics.mean(key),val_metrics.std(key)))
 
-def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=None, config=None, thresh=None, addToConfig=None, test=False,verbose=2):
+
+def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=None, config=None, thresh=None, addToConfig=None, test=False,verbose=2,summary=None,reservoir=0):
     np.random.seed(1234)
     torch.manual_seed(1234)
     if resume is not None:
@@ -174,8 +184,8 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                 validDir=None
 
             val_metrics_sum = np.zeros(len(metrics))
-            val_metrics_list = defaultdict(lambda: defaultdict(list))
-            val_comb_metrics = defaultdict(list)
+            #the printers add each image's metrics as they come, (typ,) for all of a type and (typ,name) for each list in it
+            val_metrics = MetricAggregator(reservoir)
 
             #if numberOfImages==0:
             #    for i in range(len(valid_data_loader)):
@@ -217,18 +227,8 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                         #output = output.cpu().data.numpy()
                         #target = target.data.numpy()
                         #metricsO = _eval_metrics_ind(metrics,output, target)
-                        metricsO,aux = saveFunc(config,valid_iter.next(),model,gpu,metrics,validDir,validIndex)
-                        if type(metricsO) == dict:
-                            for typ,typeLists in metricsO.items():
-                                if type(typeLists) == dict:
-                                    for name,lst in typeLists.items():
-                                        val_metrics_list[typ][name]+=lst
-                                        val_comb_metrics[typ]+=lst
-                                else:
-                                    if type(typeLists) is float or type(typeLists) is int:
-                                        typeLists = [typeLists]
-                                    val_comb_metrics[typ]+=typeLists
-                        else:
+                        metricsO,aux = saveFunc(config,valid_iter.next(),model,gpu,metrics,validDir,validIndex,aggregator=val_metrics)
+                        if type(metricsO) != dict:
                             val_metrics_sum += metricsO.sum(axis=0)/metricsO.shape[0]
                     
                 if not test:
@@ -252,19 +252,8 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                     if verbose>1:
                         print('{} batch index: {}\{} (not save)'.format(validName,vi,len(valid_data_loader)),end='\r')
                     instance = valid_iter.next()
-                    metricsO,_ = saveFunc(config,instance,model,gpu,metrics)
-                    if type(metricsO) == dict:
-                        for typ,typeLists in metricsO.items():
-                            if type(typeLists) == dict:
-                                for name,lst in typeLists.items():
-                                    val_metrics_list[typ][name]+=lst
-                                    val_comb_metrics[typ]+=lst
-                            else:
-                                if type(typeLists) is float or type(typeLists) is int:
-                                    typeLists = [typeLists]
-                                if val_comb_metrics is not None and typeLists is not None:
-                                    val_comb_metrics[typ]+=typeLists
-                    else:
+                    metricsO,_ = saveFunc(config,instance,model,gpu,metrics,aggregator=val_metrics)
+                    if type(metricsO) != dict:
                         val_metrics_sum += metricsO.sum(axis=0)/metricsO.shape[0]
             except StopIteration:
                 print('ERROR: ran out of valid batches early. Expected {} more'.format(len(valid_data_loader)-vi))
@@ -274,10 +263,9 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
             print('{} metrics'.format(validName))
             for i in range(len(metrics)):
                 print(metrics[i].__name__ + ': '+str(val_metrics_sum[i]))
-            for typ in val_comb_metrics:
-                print('{} overall mean: {}, std {}'.format(typ,np.mean(val_comb_metrics[typ],axis=0), np.std(val_comb_metrics[typ],axis=0)))
-                for name, typeLists in val_metrics_list[typ].items():
-                    print('{} {} mean: {}, std {}'.format(typ,name,np.mean(typeLists,axis=0),np.std(typeLists,axis=0)))
+            printMetrics(val_metrics)
+            if summary is not None:
+                val_metrics.save(summary)
 
             if 'save_nns' in config:
                 import pickle
@@ -350,6 +338,12 @@ if __name__ == '__main__':
                         help='Run test set')
     parser.add_argument('-v', '--verbosity', default=2, type=int,
                         help='How much stuff to print [0,1,2] (default: 2)')
+    parser.add_argument('-S', '--summary', default=None, type=str,
+                        help='save the aggregated metrics to this json file (can be merged with -M) (default: None)')
+    parser.add_argument('-q', '--reservoir', default=0, type=int,
+                        help='keep a sample of this many values per metric for quantiles (default: 0)')
+    parser.add_argument('-M', '--merge', default=None, type=str,
+                        help='merge and print the metric summaries (from -S) of these comma separated files, e.g. from eval shards')
 
     args = parser.parse_args()
 
@@ -360,6 +354,19 @@ if __name__ == '__main__':
             split2=kv.split('=')
             addtoconfig.append(split2)
 
+    if args.merge is not None:
+        val_metrics = None
+        for path in args.merge.split(','):
+            shard = MetricAggregator.load(path)
+            if val_metrics is None:
+                val_metrics = shard
+            else:
+                val_metrics.merge(shard)
+        printMetrics(val_metrics)
+        if args.summary is not None:
+            val_metrics.save(args.summary)
+        exit()
+
     config = None
     if args.checkpoint is None and args.config is None:
         print('Must provide checkpoint (with -c)')
@@ -373,6 +380,6 @@ if __name__ == '__main__':
         index = args.imgname
     if args.gpu is not None:
         with torch.cuda.device(args.gpu):
-            main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,verbose=args.verbosity)
+            main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,verbose=args.verbosity,summary=args.summary,reservoir=args.reservoir)
     else:
-        main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,verbose=args.verbosity)
+        main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,verbose=args.verbosity,summary=args.summary,reservoir=args.reservoir)
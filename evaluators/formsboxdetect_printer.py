@@ -8,7 +8,7 @@ from model.alignment_loss import alignment_loss
 import math
 from model.loss import *
 from collections import defaultdict
-from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, getTargIndexForPreds_dist
+from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, getTargIndexForPreds_dist, confident_boxes
 import json
 from utils.util import ensure_dir
 
@@ -35,7 +35,7 @@ def plotRect(img,color,xyrhw,lineW=1):
     cv2.line(img,br,bl,color,lineW)
     cv2.line(img,bl,tl,color,lineW)
 
-def FormsBoxDetect_printer(config,instance, model, gpu, metrics, outDir=None, startIndex=None, lossFunc=None):
+def FormsBoxDetect_printer(config,instance, model, gpu, metrics, outDir=None, startIndex=None, lossFunc=None, aggregator=None):
     def __eval_metrics(data,target):
         acc_metrics = np.zeros((output.shape[0],len(metrics)))
         for ind in range(output.shape[0]):
@@ -161,9 +161,9 @@ def FormsBoxDetect_printer(config,instance, model, gpu, metrics, outDir=None, st
     threshConf = max(maxConf*THRESH,0.5)
 
     if model.rotation:
-        outputBBs = non_max_sup_dist(outputBBs.cpu(),threshConf,3)
+        outputBBs = non_max_sup_dist(confident_boxes(outputBBs,threshConf).cpu(),threshConf,3)
     else:
-        outputBBs = non_max_sup_iou(outputBBs.cpu(),threshConf,0.4)
+        outputBBs = non_max_sup_iou(confident_boxes(outputBBs,threshConf).cpu(),threshConf,0.4)
 
     numClasses = model.numBBTypes
     #aps_3=[]
@@ -476,6 +476,8 @@ def FormsBoxDetect_printer(config,instance, model, gpu, metrics, outDir=None, st
     for i in range(numClasses):
         toRet['class{}_ap'.format(i)]=class_aps[i]
 
+    if aggregator is not None:
+        aggregator.addResults(toRet)
     return (
              toRet,
              (lossThis, position_loss, conf_loss, class_loss, nn_loss, recall, precision,allPredNNs)
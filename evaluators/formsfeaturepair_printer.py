@@ -15,7 +15,7 @@ import random
 
 #THRESH=0
 
-def FormsFeaturePair_printer(config,instance, model, gpu, metrics, outDir=None, startIndex=None, lossFunc=None):
+def FormsFeaturePair_printer(config,instance, model, gpu, metrics, outDir=None, startIndex=None, lossFunc=None, aggregator=None):
     THRESH=0.3#0.8
     def plotRect(img,color,xyrhw):
         xc=xyrhw[0]
@@ -54,6 +54,7 @@ def FormsFeaturePair_printer(config,instance, model, gpu, metrics, outDir=None,
     imagePath = instance['imgPath']
     data = instance['data'][0]
     if len(data.size())<1 or data.size(0)==0:
+        #nothing to add to the aggregator, the lists are empty
         return (
              { 
                'recall':[],
@@ -355,6 +356,8 @@ def FormsFeaturePair_printer(config,instance, model, gpu, metrics, outDir=None,
         
     #return metricsOut
     print('\n{} ap:{}\tmissedRels:{}'.format(imageName,ap,missedRels))
+    if aggregator is not None:
+        aggregator.addResults(returnDict)
     return (
              #{ 'ap_5':np.array(aps_5).sum(axis=0),
              #  'ap_3':np.array(aps_3).sum(axis=0),
@@ -9,7 +9,8 @@ from model.alignment_loss import alignment_loss
 import math
 from model.loss import *
 from collections import defaultdict
-from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, getTargIndexForPreds_dist, computeAP
+from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, getTargIndexForPreds_dist, computeAPArrays
+from utils.graph_tools import pairsInAdj
 from model.optimize import optimizeRelationships, optimizeRelationshipsSoft
 import json
 from utils.forms_annotations import fixAnnotations, getBBInfo
@@ -33,7 +34,11 @@ def plotRect(img,color,xyrhw,lineWidth=1):
     cv2.line(img,br,bl,color,lineWidth)
     cv2.line(img,bl,tl,color,lineWidth)
 
-def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, startIndex=None, lossFunc=None):
+def countAbove(sortedValues,thresh):
+    #how many of the sorted values are greater than thresh (compared at their precision)
+    return len(sortedValues)-int(np.searchsorted(sortedValues,np.asarray(thresh,dtype=sortedValues.dtype),side='right'))
+
+def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, startIndex=None, lossFunc=None, aggregator=None):
     def __eval_metrics(data,target):
         acc_metrics = np.zeros((output.shape[0],len(metrics)))
         for ind in range(output.shape[0]):
@@ -120,7 +125,8 @@ def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, st
                 otherThresh=confThresh,
                 otherThreshIntur=1 if confThresh is not None else None,
                 hard_detect_limit=600,
-                old_nn=True)
+                old_nn=True,
+                imageName=imageName)
         outputBoxes=torch.cat((torch.ones(targetBoxes.size(1),1),targetBoxes[0,:,0:5],targetBoxes[0,:,-numClasses:]),dim=1) #add score
     elif type(useDetections) is str:
         dataset=config['DATASET']
@@ -151,7 +157,8 @@ def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, st
                 otherThresh=confThresh,
                 otherThreshIntur=1 if confThresh is not None else None,
                 hard_detect_limit=600,
-                old_nn=True)
+                old_nn=True,
+                imageName=imageName)
         outputBoxes=savedBoxes.cpu()
     elif useDetections:
         print('Unknown detection flag: '+useDetections)
@@ -161,7 +168,8 @@ def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, st
                 otherThresh=confThresh,
                 otherThreshIntur=1 if confThresh is not None else None,
                 hard_detect_limit=600,
-                old_nn=True)
+                old_nn=True,
+                imageName=imageName)
 
     if trackAtt:
         attList = model.pairer.attn
@@ -427,57 +435,46 @@ def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, st
             #class_acc=0
             useOutputBBs=None
 
-            truePred=falsePred=badPred=0
-            scores=[]
-            if len(relPred_otherTimes)>1:
-                scores_otherTimes=[[] for i in range(relPred_otherTimes.size(1))]
-            matches=0
-            i=0
-            numMissedByHeur=0
-            targGotHit=set()
-            #print('debug relPred: {}'.format(relPred.shape))
-            for i,(n0,n1) in enumerate(relCand):
-                t0 = bbAlignment[n0].item()
-                t1 = bbAlignment[n1].item()
-                if t0>=0 and bbFullHit[n0]:
-                    targGotHit.add(t0)
-                if t1>=0 and bbFullHit[n1]:
-                    targGotHit.add(t1)
-                if t0>=0 and t1>=0 and bbFullHit[n0] and bbFullHit[n1]:
-                    if (min(t0,t1),max(t0,t1)) in adjacency:
-                        matches+=1
-                        gtRel=True
-                        if relPred[i]>rel_threshold_use:
-                            truePred+=1
-                    else:
-                        gtRel=False
-                        if relPred[i]>rel_threshold_use:
-                            falsePred+=1
+            #The alignment of the relationships and their scores don't depend on the threshold (unless optimizing changed relPred),
+            #so these are found once, and each threshold just counts the sorted scores above it
+            if len(toRet)==0 or ('optimize' in config and config['optimize']):
+                if len(relCand)>0:
+                    rels = torch.LongTensor(relCand).view(-1,2)
+                    relConf = relPred.detach().cpu().view(-1).numpy()
+                    t0 = bbAlignment[rels[:,0]]
+                    t1 = bbAlignment[rels[:,1]]
+                    hit0 = (t0>=0) & bbFullHit[rels[:,0]].bool()
+                    hit1 = (t1>=0) & bbFullHit[rels[:,1]].bool()
+                    targGotHit = set(torch.cat((t0[hit0],t1[hit1])).tolist())
+                    aligned = hit0 & hit1
+                    gtRel = (aligned & pairsInAdj(torch.stack((torch.min(t0,t1),torch.max(t0,t1)),dim=1),adjacency)).numpy()
+                    aligned = aligned.numpy()
                 else:
-                    gtRel=False
-                    if relPred[i]>rel_threshold_use:
-                        badPred+=1
-                scores.append( (relPred[i],gtRel) )
-                if len(relPred_otherTimes.size())>1:
-                    for t in range(relPred_otherTimes.size(1)):
-                        scores_otherTimes[t].append( (relPred_otherTimes[i,t],gtRel) )
-            for i in range(len(adjacency)-matches):
-                numMissedByHeur+=1
-                scores.append( (float('nan'),True) )
+                    relConf = np.zeros(0,dtype=np.float32)
+                    gtRel = aligned = np.zeros(0,dtype=bool)
+                    targGotHit = set()
+                matches = int(gtRel.sum())
+                numMissedByHeur = max(len(adjacency)-matches,0)
+                nans = np.full(numMissedByHeur,float('nan'))
+                rel_ap=computeAPArrays(np.concatenate((relConf,nans)),np.concatenate((gtRel,np.ones(numMissedByHeur,dtype=bool))))
+                rel_ap_otherTimes=[]
                 if len(relPred_otherTimes.size())>1:
                     for t in range(relPred_otherTimes.size(1)):
-                        scores_otherTimes[t].append( (float('nan'),True) )
-            rel_ap=computeAP(scores)
-            rel_ap_otherTimes=[]
-            if len(relPred_otherTimes.size())>1:
-                for t in range(relPred_otherTimes.size(1)):
-                    rel_ap_otherTimes.append( computeAP(scores_otherTimes[t]) )
-
-            numMissedByDetect=0
-            for t0,t1 in adjacency:
-                if t0 not in targGotHit or t1 not in targGotHit:
-                    numMissedByHeur-=1
-                    numMissedByDetect+=1
+                        rel_ap_otherTimes.append( computeAPArrays(np.concatenate((relPred_otherTimes[:,t].cpu().numpy(),nans)),np.concatenate((gtRel,np.ones(numMissedByHeur,dtype=bool)))) )
+
+                numMissedByDetect=0
+                for t0,t1 in adjacency:
+                    if t0 not in targGotHit or t1 not in targGotHit:
+                        numMissedByHeur-=1
+                        numMissedByDetect+=1
+
+                valid = ~np.isnan(relConf)
+                trueConf = np.sort(relConf[valid & gtRel])
+                falseConf = np.sort(relConf[valid & aligned & ~gtRel])
+                badConf = np.sort(relConf[valid & ~aligned])
+            truePred = countAbove(trueConf,rel_threshold_use)
+            falsePred = countAbove(falseConf,rel_threshold_use)
+            badPred = countAbove(badConf,rel_threshold_use)
             if len(adjacency)>0:
                 relRecall = truePred/len(adjacency)
                 heurRecall = (len(adjacency)-numMissedByHeur)/len(adjacency)
@@ -866,6 +863,8 @@ def FormsGraphPair_printer(config,instance, model, gpu, metrics, outDir=None, st
     if model.predClass:
         retData['class_loss_final']=class_loss_final
         retData['class_loss_diff']=class_loss_final-class_loss
+    if aggregator is not None:
+        aggregator.addResults(retData)
     return (
              retData,
              (lossThis, position_loss, conf_loss, class_loss, recall, precision)
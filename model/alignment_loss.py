@@ -17,24 +17,87 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+try:
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+except ImportError: #scipy<1.6
+    min_weight_full_bipartite_matching = None
 import timeit
-from random import shuffle
+from utils.yolo_tools import pairwiseBlockSize
 
+#The assignment solvers take the [locations,targets] cost matrix and return the (location_ind, target_ind)
+#of the aligned pairs, ordered by target
 
-def greedy_assignment(scores):
-    target_ind=list(range(scores.shape[1]))
-    location_ind=min_indexes = np.argmin(scores,axis=0)
-    targets = list(range(scores.shape[1]))
-    shuffle(targets) #shuffle so there isn't any bias to the greediness
-    used = np.zeros(scores.shape[0])
-    for target_i in targets:
-        if used[location_ind[target_i]]: #has this location been taken already?
-            scores[location_ind[target_i],target_i]=np.inf #dont find this as the min
-            location_ind[target_i] = np.argmin(scores[:,target_i])
-        used[location_ind[target_i]]=1
+def hungarian_assignment(scores):
+    #exact, but cubic time
+    target_ind, location_ind = linear_sum_assignment(scores.T)
     return location_ind, target_ind
 
-def alignment_loss(predictions, target, label_sizes, alpha_alignment=1000.0, alpha_backprop=100.0, return_alignment=False, debug=None, points=False, allow_greedy_speedup=True):
+def greedy_assignment(scores):
+    #Repeatedly aligns the location and target that are each other's cheapest among those left.
+    #This gives the same alignment as taking the pairs in order of cost, but each round is done at once.
+    scores = np.where(np.isnan(scores),np.inf,scores)
+    location_ind = np.full(scores.shape[1],-1,dtype=np.int64)
+    freeLoc = np.ones(scores.shape[0],dtype=bool)
+    freeTarg = np.ones(scores.shape[1],dtype=bool)
+    while freeLoc.any() and freeTarg.any():
+        locs = np.nonzero(freeLoc)[0]
+        targs = np.nonzero(freeTarg)[0]
+        left = scores[np.ix_(locs,targs)]
+        bestLoc = np.argmin(left,axis=0)
+        bestTarg = np.argmin(left,axis=1)
+        mutual = bestTarg[bestLoc]==np.arange(len(targs))
+        location_ind[targs[mutual]] = locs[bestLoc[mutual]]
+        freeLoc[locs[bestLoc[mutual]]] = False
+        freeTarg[targs[mutual]] = False
+    target_ind = np.nonzero(location_ind>=0)[0]
+    return location_ind[target_ind], target_ind
+
+def sparse_assignment(scores, candidates=16, gate=None):
+    """
+    Min cost assignment, as hungarian_assignment, but only considering the candidates cheapest locations for each
+    target (or targets for each location if there are fewer locations) and, if gate is given, only those costing less
+    than gate more than the cheapest. The sparse problem is solved exactly (LAPJVsp), in about linear time and memory.
+    If no complete assignment is left, it's retried with twice the candidates and no gate, and once the candidates
+    cover every location it's solved densely.
+    """
+    transpose = scores.shape[0]<scores.shape[1]
+    cost = scores.T if transpose else scores #[the more,the fewer]
+    if min_weight_full_bipartite_matching is None:
+        return hungarian_assignment(scores)
+    cols = np.arange(cost.shape[1])[None,:]
+    while candidates<cost.shape[0]:
+        cand = np.argpartition(cost,candidates-1,axis=0)[:candidates] #[candidates,the fewer]
+        candCost = np.take_along_axis(cost,cand,axis=0)
+        keep = np.isfinite(candCost)
+        if gate is not None:
+            keep &= candCost<=candCost.min(axis=0)[None,:]+gate
+        candCols = np.broadcast_to(cols,cand.shape)
+        #shifted to be positive, which doesn't change the best full assignment (explicit zeros are ambiguous in sparse matrices)
+        weights = candCost[keep]-candCost[keep].min()+1 if keep.any() else candCost[keep]
+        graph = csr_matrix((weights,(candCols[keep],cand[keep])),shape=(cost.shape[1],cost.shape[0]))
+        try:
+            fewer_ind, more_ind = min_weight_full_bipartite_matching(graph)
+        except ValueError: #not every row can be matched among the candidates
+            candidates*=2
+            gate=None
+            continue
+        if transpose:
+            order = np.argsort(more_ind)
+            return fewer_ind[order], more_ind[order]
+        return more_ind, fewer_ind
+    return hungarian_assignment(scores)
+
+assignment_solvers = {
+        'hungarian': hungarian_assignment,
+        'sparse': sparse_assignment,
+        'greedy': greedy_assignment
+        }
+
+def alignment_loss(predictions, target, label_sizes, alpha_alignment=1000.0, alpha_backprop=100.0, return_alignment=False, debug=None, points=False, allow_greedy_speedup=True, assignment=None, assignment_candidates=16, assignment_gate=None):
+    #assignment is the solver for the alignment, a name in assignment_solvers or a function as those. By default it's
+    #exact (hungarian) for up to 200 targets, and sparse above that (unless allow_greedy_speedup is False).
+    #assignment_candidates and assignment_gate are the candidates and gate of sparse_assignment.
     batch_size = predictions.size(0)
     # This should probably be computed using the log_softmax
     confidences = predictions[:,:,0]
@@ -56,20 +119,17 @@ def alignment_loss(predictions, target, label_sizes, alpha_alignment=1000.0, alp
 
     log_confidences = torch.log(confidences + 1e-10)
 
-    expanded_locations = locations[:,:,None,:]
-    expanded_target = target[:,None,:,:]
-
-    expanded_locations = expanded_locations.expand(locations.size(0), locations.size(1), target.size(1), locations.size(2))
-    expanded_target = expanded_target.expand(target.size(0), locations.size(1), target.size(1), target.size(2))
-
-    #Compute All Deltas
-    location_deltas = (expanded_locations - expanded_target)
-
-    ious = torch.norm(location_deltas,2,3)**2
-    expanded_log_confidences = log_confidences[:,:,None].expand(locations.size(0), locations.size(1), target.size(1))
-    expanded_log_one_minus_confidences = log_one_minus_confidences[:,:,None].expand(locations.size(0), locations.size(1), target.size(1))
-
-    C = alpha_alignment/2.0 * ious - expanded_log_confidences + expanded_log_one_minus_confidences
+    #The cost of each prediction for each target is only used to find the alignment, so it's computed without a graph
+    #and over blocks of the predictions, so the [batch,pred,target,coord] deltas stay within the pairwise memory budget
+    with torch.no_grad():
+        block = pairwiseBlockSize(locations.size(0)*target.size(1),(locations.size(2)+2)*locations.element_size())
+        if block is None:
+            block = locations.size(1)
+        C = []
+        for i in range(0,max(locations.size(1),1),max(block,1)):
+            ious = torch.norm(locations[:,i:i+block,None,:] - target[:,None,:,:],2,3)**2
+            C.append( alpha_alignment/2.0 * ious - log_confidences[:,i:i+block,None] + log_one_minus_confidences[:,i:i+block,None] )
+        C = torch.cat(C,dim=1)
 
     C = C.data.cpu().numpy()
     X = np.zeros_like(C)
@@ -92,13 +152,18 @@ def alignment_loss(predictions, target, label_sizes, alpha_alignment=1000.0, alp
         #    maxV=C_i[np.logical_not(isnan_)].max()
         #    C_i[isnan_]=maxV
         #tic=timeit.default_timer()
-        if debug is None:
-            if allow_greedy_speedup and l > 200:
-                location_ind, target_ind = greedy_assignment(C_i)
-            else:
-                target_ind, location_ind = linear_sum_assignment(C_i.T)
-        elif debug:
-            location_ind, target_ind = greedy_assignment(C_i)
+        if debug:
+            solver = greedy_assignment
+        elif assignment is not None:
+            solver = assignment_solvers[assignment] if type(assignment) is str else assignment
+        elif allow_greedy_speedup and l > 200:
+            solver = sparse_assignment
+        else:
+            solver = hungarian_assignment
+        if solver is sparse_assignment:
+            location_ind, target_ind = solver(C_i, assignment_candidates, assignment_gate)
+        else:
+            location_ind, target_ind = solver(C_i)
         #print(' batch {} of size {} linear_sum_assign: {}'.format(b,l,timeit.default_timer()-tic))
         X[b][(location_ind, target_ind)] = 1.0
         if return_alignment:
@@ -122,11 +187,14 @@ def alignment_loss(predictions, target, label_sizes, alpha_alignment=1000.0, alp
         #        exit()
 
 
+    #only the aligned pairs contribute to the loss
+    alignedB, alignedLoc, alignedTarg = [torch.from_numpy(ind).to(locations.device) for ind in np.nonzero(X)]
     X = torch.from_numpy(X).type(predictions.data.type())
-    X2 = 1.0 - torch.sum(X, 2)
+    X1 = torch.sum(X, 2)
+    X2 = 1.0 - X1
 
-    location_loss = (alpha_backprop/2.0 * ious * X).sum()
-    confidence_loss =  -(expanded_log_confidences * X).sum() - (log_one_minus_confidences * X2).sum()
+    location_loss = (alpha_backprop/2.0 * torch.norm(locations[alignedB,alignedLoc] - target[alignedB,alignedTarg],2,1)**2).sum()
+    confidence_loss =  -(log_confidences * X1).sum() - (log_one_minus_confidences * X2).sum()
 
     loss = confidence_loss + location_loss
 
@@ -145,8 +213,8 @@ def alignment_loss(predictions, target, label_sizes, alpha_alignment=1000.0, alp
         return loss, location_ind_bs, target_ind_bs
     return loss
 
-def alignment_loss_points(predictions, target, label_sizes, alpha_alignment=1000.0, alpha_backprop=100.0, return_alignment=False, debug=None):
-    return alignment_loss(predictions, target, label_sizes, alpha_alignment,alpha_backprop,return_alignment,debug,points=True)
+def alignment_loss_points(predictions, target, label_sizes, alpha_alignment=1000.0, alpha_backprop=100.0, return_alignment=False, debug=None, assignment=None, assignment_candidates=16, assignment_gate=None):
+    return alignment_loss(predictions, target, label_sizes, alpha_alignment,alpha_backprop,return_alignment,debug,points=True,assignment=assignment,assignment_candidates=assignment_candidates,assignment_gate=assignment_gate)
 
 
 
@@ -0,0 +1,44 @@
+#pragma once
+#include <torch/torch.h>
+
+#include "cpu/vision.h"
+
+// Interface for Python
+// boxes are rows of (x,y,r,h,w,...), see utils/yolo_tools.allBoxDistNeg
+at::Tensor box_dist_neg(const at::Tensor& boxes1,
+                        const at::Tensor& boxes2) {
+  if (boxes1.is_cuda()) {
+    AT_ERROR("Not implemented on the GPU");
+  }
+  return BoxDistNeg_cpu(boxes1, boxes2);
+}
+
+// boxes must be sorted by confidence, returns a byte mask of the boxes kept
+at::Tensor nms_dist(const at::Tensor& boxes,
+                    const float thresh) {
+  if (boxes.is_cuda()) {
+    AT_ERROR("Not implemented on the GPU");
+  }
+  return NMSDist_cpu(boxes, thresh);
+}
+
+// the max of box_dist_neg along dim (0: over boxes1 for each of boxes2, 1: over boxes2 for each of boxes1) and its index
+std::tuple<at::Tensor, at::Tensor> box_dist_neg_best(const at::Tensor& boxes1,
+                                                     const at::Tensor& boxes2,
+                                                     const int dim) {
+  if (boxes1.is_cuda()) {
+    AT_ERROR("Not implemented on the GPU");
+  }
+  return BoxDistNegBest_cpu(boxes1, boxes2, dim);
+}
+
+// the max IOU along dim and its index, see utils/yolo_tools.allIOU (x1,y1,w1,h1 are boxes1XYWH)
+std::tuple<at::Tensor, at::Tensor> iou_best(const at::Tensor& boxes1,
+                                            const at::Tensor& boxes2,
+                                            const int dim,
+                                            const int x1, const int y1, const int w1, const int h1) {
+  if (boxes1.is_cuda()) {
+    AT_ERROR("Not implemented on the GPU");
+  }
+  return IOUBest_cpu(boxes1, boxes2, dim, x1, y1, w1, h1);
+}
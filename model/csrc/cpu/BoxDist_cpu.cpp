@@ -0,0 +1,269 @@
+#include "cpu/vision.h"
+#include <cmath>
+#include <vector>
+#include <algorithm>
+#include <tuple>
+
+// Rotated box distance used for NMS and matching when boxes have rotation (see utils/yolo_tools.allBoxDistNeg).
+// Boxes are rows of (x,y,r,h,w); each box is reduced to the 4 points (left,right,top,bottom)
+// and the distance is ((sum of the point distances)/(mean half size))^2, negated so larger means closer.
+
+template <typename T>
+struct BoxPoints {
+  T p[8];
+  T hw;
+};
+
+template <typename T>
+BoxPoints<T> box_points(const T* box) {
+  BoxPoints<T> bp;
+  T sin_r = std::sin(box[2]);
+  T cos_r = std::cos(box[2]);
+  bp.p[0] = box[0] - cos_r*box[4];
+  bp.p[1] = box[1] + sin_r*box[3];
+  bp.p[2] = box[0] + cos_r*box[4];
+  bp.p[3] = box[1] - sin_r*box[3];
+  bp.p[4] = box[0] - cos_r*box[4];
+  bp.p[5] = box[1] - sin_r*box[3];
+  bp.p[6] = box[0] + cos_r*box[4];
+  bp.p[7] = box[1] + sin_r*box[3];
+  bp.hw = (box[4]+box[3])/2;
+  return bp;
+}
+
+template <typename T>
+T box_dist_neg(const BoxPoints<T>& a, const BoxPoints<T>& b) {
+  T sum = 0;
+  for (int k = 0; k < 8; k += 2) {
+    T dx = a.p[k] - b.p[k];
+    T dy = a.p[k+1] - b.p[k+1];
+    sum += std::sqrt(dx*dx + dy*dy);
+  }
+  T d = sum/((a.hw + b.hw)/2);
+  return -d*d;
+}
+
+template <typename T>
+std::vector<BoxPoints<T>> all_box_points(const T* boxes, int num, int stride) {
+  std::vector<BoxPoints<T>> points(num);
+  for (int i = 0; i < num; i++) {
+    points[i] = box_points(boxes + i*stride);
+  }
+  return points;
+}
+
+template <typename T>
+void BoxDistNeg_cpu_kernel(const T* boxes1, int num1, int stride1,
+                           const T* boxes2, int num2, int stride2,
+                           T* out) {
+  std::vector<BoxPoints<T>> points1 = all_box_points(boxes1, num1, stride1);
+  std::vector<BoxPoints<T>> points2 = all_box_points(boxes2, num2, stride2);
+  for (int i = 0; i < num1; i++) {
+    for (int j = 0; j < num2; j++) {
+      out[i*num2 + j] = box_dist_neg(points1[i], points2[j]);
+    }
+  }
+}
+
+// Corners of axis aligned boxes, as utils/yolo_tools.allIOU (x,y,half width,half height columns)
+template <typename T>
+struct BoxCorners {
+  std::vector<T> x1, x2, y1, y2, area;
+};
+
+template <typename T>
+BoxCorners<T> all_box_corners(const T* boxes, int num, int stride, int x, int y, int w, int h) {
+  BoxCorners<T> corners;
+  corners.x1.resize(num); corners.x2.resize(num);
+  corners.y1.resize(num); corners.y2.resize(num);
+  corners.area.resize(num);
+  for (int i = 0; i < num; i++) {
+    const T* b = boxes + i*stride;
+    corners.x1[i] = b[x] - b[w];
+    corners.x2[i] = b[x] + b[w];
+    corners.y1[i] = b[y] - b[h];
+    corners.y2[i] = b[y] + b[h];
+    corners.area[i] = (corners.x2[i] - corners.x1[i] + 1) * (corners.y2[i] - corners.y1[i] + 1);
+  }
+  return corners;
+}
+
+// Best (largest) value along dim of a pairwise matrix and its first index, without storing the matrix.
+// row(i,out) fills out with the values of boxes1[i] against every box of boxes2.
+template <typename T, typename Row>
+void best_along(int num1, int num2, int dim, Row row, T* best, int64_t* index) {
+  std::vector<T> values(num2);
+  for (int i = 0; i < num1; i++) {
+    row(i, values.data());
+    if (dim == 0) {
+      for (int j = 0; j < num2; j++) {
+        if (i == 0 || values[j] > best[j]) {
+          best[j] = values[j];
+          index[j] = i;
+        }
+      }
+    } else {
+      T bestV = values.size() > 0 ? values[0] : T(0);
+      int64_t bestI = 0;
+      for (int j = 1; j < num2; j++) {
+        if (values[j] > bestV) {
+          bestV = values[j];
+          bestI = j;
+        }
+      }
+      best[i] = bestV;
+      index[i] = bestI;
+    }
+  }
+}
+
+template <typename T>
+void BoxDistNegBest_cpu_kernel(const T* boxes1, int num1, int stride1,
+                               const T* boxes2, int num2, int stride2,
+                               int dim, T* best, int64_t* index) {
+  std::vector<BoxPoints<T>> points1 = all_box_points(boxes1, num1, stride1);
+  std::vector<BoxPoints<T>> points2 = all_box_points(boxes2, num2, stride2);
+  best_along(num1, num2, dim,
+             [&](int i, T* out) {
+               for (int j = 0; j < num2; j++) {
+                 out[j] = box_dist_neg(points1[i], points2[j]);
+               }
+             },
+             best, index);
+}
+
+template <typename T>
+void IOUBest_cpu_kernel(const T* boxes1, int num1, int stride1,
+                        const T* boxes2, int num2, int stride2,
+                        int x1, int y1, int w1, int h1,
+                        int dim, T* best, int64_t* index) {
+  BoxCorners<T> c1 = all_box_corners(boxes1, num1, stride1, x1, y1, w1, h1);
+  BoxCorners<T> c2 = all_box_corners(boxes2, num2, stride2, 0, 1, 4, 3);
+  const T* b2_x1 = c2.x1.data(); const T* b2_x2 = c2.x2.data();
+  const T* b2_y1 = c2.y1.data(); const T* b2_y2 = c2.y2.data();
+  const T* b2_area = c2.area.data();
+  best_along(num1, num2, dim,
+             [&](int i, T* out) {
+               T b1_x1 = c1.x1[i], b1_x2 = c1.x2[i], b1_y1 = c1.y1[i], b1_y2 = c1.y2[i], b1_area = c1.area[i];
+               for (int j = 0; j < num2; j++) {
+                 T inter_w = std::min(b1_x2, b2_x2[j]) - std::max(b1_x1, b2_x1[j]) + 1;
+                 T inter_h = std::min(b1_y2, b2_y2[j]) - std::max(b1_y1, b2_y1[j]) + 1;
+                 T inter_area = std::max(inter_w, T(0)) * std::max(inter_h, T(0));
+                 out[j] = inter_area / (b1_area + b2_area[j] - inter_area + T(1e-16));
+               }
+             },
+             best, index);
+}
+
+template <typename T>
+void NMSDist_cpu_kernel(const T* boxes, int num, int stride, const float thresh, uint8_t* keep) {
+  std::vector<BoxPoints<T>> points = all_box_points(boxes, num, stride);
+  for (int i = 0; i < num; i++) {
+    keep[i] = 1;
+  }
+  // greedy, boxes are already in order of confidence
+  for (int i = 0; i < num; i++) {
+    if (!keep[i]) continue;
+    for (int j = i+1; j < num; j++) {
+      if (keep[j] && box_dist_neg(points[i], points[j]) > thresh) {
+        keep[j] = 0;
+      }
+    }
+  }
+}
+
+at::Tensor BoxDistNeg_cpu(const at::Tensor& boxes1,
+                          const at::Tensor& boxes2) {
+  AT_ASSERTM(!boxes1.is_cuda(), "boxes1 must be a CPU tensor");
+  AT_ASSERTM(!boxes2.is_cuda(), "boxes2 must be a CPU tensor");
+  AT_ASSERTM(boxes1.size(1) >= 5 && boxes2.size(1) >= 5, "boxes must have (x,y,r,h,w)");
+  auto b1 = boxes1.contiguous();
+  auto b2 = boxes2.contiguous();
+  auto output = at::empty({b1.size(0), b2.size(0)}, b1.options());
+  if (output.numel() == 0) {
+    return output;
+  }
+
+  AT_DISPATCH_FLOATING_TYPES(b1.scalar_type(), "BoxDistNeg", [&] {
+    BoxDistNeg_cpu_kernel<scalar_t>(
+         b1.data_ptr<scalar_t>(), b1.size(0), b1.size(1),
+         b2.data_ptr<scalar_t>(), b2.size(0), b2.size(1),
+         output.data_ptr<scalar_t>());
+  });
+  return output;
+}
+
+at::Tensor NMSDist_cpu(const at::Tensor& boxes,
+                       const float thresh) {
+  AT_ASSERTM(!boxes.is_cuda(), "boxes must be a CPU tensor");
+  AT_ASSERTM(boxes.size(1) >= 5, "boxes must have (x,y,r,h,w)");
+  auto b = boxes.contiguous();
+  auto keep = at::empty({b.size(0)}, b.options().dtype(at::kByte));
+  if (keep.numel() == 0) {
+    return keep;
+  }
+
+  AT_DISPATCH_FLOATING_TYPES(b.scalar_type(), "NMSDist", [&] {
+    NMSDist_cpu_kernel<scalar_t>(
+         b.data_ptr<scalar_t>(), b.size(0), b.size(1),
+         thresh,
+         keep.data_ptr<uint8_t>());
+  });
+  return keep;
+}
+
+std::tuple<at::Tensor, at::Tensor> BoxDistNegBest_cpu(const at::Tensor& boxes1,
+                                                      const at::Tensor& boxes2,
+                                                      const int dim) {
+  AT_ASSERTM(!boxes1.is_cuda(), "boxes1 must be a CPU tensor");
+  AT_ASSERTM(!boxes2.is_cuda(), "boxes2 must be a CPU tensor");
+  AT_ASSERTM(boxes1.size(1) >= 5 && boxes2.size(1) >= 5, "boxes must have (x,y,r,h,w)");
+  AT_ASSERTM(dim == 0 || dim == 1, "dim must be 0 or 1");
+  auto b1 = boxes1.contiguous();
+  auto b2 = boxes2.contiguous();
+  auto best = at::empty({dim == 0 ? b2.size(0) : b1.size(0)}, b1.options());
+  auto index = at::empty({best.size(0)}, b1.options().dtype(at::kLong));
+  if (best.numel() == 0) {
+    return std::make_tuple(best, index);
+  }
+  AT_ASSERTM((dim == 0 ? b1.size(0) : b2.size(0)) > 0, "cannot reduce over no boxes");
+
+  AT_DISPATCH_FLOATING_TYPES(b1.scalar_type(), "BoxDistNegBest", [&] {
+    BoxDistNegBest_cpu_kernel<scalar_t>(
+         b1.data_ptr<scalar_t>(), b1.size(0), b1.size(1),
+         b2.data_ptr<scalar_t>(), b2.size(0), b2.size(1),
+         dim,
+         best.data_ptr<scalar_t>(),
+         index.data_ptr<int64_t>());
+  });
+  return std::make_tuple(best, index);
+}
+
+std::tuple<at::Tensor, at::Tensor> IOUBest_cpu(const at::Tensor& boxes1,
+                                               const at::Tensor& boxes2,
+                                               const int dim,
+                                               const int x1, const int y1, const int w1, const int h1) {
+  AT_ASSERTM(!boxes1.is_cuda(), "boxes1 must be a CPU tensor");
+  AT_ASSERTM(!boxes2.is_cuda(), "boxes2 must be a CPU tensor");
+  AT_ASSERTM(boxes2.size(1) >= 5, "boxes2 must have (x,y,r,h,w)");
+  AT_ASSERTM(dim == 0 || dim == 1, "dim must be 0 or 1");
+  auto b1 = boxes1.contiguous();
+  auto b2 = boxes2.contiguous();
+  auto best = at::empty({dim == 0 ? b2.size(0) : b1.size(0)}, b1.options());
+  auto index = at::empty({best.size(0)}, b1.options().dtype(at::kLong));
+  if (best.numel() == 0) {
+    return std::make_tuple(best, index);
+  }
+  AT_ASSERTM((dim == 0 ? b1.size(0) : b2.size(0)) > 0, "cannot reduce over no boxes");
+
+  AT_DISPATCH_FLOATING_TYPES(b1.scalar_type(), "IOUBest", [&] {
+    IOUBest_cpu_kernel<scalar_t>(
+         b1.data_ptr<scalar_t>(), b1.size(0), b1.size(1),
+         b2.data_ptr<scalar_t>(), b2.size(0), b2.size(1),
+         x1, y1, w1, h1,
+         dim,
+         best.data_ptr<scalar_t>(),
+         index.data_ptr<int64_t>());
+  });
+  return std::make_tuple(best, index);
+}
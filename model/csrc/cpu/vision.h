@@ -10,3 +10,18 @@ at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
                                 const int pooled_height,
                                 const int pooled_width,
                                 const int sampling_ratio);
+
+at::Tensor BoxDistNeg_cpu(const at::Tensor& boxes1,
+                          const at::Tensor& boxes2);
+
+at::Tensor NMSDist_cpu(const at::Tensor& boxes,
+                       const float thresh);
+
+std::tuple<at::Tensor, at::Tensor> BoxDistNegBest_cpu(const at::Tensor& boxes1,
+                                                      const at::Tensor& boxes2,
+                                                      const int dim);
+
+std::tuple<at::Tensor, at::Tensor> IOUBest_cpu(const at::Tensor& boxes1,
+                                               const at::Tensor& boxes2,
+                                               const int dim,
+                                               const int x1, const int y1, const int w1, const int h1);
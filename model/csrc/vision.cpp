@@ -1,6 +1,7 @@
 // Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 //#include "nms.h"
 #include "ROIAlign.h"
+#include "BoxDist.h"
 //#include "ROIPool.h"
 
 
@@ -8,6 +9,10 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   //m.def("nms", &nms, "non-maximum suppression");
   m.def("roi_align_forward", &ROIAlign_forward, "ROIAlign_forward");
   m.def("roi_align_backward", &ROIAlign_backward, "ROIAlign_backward");
+  m.def("box_dist_neg", &box_dist_neg, "rotated box distance (negated) between every pair of boxes");
+  m.def("nms_dist", &nms_dist, "greedy non-maximum suppression with the rotated box distance");
+  m.def("box_dist_neg_best", &box_dist_neg_best, "best rotated box distance (negated) and its index along a dimension");
+  m.def("iou_best", &iou_best, "best IOU and its index along a dimension");
   //m.def("roi_pool_forward", &ROIPool_forward, "ROIPool_forward");
   //m.def("roi_pool_backward", &ROIPool_backward, "ROIPool_backward");
 }
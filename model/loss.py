@@ -29,8 +29,8 @@ def MSE(y_input, y_target):
 
 
 
-def detect_alignment_loss(predictions, target,label_sizes,alpha_alignment, alpha_backprop):
-    return alignment_loss(predictions, target, label_sizes, alpha_alignment, alpha_backprop)
-def detect_alignment_loss_points(predictions, target,label_sizes,alpha_alignment, alpha_backprop):
-    return alignment_loss(predictions, target, label_sizes, alpha_alignment, alpha_backprop,points=True)
+def detect_alignment_loss(predictions, target,label_sizes,alpha_alignment, alpha_backprop, assignment=None, assignment_candidates=16, assignment_gate=None):
+    return alignment_loss(predictions, target, label_sizes, alpha_alignment, alpha_backprop,assignment=assignment,assignment_candidates=assignment_candidates,assignment_gate=assignment_gate)
+def detect_alignment_loss_points(predictions, target,label_sizes,alpha_alignment, alpha_backprop, assignment=None, assignment_candidates=16, assignment_gate=None):
+    return alignment_loss(predictions, target, label_sizes, alpha_alignment, alpha_backprop,points=True,assignment=assignment,assignment_candidates=assignment_candidates,assignment_gate=assignment_gate)
 
@@ -26,7 +26,10 @@ from model.roi_align import ROIAlign as RoIAlign
 #from model.cnn_lstm import CRNN
 from skimage import draw
 from model.net_builder import make_layers, getGroupSize
-from utils.yolo_tools import non_max_sup_iou, non_max_sup_dist
+from utils.yolo_tools import non_max_sup_iou, non_max_sup_dist, confident_boxes
+from utils.line_of_sight import LineOfSight, PerimeterIndex
+from utils.graph_cache import GraphCache
+from utils.graph_tools import pairRois, boxRois, rasterizePolygons, occupancyMask, maskRois, pairShapeFeats, boxShapeFeats, graphEdges
 from utils.util import decode_handwriting
 import math
 import random
@@ -96,7 +99,10 @@ class PairingGraph(BaseModel):
         self.useBBVisualFeats=True
         if config['graph_config']['arch'][:10]=='BinaryPair' and not self.predNN:
             self.useBBVisualFeats=False
+        #true is 'legacy', the rel-rel edges the released models were trained with, 'shared_box' links every two relationships sharing a box (see utils.graph_tools.graphEdges)
         self.includeRelRelEdges= config['use_rel_rel_edges'] if 'use_rel_rel_edges' in config else True
+        if self.includeRelRelEdges is True:
+            self.includeRelRelEdges='legacy'
         #rel_channels = config['graph_config']['rel_channels']
         self.pool_h = config['featurizer_start_h']
         self.pool_w = config['featurizer_start_w']
@@ -213,6 +219,7 @@ class PairingGraph(BaseModel):
             self.relFeaturizerConv = nn.Sequential(*layers)
 
             self.roi_align = RoIAlign(self.pool_h,self.pool_w,1.0/detect_save_scale)
+            self.roi_alignMask = RoIAlign(self.pool2_h,self.pool2_w,1.0,1) #one bilinear sample per bin, for the image resolution occupancy mask
             if self.use2ndFeatures:
                 self.roi_align2 = RoIAlign(self.pool2_h,self.pool2_w,1.0/detect_save2_scale)
         else:
@@ -292,6 +299,7 @@ class PairingGraph(BaseModel):
                 self.bbFeaturizerConv = nn.Sequential(*convlayers)
 
                 self.roi_alignBB = RoIAlign(self.poolBB_h,self.poolBB_w,1.0/detect_save_scale)
+                self.roi_alignBBMask = RoIAlign(self.poolBB2_h,self.poolBB2_w,1.0,1)
                 if self.use2ndFeatures:
                     self.roi_alignBB2 = RoIAlign(self.poolBB2_h,self.poolBB2_w,1.0/detect_save2_scale)
             else:
@@ -310,6 +318,13 @@ class PairingGraph(BaseModel):
             MAX_GRAPH_SIZE = config['max_graph_size']
 
         self.useOldDecay = config['use_old_len_decay'] if 'use_old_len_decay' in config else False
+        #'walk' is the original pixel walker, 'vectorized' casts all the rays at once (utils/line_of_sight.py)
+        self.candidateEngine = config['candidate_engine'] if 'candidate_engine' in config else 'walk'
+        #When evaluating, reuse the candidates and edges of boxes seen before (optionally saved to graph_cache_dir for later runs)
+        if 'graph_cache_size' in config and config['graph_cache_size']:
+            self.graphCache = GraphCache(config['graph_cache_size'],config['graph_cache_dir'] if 'graph_cache_dir' in config else None)
+        else:
+            self.graphCache = None
 
 
         #HWR stuff
@@ -351,7 +366,7 @@ class PairingGraph(BaseModel):
             print('Unfroze detector')
         
 
-    def forward(self, image, gtBBs=None, gtNNs=None, useGTBBs=False, otherThresh=None, otherThreshIntur=None, hard_detect_limit=300, debug=False,old_nn=False):
+    def forward(self, image, gtBBs=None, gtNNs=None, useGTBBs=False, otherThresh=None, otherThreshIntur=None, hard_detect_limit=300, debug=False,old_nn=False,imageName=None):
         ##tic=timeit.default_timer()
         bbPredictions, offsetPredictions, _,_,_,_ = self.detector(image)
         _=None
@@ -376,9 +391,9 @@ class PairingGraph(BaseModel):
             confThreshMul = self.confThresh*(1-otherThreshIntur) + otherThresh*otherThreshIntur
         threshConf = max(maxConf*confThreshMul,0.5)
         if self.rotation:
-            bbPredictions = non_max_sup_dist(bbPredictions.cpu(),threshConf,2.5,hard_detect_limit)
+            bbPredictions = non_max_sup_dist(confident_boxes(bbPredictions,threshConf,hard_detect_limit).cpu(),threshConf,2.5,hard_detect_limit)
         else:
-            bbPredictions = non_max_sup_iou(bbPredictions.cpu(),threshConf,0.4,hard_detect_limit)
+            bbPredictions = non_max_sup_iou(confident_boxes(bbPredictions,threshConf,hard_detect_limit).cpu(),threshConf,0.4,hard_detect_limit)
         #I'm assuming batch size of one
         assert(len(bbPredictions)==1)
         bbPredictions=bbPredictions[0]
@@ -430,20 +445,23 @@ class PairingGraph(BaseModel):
                 bbOuts, relOuts = self.pairer(bbAndRel_features, adjacencyMatrix, numBBs)
             else:
                 #If evaluating, force the masks of relationships to be the two ways and average
-                bbAndRel_features, adjacencyMatrix, numBBs, numRel, relIndexes = self.createGraph(useBBs,saved_features,saved_features2,image.size(-2),image.size(-1),text_emb=embeddings,flip=False)
+                #Both directions are built in one createGraph call, the rel features of the flipped one follow the unflipped ones
+                bbAndRel_features, adjacencyMatrix, numBBs, numRel, relIndexes = self.createGraph(useBBs,saved_features,saved_features2,image.size(-2),image.size(-1),text_emb=embeddings,flip='both',imageName=imageName)
                 if bbAndRel_features is None:
                     return bbPredictions, offsetPredictions, None, None, None
 
-                bbAndRel_features_B, adjacencyMatrix_B, numBBs_B, numRel_B, relIndexes_B = self.createGraph(useBBs,saved_features,saved_features2,image.size(-2),image.size(-1),text_emb=embeddings,flip=True)
-
-                assert(numBBs==numBBs_B and numRel==numRel_B)
-                for i,(n1,n2) in enumerate(relIndexes):
-                    assert(relIndexes_B[i][0]==n1 and relIndexes_B[i][1]==n2)
-                bbOuts, relOuts = self.pairer(bbAndRel_features, adjacencyMatrix, numBBs)
-                bbOuts_B, relOuts_B = self.pairer(bbAndRel_features_B, adjacencyMatrix, numBBs)
-                #Average results together
-                if bbOuts is not None:
-                    bbOuts = (bbOuts+bbOuts_B)/2
+                if type(self.pairer) is BinaryPairReal:
+                    #each node is classified on its own, so both directions can go through together
+                    bbOuts, relOuts = self.pairer(bbAndRel_features, adjacencyMatrix, numBBs)
+                    relOuts_B = relOuts[numRel:]
+                    relOuts = relOuts[:numRel]
+                else:
+                    bbFeats = bbAndRel_features[:numBBs]
+                    bbOuts, relOuts = self.pairer(bbAndRel_features[:numBBs+numRel], adjacencyMatrix, numBBs)
+                    bbOuts_B, relOuts_B = self.pairer(torch.cat((bbFeats,bbAndRel_features[numBBs+numRel:]),dim=0), adjacencyMatrix, numBBs)
+                    #Average results together
+                    if bbOuts is not None:
+                        bbOuts = (bbOuts+bbOuts_B)/2
                 relOuts = (relOuts+relOuts_B)/2
                 ####
                 #print(" TO GET IMAGE OF LINEOFSIGHT")
@@ -476,13 +494,27 @@ class PairingGraph(BaseModel):
         else:
             return bbPredictions, offsetPredictions, None, None, None
 
-    def createGraph(self,bbs,features,features2,imageHeight,imageWidth,text_emb=None,flip=None,debug_image=None):
+    def createGraph(self,bbs,features,features2,imageHeight,imageWidth,text_emb=None,flip=None,debug_image=None,imageName=None):
         if text_emb is not None:
             raise NotImplemented('having appened text emb yet')
         ##tic=timeit.default_timer()
-        candidates = self.selectCandidateEdges(bbs,imageHeight,imageWidth)
+        cached = None
+        cacheChanged = False
+        if self.graphCache is not None and not self.training:
+            cacheKey = GraphCache.key(imageName,bbs[:,:5],imageHeight,imageWidth,self.useOldDecay,self.includeRelRelEdges,self.expandedRelContext,self.expandedBBContext)
+            cached = self.graphCache.get(cacheKey)
+            if cached is None:
+                candidates = self.selectCandidateEdges(bbs,imageHeight,imageWidth)
+                cached = {'candidates':torch.LongTensor(candidates).view(-1,2)}
+                cacheChanged = True
+            else:
+                candidates = [tuple(c) for c in cached['candidates'].tolist()]
+        else:
+            candidates = self.selectCandidateEdges(bbs,imageHeight,imageWidth)
         ##print('  candidate: {}'.format(timeit.default_timer()-tic))
         if len(candidates)==0:
+            if cacheChanged:
+                self.graphCache.put(cacheKey,cached)
             return None,None,None,None,None
         ##tic=timeit.default_timer()
 
@@ -504,6 +536,8 @@ class PairingGraph(BaseModel):
         brY = -w*sin_r + h*cos_r +y
         blX = -w*cos_r + h*sin_r +x
         blY =  w*sin_r + h*cos_r +y
+        cornersX = torch.stack((tlX,trX,brX,blX),dim=1)
+        cornersY = torch.stack((tlY,trY,brY,blY),dim=1)
 
         tlX = tlX.cpu()
         tlY = tlY.cpu()
@@ -518,29 +552,24 @@ class PairingGraph(BaseModel):
             debug_images=[]
             debug_masks=[]
 
+        candIndexes = torch.LongTensor(candidates).to(cornersX.device)
+        allMasks=None #page occupancy, shared by the rel and bb context masks
         if self.useShapeFeats!='only':
             #get axis aligned rectangle from corners
-            rois = torch.zeros((len(candidates),5)) #(batchIndex,x1,y1,x2,y2) as expected by ROI Align
-            for i,(index1, index2) in enumerate(candidates):
-                maxX = max(tlX[index1],tlX[index2],trX[index1],trX[index2],blX[index1],blX[index2],brX[index1],brX[index2])
-                minX = min(tlX[index1],tlX[index2],trX[index1],trX[index2],blX[index1],blX[index2],brX[index1],brX[index2])
-                maxY = max(tlY[index1],tlY[index2],trY[index1],trY[index2],blY[index1],blY[index2],brY[index1],brY[index2])
-                minY = min(tlY[index1],tlY[index2],trY[index1],trY[index2],blY[index1],blY[index2],brY[index1],brY[index2])
-                if self.expandedRelContext is not None:
-                    maxX = min(maxX.item()+self.expandedRelContext,imageWidth-1)
-                    minX = max(minX.item()-self.expandedRelContext,0)
-                    maxY = min(maxY.item()+self.expandedRelContext,imageHeight-1)
-                    minY = max(minY.item()-self.expandedRelContext,0)
-                rois[i,1]=minX
-                rois[i,2]=minY
-                rois[i,3]=maxX
-                rois[i,4]=maxY
-
-
-
-
-                ###DEBUG
-                if debug_image is not None and i<5:
+            if cached is not None and 'relRois' in cached:
+                relRois = cached['relRois'].to(cornersX.device)
+            else:
+                relRois = pairRois(cornersX,cornersY,candIndexes,self.expandedRelContext,imageHeight,imageWidth)
+                if cached is not None:
+                    cached['relRois'] = relRois.cpu()
+                    cacheChanged = True
+            roisDevice = relRois.to(features.device)
+            rois = relRois.cpu()
+
+            ###DEBUG
+            if debug_image is not None:
+                for i,(index1, index2) in enumerate(candidates[:5]):
+                    minX,minY,maxX,maxY = rois[i,1:]
                     assert(self.rotation==False)
                     #print('crop {}: ({},{}), ({},{})'.format(i,minX.item(),maxX.item(),minY.item(),maxY.item()))
                     #print(bbs[index1])
@@ -555,14 +584,14 @@ class PairingGraph(BaseModel):
                     #cv2.imshow('crop {}'.format(i),crop)
                     debug_images.append(crop)
                     #import pdb;pdb.set_trace()
-                ###
+            ###
             #if debug_image is not None:
             #    cv2.waitKey()
 
             #crop from feats, ROI pool
-            stackedEdgeFeatWindows = self.roi_align(features,rois.to(features.device))
+            stackedEdgeFeatWindows = self.roi_align(features,roisDevice)
             if features2 is not None:
-                stackedEdgeFeatWindows2 = self.roi_align2(features2,rois.to(features.device))
+                stackedEdgeFeatWindows2 = self.roi_align2(features2,roisDevice)
                 if not self.splitFeatures:
                     stackedEdgeFeatWindows = torch.cat( (stackedEdgeFeatWindows,stackedEdgeFeatWindows2), dim=1)
                     stackedEdgeFeatWindows2=None
@@ -571,120 +600,68 @@ class PairingGraph(BaseModel):
             if self.expandedRelContext is not None:
                 #We're going to add a third mask for all bbs, which we'll precompute here
                 numMasks=3
-                allMasks = torch.zeros(imageHeight,imageWidth)
-                if self.use_fixed_masks:
-                    for bbIdx in range(bbs.size(0)):
-                        rr, cc = draw.polygon([tlY[bbIdx],trY[bbIdx],brY[bbIdx],blY[bbIdx]],[tlX[bbIdx],trX[bbIdx],brX[bbIdx],blX[bbIdx]], [imageHeight,imageWidth])
-                        allMasks[rr,cc]=1
+                if allMasks is None:
+                    allMasks = occupancyMask(cornersX,cornersY,imageHeight,imageWidth,self.use_fixed_masks,features.device)
             else:
                 numMasks=2
-            masks = torch.zeros(stackedEdgeFeatWindows.size(0),numMasks,self.pool2_h,self.pool2_w)
-        if self.useShapeFeats:
-            shapeFeats = torch.FloatTensor(len(candidates),self.numShapeFeats)
+            masks = torch.zeros(stackedEdgeFeatWindows.size(0),numMasks,self.pool2_h,self.pool2_w,device=relRois.device)
+
+            #... or make it so index1 is always to top-left one
+            #TODO, not random for eval
+            #flip=='both' builds the unflipped direction here, the flipped one is added below
+            swap = [bool((random.random()<0.5 and flip is None and  not self.debug) or flip is True) for c in candidates]
+            swap = torch.tensor(swap,dtype=torch.bool,device=candIndexes.device)
+            candIndexes = torch.where(swap[:,None],candIndexes.flip(1),candIndexes)
+
+            #warp to roi space
+            feature_w = relRois[:,3]-relRois[:,1] +1
+            feature_h = relRois[:,4]-relRois[:,2] +1
+            w_m = (self.pool2_w/feature_w)[:,None]
+            h_m = (self.pool2_h/feature_h)[:,None]
+            for m in range(2):
+                vertsX = torch.round((cornersX[candIndexes[:,m]]-relRois[:,1:2])*w_m)
+                vertsY = torch.round((cornersY[candIndexes[:,m]]-relRois[:,2:3])*h_m)
+                masks[:,m] = rasterizePolygons(vertsY,vertsX,self.pool2_h,self.pool2_w)
+            if self.expandedRelContext is not None:
+                masks[:,2] = self.roi_alignMask(allMasks,maskRois(roisDevice))[:,0].to(masks.device)
+                if debug_image is not None:
+                    for i in range(min(5,len(candidates))):
+                        debug_masks.append(allMasks[0,0,round(rois[i,2].item()):round(rois[i,4].item())+1,round(rois[i,1].item()):round(rois[i,3].item())+1].cpu())
         if self.detector.predNumNeighbors:
             extraPred=1
         else:
             extraPred=0
-
-        for i,(index1, index2) in enumerate(candidates):
+        if self.useShapeFeats:
+            if type(self.pairer) is BinaryPairReal and type(self.pairer.shape_layers) is not nn.Sequential:
+                #The index specification is to allign with the format feat nets are trained with
+                ixs=[0,1,2,3,3+self.numBBTypes,3+self.numBBTypes,4+self.numBBTypes,5+self.numBBTypes,6+self.numBBTypes,6+2*self.numBBTypes,6+2*self.numBBTypes,7+2*self.numBBTypes]
+            else:
+                ixs=[4,6,2,8,8+self.numBBTypes,5,7,3,8+self.numBBTypes,8+self.numBBTypes+self.numBBTypes,0,1]
+            shapeFeats = pairShapeFeats(bbs,cornersX,cornersY,candIndexes,ixs,self.numShapeFeats,self.numBBTypes,extraPred,
+                    self.normalizeVert,self.normalizeHorz,self.normalizeDist,
+                    self.useShapeFeats!='old',self.usePositionFeature,imageHeight,imageWidth)
+        if flip=='both':
+            #The flipped direction has the same visual windows, only the two box masks and the box feature slots swap.
+            #Both directions then go through the featurizer as one batch (rels 0..E-1 unflipped, E..2E-1 flipped)
             if self.useShapeFeats!='only':
-                #... or make it so index1 is always to top-left one
-                #TODO, not random for eval
-                if (random.random()<0.5 and flip is None and  not self.debug) or flip:
-                    temp=index1
-                    index1=index2
-                    index2=temp
-                
-                #warp to roi space
-                feature_w = rois[i,3]-rois[i,1] +1
-                feature_h = rois[i,4]-rois[i,2] +1
-                w_m = self.pool2_w/feature_w
-                h_m = self.pool2_h/feature_h
-
-                tlX1 = round(((tlX[index1]-rois[i,1])*w_m).item())
-                trX1 = round(((trX[index1]-rois[i,1])*w_m).item())
-                brX1 = round(((brX[index1]-rois[i,1])*w_m).item())
-                blX1 = round(((blX[index1]-rois[i,1])*w_m).item())
-                tlY1 = round(((tlY[index1]-rois[i,2])*h_m).item())
-                trY1 = round(((trY[index1]-rois[i,2])*h_m).item())
-                brY1 = round(((brY[index1]-rois[i,2])*h_m).item())
-                blY1 = round(((blY[index1]-rois[i,2])*h_m).item())
-                tlX2 = round(((tlX[index2]-rois[i,1])*w_m).item())
-                trX2 = round(((trX[index2]-rois[i,1])*w_m).item())
-                brX2 = round(((brX[index2]-rois[i,1])*w_m).item())
-                blX2 = round(((blX[index2]-rois[i,1])*w_m).item())
-                tlY2 = round(((tlY[index2]-rois[i,2])*h_m).item())
-                trY2 = round(((trY[index2]-rois[i,2])*h_m).item())
-                brY2 = round(((brY[index2]-rois[i,2])*h_m).item())
-                blY2 = round(((blY[index2]-rois[i,2])*h_m).item())
-
-                rr, cc = draw.polygon([tlY1,trY1,brY1,blY1],[tlX1,trX1,brX1,blX1], [self.pool2_h,self.pool2_w])
-                masks[i,0,rr,cc]=1
-                rr, cc = draw.polygon([tlY2,trY2,brY2,blY2],[tlX2,trX2,brX2,blX2], [self.pool2_h,self.pool2_w])
-                masks[i,1,rr,cc]=1
-                if self.expandedRelContext is not None:
-                    cropArea = allMasks[round(rois[i,2].item()):round(rois[i,4].item())+1,round(rois[i,1].item()):round(rois[i,3].item())+1]
-                    if len(cropArea.shape)==0:
-                        raise ValueError("RoI is bad: {}:{},{}:{} for size {}".format(round(rois[i,2].item()),round(rois[i,4].item())+1,round(rois[i,1].item()),round(rois[i,3].item())+1,allMasks.shape))
-                    masks[i,2] = F.upsample(cropArea[None,None,...], size=(self.pool2_h,self.pool2_w), mode='bilinear')[0,0]
-                    #masks[i,2] = cv2.resize(cropArea,(stackedEdgeFeatWindows.size(2),stackedEdgeFeatWindows.size(3)))
-                    if debug_image is not None:
-                        debug_masks.append(cropArea)
-
-            if self.useShapeFeats:
-                if type(self.pairer) is BinaryPairReal and type(self.pairer.shape_layers) is not nn.Sequential:
-                    #The index specification is to allign with the format feat nets are trained with
-                    ixs=[0,1,2,3,3+self.numBBTypes,3+self.numBBTypes,4+self.numBBTypes,5+self.numBBTypes,6+self.numBBTypes,6+2*self.numBBTypes,6+2*self.numBBTypes,7+2*self.numBBTypes]
-                else:
-                    ixs=[4,6,2,8,8+self.numBBTypes,5,7,3,8+self.numBBTypes,8+self.numBBTypes+self.numBBTypes,0,1]
-                
-                shapeFeats[i,ixs[0]] = 2*bbs[index1,3]/self.normalizeVert #bb preds half height/width
-                shapeFeats[i,ixs[1]] = 2*bbs[index1,4]/self.normalizeHorz
-                shapeFeats[i,ixs[2]] = bbs[index1,2]/math.pi
-                shapeFeats[i,ixs[3]:ixs[4]] = bbs[index1,extraPred+5:]# torch.sigmoid(bbs[index1,extraPred+5:])
-
-                shapeFeats[i,ixs[5]] = 2*bbs[index2,3]/self.normalizeVert
-                shapeFeats[i,ixs[6]] = 2*bbs[index2,4]/self.normalizeHorz
-                shapeFeats[i,ixs[7]] = bbs[index2,2]/math.pi
-                shapeFeats[i,ixs[8]:ixs[9]] = bbs[index2,extraPred+5:]#torch.sigmoid(bbs[index2,extraPred+5:])
-
-                shapeFeats[i,ixs[10]] = (bbs[index1,0]-bbs[index2,0])/self.normalizeHorz
-                shapeFeats[i,ixs[11]] = (bbs[index1,1]-bbs[index2,1])/self.normalizeVert
-                if self.useShapeFeats!='old':
-                    startCorners = 8+self.numBBTypes+self.numBBTypes
-                    shapeFeats[i,startCorners +0] = math.sqrt( (tlX[index1]-tlX[index2])**2 + (tlY[index1]-tlY[index2])**2 )/self.normalizeDist
-                    shapeFeats[i,startCorners +1] = math.sqrt( (trX[index1]-trX[index2])**2 + (trY[index1]-trY[index2])**2 )/self.normalizeDist
-                    shapeFeats[i,startCorners +3] = math.sqrt( (brX[index1]-brX[index2])**2 + (brY[index1]-brY[index2])**2 )/self.normalizeDist
-                    shapeFeats[i,startCorners +2] = math.sqrt( (blX[index1]-blX[index2])**2 + (blY[index1]-blY[index2])**2 )/self.normalizeDist
-                    startNN =startCorners+4
-                else:
-                    startNN = 8+self.numBBTypes+self.numBBTypes
-                if self.detector.predNumNeighbors:
-                    shapeFeats[i,startNN +0] = bbs[index1,5]
-                    shapeFeats[i,startNN +1] = bbs[index2,5]
-                    startPos=startNN+2
-                else:
-                    startPos=startNN
-                if self.usePositionFeature:
-                    if self.usePositionFeature=='absolute':
-                        shapeFeats[i,startPos +0] = (bbs[index1,0]-imageWidth/2)/(5*self.normalizeHorz)
-                        shapeFeats[i,startPos +1] = (bbs[index1,1]-imageHeight/2)/(10*self.normalizeVert)
-                        shapeFeats[i,startPos +2] = (bbs[index2,0]-imageWidth/2)/(5*self.normalizeHorz)
-                        shapeFeats[i,startPos +3] = (bbs[index2,1]-imageHeight/2)/(10*self.normalizeVert)
-                    else:
-                        shapeFeats[i,startPos +0] = (bbs[index1,0]-imageWidth/2)/(imageWidth/2)
-                        shapeFeats[i,startPos +1] = (bbs[index1,1]-imageHeight/2)/(imageHeight/2)
-                        shapeFeats[i,startPos +2] = (bbs[index2,0]-imageWidth/2)/(imageWidth/2)
-                        shapeFeats[i,startPos +3] = (bbs[index2,1]-imageHeight/2)/(imageHeight/2)
-
-            
-                #if self.us
+                stackedEdgeFeatWindows = torch.cat((stackedEdgeFeatWindows,stackedEdgeFeatWindows),dim=0)
+                if self.splitFeatures:
+                    stackedEdgeFeatWindows2 = torch.cat((stackedEdgeFeatWindows2,stackedEdgeFeatWindows2),dim=0)
+                masks = torch.cat((masks,torch.cat((masks[:,1:2],masks[:,0:1],masks[:,2:]),dim=1)),dim=0)
+            if self.useShapeFeats=='only':
+                #candidates are never flipped without the visual features
+                shapeFeats = torch.cat((shapeFeats,shapeFeats),dim=0)
+            elif self.useShapeFeats:
+                shapeFeatsB = pairShapeFeats(bbs,cornersX,cornersY,candIndexes.flip(1),ixs,self.numShapeFeats,self.numBBTypes,extraPred,
+                        self.normalizeVert,self.normalizeHorz,self.normalizeDist,
+                        self.useShapeFeats!='old',self.usePositionFeature,imageHeight,imageWidth)
+                shapeFeats = torch.cat((shapeFeats,shapeFeatsB),dim=0)
 
         ###DEBUG
         if debug_image is not None:
             for i in range(4):
                 cv2.imshow('crop rel {}'.format(i),debug_images[i])
-                cv2.imshow('masks rel {}'.format(i),masks[i].numpy().transpose([1,2,0]))
+                cv2.imshow('masks rel {}'.format(i),masks[i].cpu().numpy().transpose([1,2,0]))
                 cv2.imshow('mask all rel {}'.format(i),debug_masks[i].numpy())
             cv2.waitKey()
             debug_images=[]
@@ -714,65 +691,36 @@ class PairingGraph(BaseModel):
         if self.useBBVisualFeats:
             assert(features.size(0)==1)
             if self.useShapeFeats:
-                bb_shapeFeats=torch.FloatTensor(bbs.size(0),self.numShapeFeatsBB)
+                bb_shapeFeats = boxShapeFeats(bbs,self.numShapeFeatsBB,self.numBBTypes,extraPred,
+                        self.normalizeVert,self.normalizeHorz,self.usePositionFeature,imageHeight,imageWidth)
+            if cached is not None and 'bbRois' in cached:
+                bbRois = cached['bbRois'].to(cornersX.device)
+            else:
+                bbRois = boxRois(cornersX,cornersY,self.expandedBBContext,imageHeight,imageWidth)
+                if cached is not None:
+                    cached['bbRois'] = bbRois.cpu()
+                    cacheChanged = True
+            roisDevice = bbRois.to(features.device)
+            rois = bbRois.cpu()
             if self.useShapeFeats != "only" and self.expandedBBContext:
-                masks = torch.zeros(bbs.size(0),2,self.poolBB2_h,self.poolBB2_w)
-            
-            rois = torch.zeros((bbs.size(0),5))
-            for i in range(bbs.size(0)):
-                minY = round(min(tlY[i].item(),trY[i].item(),blY[i].item(),brY[i].item()))
-                maxY = round(max(tlY[i].item(),trY[i].item(),blY[i].item(),brY[i].item()))
-                minX = round(min(tlX[i].item(),trX[i].item(),blX[i].item(),brX[i].item()))
-                maxX = round(max(tlX[i].item(),trX[i].item(),blX[i].item(),brX[i].item()))
-                if self.expandedBBContext is not None:
-                    maxX = min(maxX+self.expandedBBContext,imageWidth-1)
-                    minX = max(minX-self.expandedBBContext,0)
-                    maxY = min(maxY+self.expandedBBContext,imageHeight-1)
-                    minY = max(minY-self.expandedBBContext,0)
-                rois[i,1]=minX
-                rois[i,2]=minY
-                rois[i,3]=maxX
-                rois[i,4]=maxY
-                if self.useShapeFeats:
-                    bb_shapeFeats[i,0]= (bbs[i,2]+math.pi)/(2*math.pi)
-                    bb_shapeFeats[i,1]=bbs[i,3]/self.normalizeVert
-                    bb_shapeFeats[i,2]=bbs[i,4]/self.normalizeHorz
-                    if self.detector.predNumNeighbors:
-                        bb_shapeFeats[i,3]=bbs[i,5]
-                    bb_shapeFeats[i,3+extraPred:self.numBBTypes+3+extraPred]=torch.sigmoid(bbs[i,5+extraPred:self.numBBTypes+5+extraPred])
-                    if self.usePositionFeature:
-                        if self.usePositionFeature=='absolute':
-                            bb_shapeFeats[i,self.numBBTypes+3+extraPred] = (bbs[i,0]-imageWidth/2)/(5*self.normalizeHorz)
-                            bb_shapeFeats[i,self.numBBTypes+4+extraPred] = (bbs[i,1]-imageHeight/2)/(10*self.normalizeVert)
-                        else:
-                            bb_shapeFeats[i,self.numBBTypes+3+extraPred] = (bbs[i,0]-imageWidth/2)/(imageWidth/2)
-                            bb_shapeFeats[i,self.numBBTypes+4+extraPred] = (bbs[i,1]-imageHeight/2)/(imageHeight/2)
-                if self.useShapeFeats != "only" and self.expandedBBContext:
-                    #Add detected BB masks
-                    #warp to roi space
-                    feature_w = rois[i,3]-rois[i,1] +1
-                    feature_h = rois[i,4]-rois[i,2] +1
-                    w_m = self.poolBB2_w/feature_w
-                    h_m = self.poolBB2_h/feature_h
-
-                    tlX1 = round(((tlX[i]-rois[i,1])*w_m).item())
-                    trX1 = round(((trX[i]-rois[i,1])*w_m).item())
-                    brX1 = round(((brX[i]-rois[i,1])*w_m).item())
-                    blX1 = round(((blX[i]-rois[i,1])*w_m).item())
-                    tlY1 = round(((tlY[i]-rois[i,2])*h_m).item())
-                    trY1 = round(((trY[i]-rois[i,2])*h_m).item())
-                    brY1 = round(((brY[i]-rois[i,2])*h_m).item())
-                    blY1 = round(((blY[i]-rois[i,2])*h_m).item())
-
-                    rr, cc = draw.polygon([tlY1,trY1,brY1,blY1],[tlX1,trX1,brX1,blX1], (self.poolBB2_h,self.poolBB2_w))
-                    masks[i,0,rr,cc]=1
-                    if self.expandedBBContext is not None:
-                        cropArea = allMasks[round(rois[i,2].item()):round(rois[i,4].item())+1,round(rois[i,1].item()):round(rois[i,3].item())+1]
-                        masks[i,1] = F.upsample(cropArea[None,None,...], size=(self.poolBB2_h,self.poolBB2_w), mode='bilinear')[0,0]
-                        #masks[i,2] = cv2.resize(cropArea,(stackedEdgeFeatWindows.size(2),stackedEdgeFeatWindows.size(3)))
-                ###DEBUG
-                if debug_image is not None and i<5:
+                masks = torch.zeros(bbs.size(0),2,self.poolBB2_h,self.poolBB2_w,device=bbRois.device)
+                #Add detected BB masks
+                #warp to roi space
+                feature_w = bbRois[:,3]-bbRois[:,1] +1
+                feature_h = bbRois[:,4]-bbRois[:,2] +1
+                w_m = (self.poolBB2_w/feature_w)[:,None]
+                h_m = (self.poolBB2_h/feature_h)[:,None]
+                vertsX = torch.round((cornersX-bbRois[:,1:2])*w_m)
+                vertsY = torch.round((cornersY-bbRois[:,2:3])*h_m)
+                masks[:,0] = rasterizePolygons(vertsY,vertsX,self.poolBB2_h,self.poolBB2_w)
+                if allMasks is None:
+                    allMasks = occupancyMask(cornersX,cornersY,imageHeight,imageWidth,self.use_fixed_masks,features.device)
+                masks[:,1] = self.roi_alignBBMask(allMasks,maskRois(roisDevice))[:,0].to(masks.device)
+            ###DEBUG
+            if debug_image is not None:
+                for i in range(min(5,bbs.size(0))):
                     assert(self.rotation==False)
+                    minX,minY,maxX,maxY = rois[i,1:]
                     crop = debug_image[0,:,int(minY):int(maxY),int(minX):int(maxX)+1].cpu()
                     crop = (2-crop)/2
                     if crop.size(0)==1:
@@ -780,15 +728,14 @@ class PairingGraph(BaseModel):
                     crop[0,int(tlY[i].item()-minY):int(brY[i].item()-minY)+1,int(tlX[i].item()-minX):int(brX[i].item()-minX)+1]*=0.5
                     crop = crop.numpy().transpose([1,2,0])
                     cv2.imshow('crop bb {}'.format(i),crop)
-                    cv2.imshow('masks bb {}'.format(i),torch.cat((masks[i],torch.zeros(1,self.poolBB2_h,self.poolBB2_w)),dim=0).numpy().transpose([1,2,0]))
+                    cv2.imshow('masks bb {}'.format(i),torch.cat((masks[i].cpu(),torch.zeros(1,self.poolBB2_h,self.poolBB2_w)),dim=0).numpy().transpose([1,2,0]))
                     #debug_images.append(crop)
-            if debug_image is not None:
                 cv2.waitKey()
             if self.useShapeFeats != "only":
                 #bb_features[i]= F.avg_pool2d(features[0,:,minY:maxY+1,minX:maxX+1], (1+maxY-minY,1+maxX-minX)).view(-1)
-                bb_features = self.roi_alignBB(features,rois.to(features.device))
+                bb_features = self.roi_alignBB(features,roisDevice)
                 if features2 is not None:
-                    bb_features2 = self.roi_alignBB2(features2,rois.to(features.device))
+                    bb_features2 = self.roi_alignBB2(features2,roisDevice)
                     if not self.splitFeatures:
                         bb_features = torch.cat( (bb_features,bb_features2), dim=1)
                 if self.expandedBBContext:
@@ -830,47 +777,25 @@ class PairingGraph(BaseModel):
             numOfNeighbors = None
         else:
             bbAndRel_features = torch.cat((bb_features,relFeats),dim=0)
-            numOfNeighbors = torch.ones(bbs.size(0)+len(candidates)) #starts at one for yourself
-            edges=[]
-            i=0
-            for bb1,bb2 in candidates:
-                edges.append( (bb1,numBB+i) )
-                edges.append( (bb2,numBB+i) )
-                numOfNeighbors[bb1]+=1
-                numOfNeighbors[bb2]+=1
-                numOfNeighbors[numBB+i]+=2
-                i+=1
-            if self.includeRelRelEdges:
-                relEdges=set()
-                i=0
-                for bb1,bb2 in candidates:
-                    j=0
-                    for bbA,bbB in candidates[i:]:
-                        if i!=j and bb1==bbA or bb1==bbB or bb2==bbA or bb2==bbB:
-                            relEdges.add( (numBB+i,numBB+j) ) #i<j always
-                        j+=1   
-                    i+=1
-                relEdges = list(relEdges)
-                for r1, r2 in relEdges:
-                    numOfNeighbors[r1]+=1
-                    numOfNeighbors[r2]+=1
-                edges += relEdges
-            #add reverse edges
-            edges+=[(y,x) for x,y in edges]
-            #add diagonal (self edges)
-            for i in range(bbAndRel_features.size(0)):
-                edges.append((i,i))
-
-            edgeLocs = torch.LongTensor(edges).t().to(relFeats.device)
-            ones = torch.ones(len(edges)).to(relFeats.device)
-            adjacencyMatrix = torch.sparse.FloatTensor(edgeLocs,ones,torch.Size([bbAndRel_features.size(0),bbAndRel_features.size(0)]))
             #numOfNeighbors is for convienence in tracking the normalization term
-            numOfNeighbors=numOfNeighbors.to(relFeats.device)
+            if cached is not None and 'edgeLocs' in cached:
+                edgeLocs = cached['edgeLocs'].to(relFeats.device)
+                numOfNeighbors = cached['numOfNeighbors'].to(relFeats.device)
+            else:
+                edgeLocs, numOfNeighbors = graphEdges(torch.LongTensor(candidates).to(relFeats.device),numBB,self.includeRelRelEdges)
+                if cached is not None:
+                    cached['edgeLocs'] = edgeLocs.cpu()
+                    cached['numOfNeighbors'] = numOfNeighbors.cpu()
+                    cacheChanged = True
+            ones = torch.ones(edgeLocs.size(1),device=relFeats.device)
+            adjacencyMatrix = torch.sparse.FloatTensor(edgeLocs,ones,torch.Size([numBB+numRel,numBB+numRel]))
 
             #rel_features = (candidates,relFeats)
             #adjacencyMatrix = None
             ##print('create graph: {}'.format(timeit.default_timer()-tic))
             #return bb_features, adjacencyMatrix, rel_features
+        if cacheChanged:
+            self.graphCache.put(cacheKey,cached)
         return bbAndRel_features, (adjacencyMatrix,numOfNeighbors), numBB, numRel, relIndexes
 
 
@@ -972,40 +897,43 @@ class PairingGraph(BaseModel):
         r = bbs[:,2]
 
         distMul=1.0
+        sight=None
         while distMul>0.03:
 
-            boxesDrawn = np.zeros( (math.ceil(maxY-minY),math.ceil(maxX-minX)) ,dtype=int)#torch.IntTensor( (maxY-minY,maxX-minX) ).zero_()
-            if boxesDrawn.shape[0]==0 or boxesDrawn.shape[1]==0:
-                return []
-            #import pdb;pdb.set_trace()
-            numBoxes = bbs.size(0)
-            for i in range(numBoxes):
+            #the vectorized engine doesn't write to the canvas and walks its rays only once per page
+            if sight is None or self.candidateEngine!='vectorized':
+                boxesDrawn = np.zeros( (math.ceil(maxY-minY),math.ceil(maxX-minX)) ,dtype=int)#torch.IntTensor( (maxY-minY,maxX-minX) ).zero_()
+                if boxesDrawn.shape[0]==0 or boxesDrawn.shape[1]==0:
+                    return []
+                #import pdb;pdb.set_trace()
+                numBoxes = bbs.size(0)
+                for i in range(numBoxes):
                 
-                #cv2.line( boxesDrawn, (int(tlX[i]),int(tlY[i])),(int(trX[i]),int(trY[i])),i,1)
-                #cv2.line( boxesDrawn, (int(trX[i]),int(trY[i])),(int(brX[i]),int(brY[i])),i,1)
-                #cv2.line( boxesDrawn, (int(blX[i]),int(blY[i])),(int(brX[i]),int(brY[i])),i,1)
-                #cv2.line( boxesDrawn, (int(blX[i]),int(blY[i])),(int(tlX[i]),int(tlY[i])),i,1)
-
-                #These are to catch the wierd case of a (clipped) bb having 0 height or width
-                #we just add a bit, this shouldn't greatly effect the heuristic pairing
-                if int(tlY[i])==int(trY[i]) and int(tlY[i])==int(brY[i]) and int(tlY[i])==int(blY[i]):
-                    if int(tlY[i])<2:
-                        blY[i]+=1.1
-                        brY[i]+=1.1
-                    else:
-                        tlY[i]-=1.1
-                        trY[i]-=1.1
-                if int(tlX[i])==int(trX[i]) and int(tlX[i])==int(brX[i]) and int(tlX[i])==int(blX[i]):
-                    if int(tlX[i])<2:
-                        trX[i]+=1.1
-                        brX[i]+=1.1
-                    else:
-                        tlX[i]-=1.1
-                        blX[i]-=1.1
+                    #cv2.line( boxesDrawn, (int(tlX[i]),int(tlY[i])),(int(trX[i]),int(trY[i])),i,1)
+                    #cv2.line( boxesDrawn, (int(trX[i]),int(trY[i])),(int(brX[i]),int(brY[i])),i,1)
+                    #cv2.line( boxesDrawn, (int(blX[i]),int(blY[i])),(int(brX[i]),int(brY[i])),i,1)
+                    #cv2.line( boxesDrawn, (int(blX[i]),int(blY[i])),(int(tlX[i]),int(tlY[i])),i,1)
 
+                    #These are to catch the wierd case of a (clipped) bb having 0 height or width
+                    #we just add a bit, this shouldn't greatly effect the heuristic pairing
+                    if int(tlY[i])==int(trY[i]) and int(tlY[i])==int(brY[i]) and int(tlY[i])==int(blY[i]):
+                        if int(tlY[i])<2:
+                            blY[i]+=1.1
+                            brY[i]+=1.1
+                        else:
+                            tlY[i]-=1.1
+                            trY[i]-=1.1
+                    if int(tlX[i])==int(trX[i]) and int(tlX[i])==int(brX[i]) and int(tlX[i])==int(blX[i]):
+                        if int(tlX[i])<2:
+                            trX[i]+=1.1
+                            brX[i]+=1.1
+                        else:
+                            tlX[i]-=1.1
+                            blX[i]-=1.1
 
-                rr,cc = draw.polygon_perimeter([int(tlY[i]),int(trY[i]),int(brY[i]),int(blY[i])],[int(tlX[i]),int(trX[i]),int(brX[i]),int(blX[i])],boxesDrawn.shape,True)
-                boxesDrawn[rr,cc]=i+1
+
+                    rr,cc = draw.polygon_perimeter([int(tlY[i]),int(trY[i]),int(brY[i]),int(blY[i])],[int(tlX[i]),int(trX[i]),int(brX[i]),int(blX[i])],boxesDrawn.shape,True)
+                    boxesDrawn[rr,cc]=i+1
 
             #how to walk?
             #walk until number found.
@@ -1115,45 +1043,55 @@ class PairingGraph(BaseModel):
                 cv2.waitKey()
 
 
-            candidates=set()
-            for i in range(numBoxes):
-                boxId=i+1
-                toSplit=[]
-                hit = set()
+            if self.candidateEngine=='vectorized':
+                if sight is None:
+                    #distMul only shrinks, so later passes just filter what this one found
+                    corners = [c.cpu().double().numpy() for c in (tlX,tlY,trX,trY,brX,brY,blX,blY)]
+                    sight = LineOfSight(PerimeterIndex(boxesDrawn,*corners),
+                            *corners,
+                            r.cpu().double().numpy(),w.cpu().numpy(),h.cpu().numpy(),
+                            maxDist,maxDistY,minWidth,minHeight,numFan)
+                candidates = sight.candidates(maxDist,maxDistY)
+            else:
+                candidates=set()
+                for i in range(numBoxes):
+                    boxId=i+1
+                    toSplit=[]
+                    hit = set()
 
-                horzDiv = 1+math.ceil(w[i]/minWidth)
-                vertDiv = 1+math.ceil(h[i]/minHeight)
+                    horzDiv = 1+math.ceil(w[i]/minWidth)
+                    vertDiv = 1+math.ceil(h[i]/minHeight)
 
-                if horzDiv==1:
-                    leftW=0.5
-                    rightW=0.5
-                    hit.update( pathWalk(boxId, tlX[i].item()*leftW+trX[i].item()*rightW, tlY[i].item()*leftW+trY[i].item()*rightW,r[i].item()+90) )
-                    hit.update( pathWalk(boxId, tlX[i].item()*leftW+trX[i].item()*rightW, tlY[i].item()*leftW+trY[i].item()*rightW,r[i].item()-90) )
-                else:
-                    for j in range(horzDiv):
-                        leftW = 1-j/(horzDiv-1)
-                        rightW = j/(horzDiv-1)
+                    if horzDiv==1:
+                        leftW=0.5
+                        rightW=0.5
                         hit.update( pathWalk(boxId, tlX[i].item()*leftW+trX[i].item()*rightW, tlY[i].item()*leftW+trY[i].item()*rightW,r[i].item()+90) )
                         hit.update( pathWalk(boxId, tlX[i].item()*leftW+trX[i].item()*rightW, tlY[i].item()*leftW+trY[i].item()*rightW,r[i].item()-90) )
-
-                if vertDiv==1:
-                    topW=0.5
-                    botW=0.5
-                    hit.update( pathWalk(boxId, tlX[i].item()*topW+blX[i].item()*botW, tlY[i].item()*topW+blY[i].item()*botW,r[i].item()+180) )
-                    hit.update( pathWalk(boxId, trX[i].item()*topW+brX[i].item()*botW, trY[i].item()*topW+brY[i].item()*botW,r[i].item()) )
-                else:
-                    for j in range(vertDiv):
-                        topW = 1-j/(vertDiv-1)
-                        botW = j/(vertDiv-1)
+                    else:
+                        for j in range(horzDiv):
+                            leftW = 1-j/(horzDiv-1)
+                            rightW = j/(horzDiv-1)
+                            hit.update( pathWalk(boxId, tlX[i].item()*leftW+trX[i].item()*rightW, tlY[i].item()*leftW+trY[i].item()*rightW,r[i].item()+90) )
+                            hit.update( pathWalk(boxId, tlX[i].item()*leftW+trX[i].item()*rightW, tlY[i].item()*leftW+trY[i].item()*rightW,r[i].item()-90) )
+
+                    if vertDiv==1:
+                        topW=0.5
+                        botW=0.5
                         hit.update( pathWalk(boxId, tlX[i].item()*topW+blX[i].item()*botW, tlY[i].item()*topW+blY[i].item()*botW,r[i].item()+180) )
                         hit.update( pathWalk(boxId, trX[i].item()*topW+brX[i].item()*botW, trY[i].item()*topW+brY[i].item()*botW,r[i].item()) )
-                fan(boxId,tlX[i].item(),tlY[i].item(),r[i].item()+135,numFan,hit)
-                fan(boxId,trX[i].item(),trY[i].item(),r[i].item()+45,numFan,hit)
-                fan(boxId,blX[i].item(),blY[i].item(),r[i].item()+225,numFan,hit)
-                fan(boxId,brX[i].item(),brY[i].item(),r[i].item()+315,numFan,hit)
-
-                for jId in hit:
-                    candidates.add( (min(i,jId-1),max(i,jId-1)) )
+                    else:
+                        for j in range(vertDiv):
+                            topW = 1-j/(vertDiv-1)
+                            botW = j/(vertDiv-1)
+                            hit.update( pathWalk(boxId, tlX[i].item()*topW+blX[i].item()*botW, tlY[i].item()*topW+blY[i].item()*botW,r[i].item()+180) )
+                            hit.update( pathWalk(boxId, trX[i].item()*topW+brX[i].item()*botW, trY[i].item()*topW+brY[i].item()*botW,r[i].item()) )
+                    fan(boxId,tlX[i].item(),tlY[i].item(),r[i].item()+135,numFan,hit)
+                    fan(boxId,trX[i].item(),trY[i].item(),r[i].item()+45,numFan,hit)
+                    fan(boxId,blX[i].item(),blY[i].item(),r[i].item()+225,numFan,hit)
+                    fan(boxId,brX[i].item(),brY[i].item(),r[i].item()+315,numFan,hit)
+
+                    for jId in hit:
+                        candidates.add( (min(i,jId-1),max(i,jId-1)) )
             
             #print('candidates:{} ({})'.format(len(candidates),distMul))
             #if len(candidates)>1:
@@ -1186,6 +1124,8 @@ class PairingGraph(BaseModel):
         brY = -w*sin_r + h*cos_r +y
         blX = -w*cos_r + h*sin_r +x
         blY =  w*sin_r + h*cos_r +y
+        cornersX = torch.stack((tlX,trX,brX,blX),dim=1)
+        cornersY = torch.stack((tlY,trY,brY,blY),dim=1)
 
         tlX = tlX.cpu()
         tlY = tlY.cpu()
@@ -6,7 +6,11 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.nn.modules.utils import _pair
 
-from model import _C
+try:
+    from model import _C
+except ImportError:
+    #not built (python setup.py build develop), only ROIAlign needs it
+    _C = None
 
 
 class _ROIAlign(Function):
@@ -17,6 +21,8 @@ class _ROIAlign(Function):
         ctx.spatial_scale = spatial_scale
         ctx.sampling_ratio = sampling_ratio
         ctx.input_shape = input.size()
+        if _C is None:
+            raise ImportError('model._C is not built (python setup.py build develop)')
         output = _C.roi_align_forward(
             input, roi, spatial_scale, output_size[0], output_size[1], sampling_ratio
         )
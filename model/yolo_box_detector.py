@@ -19,8 +19,26 @@ from base import BaseModel
 import math
 import json
 import numpy as np
+from collections import OrderedDict
 from .net_builder import make_layers
 
+default_down_layers_cfg=[64, 'M', 128, 'M', 256, 256, 'M', 512, 512, 'M', 512, 512] #after the input channels
+
+def downScale(layers_cfg):
+    #the (x,y) scale of make_layers(layers_cfg)'s output relative to its input
+    scaleX=1
+    scaleY=1
+    for a in layers_cfg:
+        if a=='M' or (type(a) is str and a[0]=='D'):
+            scaleX*=2
+            scaleY*=2
+        elif type(a) is str and a[0]=='U':
+            scaleX/=2
+            scaleY/=2
+        elif type(a) is str and a[0:4]=='long': #long pool
+            scaleX*=3
+            scaleY*=2
+    return (scaleX,scaleY)
 
 
 
@@ -53,6 +71,9 @@ class YoloBoxDetector(nn.Module): #BaseModel
         else:
             self.meanH=62.1242376857/2
         self.numAnchors = len(self.anchors)
+        #prior grids (and anchor tensors) for decoding, kept for the most recently seen feature sizes
+        self.decodeGrids=OrderedDict()
+        self.maxDecodeGrids = config['decode_grid_cache_size'] if 'decode_grid_cache_size' in config else 16
         if self.predLineCount>0:
             print('Warning, using hardcoded mean H (yolo_box_detector)')
 
@@ -70,26 +91,14 @@ class YoloBoxDetector(nn.Module): #BaseModel
         if 'down_layers_cfg' in config:
             layers_cfg = config['down_layers_cfg']
         else:
-            layers_cfg=[in_ch,64, 'M', 128, 'M', 256, 256, 'M', 512, 512, 'M', 512, 512]
+            layers_cfg=[in_ch]+default_down_layers_cfg
 
         self.net_down_modules, down_last_channels = make_layers(layers_cfg, dilation,norm,dropout=dropout)
         self.final_features=None 
         self.last_channels=down_last_channels
         self.net_down_modules.append(nn.Conv2d(down_last_channels, self.numOutBB+self.numOutLine+self.numOutPoint, kernel_size=1))
         self._hack_down = nn.Sequential(*self.net_down_modules)
-        scaleX=1
-        scaleY=1
-        for a in layers_cfg:
-            if a=='M' or (type(a) is str and a[0]=='D'):
-                scaleX*=2
-                scaleY*=2
-            elif type(a) is str and a[0]=='U':
-                scaleX/=2
-                scaleY/=2
-            elif type(a) is str and a[0:4]=='long': #long pool
-                scaleX*=3
-                scaleY*=2
-        self.scale=(scaleX,scaleY)
+        self.scale=downScale(layers_cfg)
 
         if self.predPixelCount>0:
             if 'up_layers_cfg' in config:
@@ -116,54 +125,14 @@ class YoloBoxDetector(nn.Module): #BaseModel
         #y=levels[-1]
 
 
-        #priors_0 = Variable(torch.arange(0,y.size(2)).type_as(img.data), requires_grad=False)[None,:,None]
-        priors_0 = torch.arange(0,y.size(2)).type_as(img.data)[None,:,None]
-        priors_0 = (priors_0 + 0.5) * self.scale[1] #self.base_0
-        priors_0 = priors_0.expand(y.size(0), priors_0.size(1), y.size(3))
-        priors_0 = priors_0[:,None,:,:].to(img.device)
-
-        #priors_1 = Variable(torch.arange(0,y.size(3)).type_as(img.data), requires_grad=False)[None,None,:]
-        priors_1 = torch.arange(0,y.size(3)).type_as(img.data)[None,None,:]
-        priors_1 = (priors_1 + 0.5) * self.scale[0] #elf.base_1
-        priors_1 = priors_1.expand(y.size(0), y.size(2), priors_1.size(2))
-        priors_1 = priors_1[:,None,:,:].to(img.device)
-
-        anchor = self.anchors
-        pred_boxes=[]
-        pred_offsets=[] #we seperate anchor predictions here. And compute actual bounding boxes
-        for i in range(self.numAnchors):
+        grid = self.decodeGrid(y.size(2),y.size(3),y.device,y.dtype)
+        priors_0 = grid['priors_0'] #y-centers of the cells [1,1,rows,cols]
+        priors_1 = grid['priors_1'] #x-centers of the cells
 
-            offset = i*(self.numBBParams+self.numBBTypes)
-            if self.rotation:
-                rot_dif = (math.pi/2)*torch.tanh(y[:,3+offset:4+offset,:,:])
-            else:
-                rot_dif = torch.zeros_like(y[:,3+offset:4+offset,:,:])
-
-            stackedPred = [
-                torch.sigmoid(y[:,0+offset:1+offset,:,:]),                #0. confidence
-                torch.tanh(y[:,1+offset:2+offset,:,:])*self.scale[0] + priors_1,        #1. x-center
-                torch.tanh(y[:,2+offset:3+offset,:,:])*self.scale[1] + priors_0,        #2. y-center
-                rot_dif + anchor[i]['rot'],      #3. rotation (radians)
-                torch.exp(y[:,4+offset:5+offset,:,:]) * anchor[i]['height'], #4. height (half), I don't think this needs scaled
-                torch.exp(y[:,5+offset:6+offset,:,:]) * anchor[i]['width'],  #5. width (half)   as we scale the anchors in training
-            ]
-
-
-            if self.predNumNeighbors:
-                stackedPred.append(1+y[:,6+offset:7+offset,:,:]) #+1 so predicted -1 is 0 neighbors
-                extra=1
-            else:
-                extra=0
-            for j in range(self.numBBTypes):
-                stackedPred.append(torch.sigmoid(y[:,6+j+extra+offset:7+j+extra+offset,:,:]))         #x. class prediction
-                #stackedOffsets.append(y[:,6+j+offset:7+j+offset,:,:])         #x. class prediction
-            pred_boxes.append(torch.cat(stackedPred, dim=1))
-            #pred_offsets.append(torch.cat(stackedOffsets, dim=1))
-            pred_offsets.append(y[:,offset:offset+self.numBBParams+self.numBBTypes,:,:])
-
-        if len(pred_boxes)>0:
-            bbPredictions = torch.stack(pred_boxes, dim=1)
-            offsetPredictions = torch.stack(pred_offsets, dim=1)
+        if self.numAnchors>0:
+            bbPredictions = self.decodeBoxes(y,grid)
+            offsetPredictions = y[:,:self.numAnchors*(self.numBBParams+self.numBBTypes)]
+            offsetPredictions = offsetPredictions.view(y.size(0),self.numAnchors,self.numBBParams+self.numBBTypes,y.size(2),y.size(3))
             
             bbPredictions = bbPredictions.transpose(2,4).contiguous()#from [batch, anchors, channel, rows, cols] to [batch, anchros, cols, rows, channels]
             bbPredictions = bbPredictions.view(bbPredictions.size(0),bbPredictions.size(1),-1,bbPredictions.size(4))#flatten to [batch, anchors, instances, channel]
@@ -227,6 +196,58 @@ class YoloBoxDetector(nn.Module): #BaseModel
 
         return bbPredictions, offsetPredictions, linePreds, offsetLinePreds, pointPreds, pixelPreds #, avg_conf_per_anchor
 
+    def decodeGrid(self,rows,cols,device,dtype):
+        """
+        Cell center priors and anchor tensors for a feature map of rows x cols, cached per (rows,cols,device,dtype)
+        so repeated page sizes (inference, validation) don't rebuild them.
+        """
+        key=(rows,cols,str(device),dtype)
+        if key in self.decodeGrids:
+            self.decodeGrids.move_to_end(key)
+            return self.decodeGrids[key]
+        grid={
+                'priors_0': ((torch.arange(0,rows,dtype=dtype,device=device) + 0.5) * self.scale[1])[None,None,:,None].expand(1,1,rows,cols), #self.base_0
+                'priors_1': ((torch.arange(0,cols,dtype=dtype,device=device) + 0.5) * self.scale[0])[None,None,None,:].expand(1,1,rows,cols), #self.base_1
+                #[1,anchors,1,1,1], to broadcast against [batch,anchors,1,rows,cols]
+                'rot': torch.tensor([a['rot'] for a in self.anchors],dtype=dtype,device=device).view(1,-1,1,1,1),
+                'height': torch.tensor([a['height'] for a in self.anchors],dtype=dtype,device=device).view(1,-1,1,1,1),
+                'width': torch.tensor([a['width'] for a in self.anchors],dtype=dtype,device=device).view(1,-1,1,1,1),
+                }
+        self.decodeGrids[key]=grid
+        if len(self.decodeGrids)>self.maxDecodeGrids:
+            self.decodeGrids.popitem(last=False)
+        return grid
+
+    def decodeBoxes(self,y,grid):
+        """
+        Decodes the anchor channels of the network output y into boxes for all anchors at once.
+        Returns [batch, anchors, channel, rows, cols]
+        """
+        y = y[:,:self.numAnchors*(self.numBBParams+self.numBBTypes)]
+        y = y.view(y.size(0),self.numAnchors,self.numBBParams+self.numBBTypes,y.size(2),y.size(3))
+        priors_0 = grid['priors_0'][:,:,None]
+        priors_1 = grid['priors_1'][:,:,None]
+        if self.rotation:
+            rot_dif = (math.pi/2)*torch.tanh(y[:,:,3:4])
+        else:
+            rot_dif = torch.zeros_like(y[:,:,3:4])
+
+        stackedPred = [
+            torch.sigmoid(y[:,:,0:1]),                #0. confidence
+            torch.tanh(y[:,:,1:2])*self.scale[0] + priors_1,        #1. x-center
+            torch.tanh(y[:,:,2:3])*self.scale[1] + priors_0,        #2. y-center
+            rot_dif + grid['rot'],      #3. rotation (radians)
+            torch.exp(y[:,:,4:5]) * grid['height'], #4. height (half), I don't think this needs scaled
+            torch.exp(y[:,:,5:6]) * grid['width'],  #5. width (half)   as we scale the anchors in training
+        ]
+        if self.predNumNeighbors:
+            stackedPred.append(1+y[:,:,6:7]) #+1 so predicted -1 is 0 neighbors
+            extra=1
+        else:
+            extra=0
+        stackedPred.append(torch.sigmoid(y[:,:,6+extra:6+extra+self.numBBTypes])) #class predictions
+        return torch.cat(stackedPred, dim=2)
+
     def summary(self):
         """
         Model summary
@@ -18,7 +18,7 @@ import torch.nn.functional as F
 import torch
 import numpy as np
 import math
-from utils.yolo_tools import allIOU, allDist
+from utils.yolo_tools import bestIOU, allDist_, pairwiseBest, closestAnchors
 
 class YoloLoss (nn.Module):
     def __init__(self, num_classes, rotation, scale, anchors, ignore_thresh=0.5,use_special_loss=False,bad_conf_weight=1.25, multiclass=False):
@@ -32,12 +32,14 @@ class YoloLoss (nn.Module):
         self.multiclass=multiclass
         self.anchors=anchors
         self.num_anchors=len(anchors)
+        self.warned_assignment=False
         self.mse_loss = nn.MSELoss(reduction='elementwise_mean')  # Coordinate loss
         self.bce_loss = nn.BCEWithLogitsLoss(reduction='elementwise_mean')  # Confidence loss
         self.ce_loss = nn.CrossEntropyLoss(reduction='elementwise_mean')  # Class loss
         self.mse_loss = nn.MSELoss(reduction='elementwise_mean')  # Num neighbor regression
 
-    def forward(self,prediction, target, target_sizes, target_num_neighbors=None ):
+    def forward(self,prediction, target, target_sizes, target_num_neighbors=None, anchor_assignment=None ):
+        #anchor_assignment is optionally the targets' anchors, computed by utils.yolo_tools.anchorAssignment in the DataLoader
 
         nA = self.num_anchors
         nB = prediction.size(0)
@@ -78,14 +80,21 @@ class YoloLoss (nn.Module):
         #if target is not None:
         #    target[:,:,[0,4]] /= self.scale[0]
         #    target[:,:,[1,3]] /= self.scale[1]
+        #the DataLoader can be given its own anchors_file, so the anchor sizes are compared, not just their number
+        settings = [list(self.scale),self.ignore_thresh,scaled_anchors.tolist()]
+        if anchor_assignment is not None and anchor_assignment['settings']!=settings:
+            if not self.warned_assignment:
+                print('Warning, anchor assignment from the DataLoader is for {}, but YoloLoss has {}. Ignoring it.'.format(anchor_assignment['settings'],settings))
+                self.warned_assignment=True
+            anchor_assignment=None
 
         nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious = build_targets(
-            pred_boxes=pred_boxes.cpu().data,
-            pred_conf=pred_conf.cpu().data,
-            pred_cls=pred_cls.cpu().data,
-            target=target.cpu().data if target is not None else None,
+            pred_boxes=pred_boxes.data,
+            pred_conf=pred_conf.data,
+            pred_cls=pred_cls.data,
+            target=target.data if target is not None else None,
             target_sizes=target_sizes,
-            anchors=scaled_anchors.cpu().data,
+            anchors=scaled_anchors.data,
             num_anchors=nA,
             num_classes=self.num_classes,
             grid_sizeH=nH,
@@ -93,7 +102,8 @@ class YoloLoss (nn.Module):
             ignore_thres=self.ignore_thresh,
             scale=self.scale,
             calcIOUAndDist=self.use_special_loss,
-            target_num_neighbors=target_num_neighbors
+            target_num_neighbors=target_num_neighbors,
+            anchor_assignment=anchor_assignment
         )
 
         nProposals = int((pred_conf > 0).sum().item())
@@ -244,98 +254,139 @@ def get_closest_anchor_iou(anchors,gh,gw):
 
     return best_n, anch_ious
 
+def inv_tanh_all(y):
+    #inv_tanh of every element. The log is taken in double, as math.log
+    y_log = (0.5*((1+y)/(1-y)).double().log()).type(y.dtype)
+    return torch.where(y<=-1, torch.full_like(y,-2), torch.where(y>=1, torch.full_like(y,2), y_log))
+
+def last_of_each(keys):
+    #index of the last occurence of each distinct key (later assignments overwrite earlier ones)
+    order = torch.arange(keys.size(0),device=keys.device)
+    _, perm = torch.sort(keys*keys.size(0)+order)
+    sortedKeys = keys[perm]
+    last = torch.ones_like(sortedKeys,dtype=torch.bool)
+    last[:-1] = sortedKeys[1:]!=sortedKeys[:-1]
+    return perm[last]
+
+def batch_targets(target_sizes, keep):
+    #(image,target) indexes of the targets within target_sizes where keep ([nB,nT]) is true, in order of image then target
+    sizes = torch.tensor([int(s) for s in target_sizes],device=keep.device)
+    valid = (torch.arange(keep.size(1),device=keep.device)[None,:]<sizes[:,None]) & keep
+    return valid.nonzero().t()
+
+def assign_targets(conf_mask, cells, best, ignore, targets):
+    """
+    Shared core of the batched build_targets*.
+    cells[i,a] is the flat index of target i's grid cell for anchor a ([N,1] without anchors), best[i] the
+    anchor target i is assigned to and ignore[i,a] whether anchor a is close enough to it to not be penalized.
+    conf_mask is zeroed where ignored and set to 1 where assigned. targets is a list of (tensor,values),
+    values[i] (or values, if it's a number) is written in tensor at target i's assigned cell.
+    Where targets share a cell the last one's values are kept, as when assigning them one at a time in order.
+    """
+    isBest = torch.arange(cells.size(1),device=cells.device)[None,:]==best[:,None]
+    event = isBest | ignore
+    eventCells = cells[event]
+    last = last_of_each(eventCells)
+    conf_mask.view(-1)[eventCells[last]] = isBest[event][last].type(conf_mask.dtype)
+
+    bestCells = cells[torch.arange(cells.size(0),device=cells.device),best]
+    last = last_of_each(bestCells)
+    lastCells = bestCells[last]
+    for tensor,values in targets:
+        if torch.is_tensor(values):
+            tensor.view(-1,*values.size()[1:])[lastCells] = values[last].type(tensor.dtype)
+        else:
+            tensor.view(-1)[lastCells] = values
+
 def build_targets(
-    pred_boxes, pred_conf, pred_cls, target, target_sizes, anchors, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale, calcIOUAndDist=False, target_num_neighbors=None
+    pred_boxes, pred_conf, pred_cls, target, target_sizes, anchors, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale, calcIOUAndDist=False, target_num_neighbors=None, anchor_assignment=None
 ):
+    #All targets of the batch are assigned at once, on the device of pred_boxes.
+    #Where targets share a cell, the later one's values are kept (as when assigning them in order)
     nB = pred_boxes.size(0)
     nA = num_anchors
     nC = num_classes
     nH = grid_sizeH
     nW = grid_sizeW
-    mask = torch.zeros(nB, nA, nH, nW)
-    conf_mask = torch.ones(nB, nA, nH, nW)
-    tx = torch.zeros(nB, nA, nH, nW)
-    ty = torch.zeros(nB, nA, nH, nW)
-    tw = torch.zeros(nB, nA, nH, nW)
-    th = torch.zeros(nB, nA, nH, nW)
-    tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
-    tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
+    device = pred_boxes.device
+    mask = torch.zeros(nB, nA, nH, nW, device=device)
+    conf_mask = torch.ones(nB, nA, nH, nW, device=device)
+    tx = torch.zeros(nB, nA, nH, nW, device=device)
+    ty = torch.zeros(nB, nA, nH, nW, device=device)
+    tw = torch.zeros(nB, nA, nH, nW, device=device)
+    th = torch.zeros(nB, nA, nH, nW, device=device)
+    tconf = torch.zeros(nB, nA, nH, nW, dtype=torch.uint8, device=device)
+    tcls = torch.zeros(nB, nA, nH, nW, nC, dtype=torch.uint8, device=device)
     if target_num_neighbors is not None:
-        tneighbors = torch.FloatTensor(nB, nA, nH, nW).fill_(0)
+        tneighbors = torch.zeros(nB, nA, nH, nW, device=device)
     else:
         tneighbors=None
     if calcIOUAndDist:
-        distances = torch.ones(nB,nA, nH, nW) #distance to closest target
-        ious = torch.zeros(nB,nA, nH, nW) #max iou to target
+        distances = torch.ones(nB,nA, nH, nW, device=device) #distance to closest target
+        ious = torch.zeros(nB,nA, nH, nW, device=device) #max iou to target
     else:
         distances=None
         ious=None
 
-    nGT = 0
-    nCorrect = 0
-    #import pdb; pdb.set_trace()
-    for b in range(nB):
-        if calcIOUAndDist and target_sizes[b]>0:
-            raise Exception('caclIOUAndDist does not have normalized target (scaled)')
-            flat_pred = pred_boxes[b].view(-1,pred_boxes.size(-1))
-            #flat_target = target[b,:target_sizes[b]].view(-1,target.size(-1))
-            iousB = allIOU(flat_pred,target[b,:target_sizes[b]], boxes1XYWH=[0,1,2,3])
-            iousB = iousB.view(nA, nH, nW,-1)
-            ious[b] = iousB.max(dim=-1)[0]
-            distancesB = allDist(flat_pred,target[b,:target_sizes[b]])
-            distances[b] = distancesB.min(dim=-1)[0].view(nA, nH, nW)
-            #import pdb;pdb.set_trace()
-        
-        for t in range(target_sizes[b]): #range(target.shape[1]):
-            #if target[b, t].sum() == 0:
-            #    continue
-            # Convert to position relative to box
-            gx = target[b, t, 0] / scale[0]
-            gy = target[b, t, 1] / scale[1]
-            gw = target[b, t, 4] / scale[0]
-            gh = target[b, t, 3] / scale[1]
-        
-            if gw==0 or gh==0:
-                continue
-            nGT += 1
-            # Get grid box indices
-            gi = max(min(int(gx),conf_mask.size(3)-1),0)
-            gj = max(min(int(gy),conf_mask.size(2)-1),0)
-            #Get best matching anchor
-            best_n, anch_ious = get_closest_anchor_iou(anchors,gh,gw)
-            # Where the overlap is larger than threshold set mask to zero (ignore)
-            conf_mask[b, anch_ious > ignore_thres, gj, gi] = 0
-            # Get ground truth box
-            gt_box = torch.FloatTensor(np.array([gx, gy, gw, gh])).unsqueeze(0)
-            # Get the best prediction
-            pred_box = pred_boxes[b, best_n, gj, gi].unsqueeze(0)
-            # Masks
-            mask[b, best_n, gj, gi] = 1
-            conf_mask[b, best_n, gj, gi] = 1 #why not just set this to 0?
-            # Coordigates
-            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
-            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
-            # Width and height
-            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
-            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
-            # One-hot encoding of label
-            #target_label = int(target[b, t, 0])
-            tcls[b, best_n, gj, gi] = target[b, t,13:]
-            if target_num_neighbors is not None:
-                tneighbors[b, best_n, gj, gi] = target_num_neighbors[b, t]
-            tconf[b, best_n, gj, gi] = 1
-
-            # Calculate iou between ground truth and best matching prediction
-            if calcIOUAndDist:
-                #iou = ious[best_n*(nH*nW) + gj*(nW) + gi,t]
-                iou = iousB[best_n, gj, gi, t]
-            else:
-                iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
-            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
-            score = pred_conf[b, best_n, gj, gi]
-            #import pdb; pdb.set_trace()
-            if iou > 0.5 and pred_label == torch.argmax(target[b,t,13:]) and score > 0:
-                nCorrect += 1
+    if calcIOUAndDist:
+        for b in range(nB):
+            if target_sizes[b]>0:
+                raise Exception('caclIOUAndDist does not have normalized target (scaled)')
+                flat_pred = pred_boxes[b].view(-1,pred_boxes.size(-1))
+                #flat_target = target[b,:target_sizes[b]].view(-1,target.size(-1))
+                ious[b] = bestIOU(flat_pred,target[b,:target_sizes[b]],1, boxes1XYWH=[0,1,2,3])[0].view(nA, nH, nW)
+                distances[b] = pairwiseBest(allDist_,flat_pred,target[b,:target_sizes[b]],1,largest=False)[0].view(nA, nH, nW)
+
+    if target is None or nB==0 or sum(int(s) for s in target_sizes)==0:
+        return 0, 0, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious
+
+    target = target.to(device)
+    anchors = anchors.to(device)
+    # Convert to position relative to box
+    gx_all = target[:,:,0] / scale[0]
+    gy_all = target[:,:,1] / scale[1]
+    gw_all = target[:,:,4] / scale[0]
+    gh_all = target[:,:,3] / scale[1]
+    b, t = batch_targets(target_sizes, (gw_all!=0) & (gh_all!=0))
+    gx = gx_all[b,t]
+    gy = gy_all[b,t]
+    gw = gw_all[b,t]
+    gh = gh_all[b,t]
+    nGT = b.size(0)
+    if nGT==0:
+        return 0, 0, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious
+
+    # Get grid box indices
+    gi = gx.long().clamp(0,nW-1)
+    gj = gy.long().clamp(0,nH-1)
+    #Get best matching anchor (by shape only, as get_closest_anchor_iou), unless the DataLoader already did
+    if anchor_assignment is not None:
+        best_n = anchor_assignment['best_anchor'].to(device)[b,t]
+        ignore = anchor_assignment['ignore'].to(device)[b,t]
+    else:
+        best_n, ignore = closestAnchors(gw,gh,anchors.type(gw.dtype),ignore_thres)
+
+    # Where the overlap is larger than threshold set mask to zero (ignore), masks, coordinates,
+    # width and height, and one-hot label
+    cells = (b[:,None]*nA + torch.arange(nA,device=device)[None,:])*nH*nW + gj[:,None]*nW + gi[:,None]
+    assigned = [(mask,1), (tconf,1),
+            (tx,inv_tanh_all(gx - (gi.type(gx.dtype)+0.5))),
+            (ty,inv_tanh_all(gy - (gj.type(gy.dtype)+0.5))),
+            (tw,(gw / anchors[best_n,0] + 1e-16).double().log()),
+            (th,(gh / anchors[best_n,1] + 1e-16).double().log()),
+            (tcls,target[b,t,13:])]
+    if target_num_neighbors is not None:
+        assigned.append((tneighbors,target_num_neighbors.to(device)[b,t]))
+    assign_targets(conf_mask, cells, best_n, ignore, assigned)
+
+    # Calculate iou between ground truth and best matching prediction
+    gt_box = torch.stack([gx,gy,gw,gh],dim=1)
+    pred_box = pred_boxes[b,best_n,gj,gi]
+    iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
+    pred_label = torch.argmax(pred_cls[b,best_n,gj,gi],dim=1)
+    score = pred_conf[b,best_n,gj,gi]
+    correct = (iou > 0.5) & (pred_label == torch.argmax(target[b,t,13:],dim=1)) & (score > 0)
+    nCorrect = int(correct.sum().item())
 
     return nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious
 
@@ -440,15 +491,15 @@ class YoloDistLoss (nn.Module):
         #    target[:,:,5:13] /= self.scale[0]
 
         nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls = build_targets_dist(
-            pred_points=pred_points.cpu().data,
-            pred_hws=((o_h+o_w)/2.0).cpu().data,
-            pred_conf=pred_conf.cpu().data,
-            pred_cls=pred_cls.cpu().data,
-            target=target.cpu().data if target is not None else None,
+            pred_points=pred_points.data,
+            pred_hws=((o_h+o_w)/2.0).data,
+            pred_conf=pred_conf.data,
+            pred_cls=pred_cls.data,
+            target=target.data if target is not None else None,
             target_sizes=target_sizes,
-            anchors=self.scaled_anchors.cpu().data,
-            anchor_points=self.scaled_anchor_points.cpu().data,
-            anchor_hws=self.scaled_anchor_hws.cpu().data,
+            anchors=self.scaled_anchors.data,
+            anchor_points=self.scaled_anchor_points.data,
+            anchor_hws=self.scaled_anchor_hws.data,
             num_anchors=nA,
             num_classes=self.num_classes,
             grid_sizeH=nH,
@@ -537,86 +588,82 @@ def get_closest_anchor_dist(anchors,rot,gh,gw):
 def build_targets_dist(
     pred_points, pred_hws, pred_conf, pred_cls, target, target_sizes, anchors, anchor_points, anchor_hws, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale
 ):
+    #Batched as build_targets
     nB = pred_points.size(0)
     nA = num_anchors
     nC = num_classes
     nH = grid_sizeH
     nW = grid_sizeW
-    mask = torch.zeros(nB, nA, nH, nW)
-    conf_mask = torch.ones(nB, nA, nH, nW)
-    tx = torch.zeros(nB, nA, nH, nW)
-    ty = torch.zeros(nB, nA, nH, nW)
-    tw = torch.zeros(nB, nA, nH, nW)
-    th = torch.zeros(nB, nA, nH, nW)
-    tr = torch.zeros(nB, nA, nH, nW)
-    tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
-    tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
-
-    nGT = 0
-    nCorrect = 0
-    for b in range(nB):
-        for t in range(target_sizes[b]): #range(target.shape[1]):
-            #if target[b, t].sum() == 0:
-            #    continue
-
-            # Convert to position relative to box
-            gx = target[b, t, 0] / scale[0]
-            gy = target[b, t, 1] / scale[0]
-            gw = target[b, t, 4] / scale[0]
-            gh = target[b, t, 3] / scale[0]
-            gr = target[b, t, 2]
-            if gw==0 or gh==0:
-                continue
-            nGT += 1
-            # Get grid box indices
-            gi = max(min(int(gx),conf_mask.size(3)-1),0)
-            gj = max(min(int(gy),conf_mask.size(2)-1),0)
-            # Get shape of gt box
-            gt_points = target[b,t,5:13] / scale[0]
-            gt_points[[0,2,4,6]]-=gx #center the points about the origin instead of BB location
-            gt_points[[1,3,5,7]]-=gy
-            # Get shape of anchor box
-            #anchor_shapes = torch.FloatTensor(np.concatenate((np.zeros((len(anchors), 2)), np.array(anchors)), 1))
-            # Calculate iou between gt and anchor shapes
-            anch_dists = bbox_dist(gt_points, (gh+gw)/2.0, anchor_points, anchor_hws)
-            # Where the overlap is larger than threshold set mask to zero (ignore)
-            conf_mask[b, anch_dists < ignore_thres, gj, gi] = 0
-            # Find the best matching anchor box
-            best_n = np.argmin(anch_dists)
-            # Get ground truth box
-            gt_points = target[b,t,5:13] / scale[0]
-            #gt_points[[0,2,4,6]]+=gx
-            #gt_points[[1,3,5,7]]+=gy
-            # Get the best prediction
-            pred_point = pred_points[b, best_n, gj, gi]#.unsqueeze(0)
-            pred_hw = pred_hws[b, best_n, gj, gi]#.unsqueeze(0)
-            # Masks
-            mask[b, best_n, gj, gi] = 1
-            conf_mask[b, best_n, gj, gi] = 1
-            # Coordinates
-            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
-            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
-            # Rotation
-            rot_diff = gr-anchors[best_n][2]
-            if rot_diff>math.pi:
-                rot_diff-=2*math.pi
-            elif rot_diff<-math.pi:
-                rot_diff+=2*math.pi
-            tr[b, best_n, gj, gi] = inv_tanh(rot_diff/(math.pi/2))
-            # Width and height
-            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
-            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
-            # One-hot encoding of label
-            #target_label = int(target[b, t, 0])
-            tcls[b, best_n, gj, gi] = target[b, t,13:]
-            tconf[b, best_n, gj, gi] = 1
-
-            # Calculate iou between ground truth and best matching prediction
-            dist = bbox_dist(gt_points, (gh+gw)/2.0, pred_point, pred_hw)
-            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
-            score = pred_conf[b, best_n, gj, gi]
-            if dist < 0.85 and pred_label == torch.argmax(target[b,t,13:]) and score > 0.0:
-                nCorrect += 1
+    device = pred_points.device
+    mask = torch.zeros(nB, nA, nH, nW, device=device)
+    conf_mask = torch.ones(nB, nA, nH, nW, device=device)
+    tx = torch.zeros(nB, nA, nH, nW, device=device)
+    ty = torch.zeros(nB, nA, nH, nW, device=device)
+    tw = torch.zeros(nB, nA, nH, nW, device=device)
+    th = torch.zeros(nB, nA, nH, nW, device=device)
+    tr = torch.zeros(nB, nA, nH, nW, device=device)
+    tconf = torch.zeros(nB, nA, nH, nW, dtype=torch.uint8, device=device)
+    tcls = torch.zeros(nB, nA, nH, nW, nC, dtype=torch.uint8, device=device)
+
+    if target is None or nB==0 or sum(int(s) for s in target_sizes)==0:
+        return 0, 0, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
+
+    target = target.to(device)
+    anchors = anchors.to(device)
+    anchor_points = anchor_points.to(device)
+    anchor_hws = anchor_hws.to(device)
+    # Convert to position relative to box
+    gx_all = target[:,:,0] / scale[0]
+    gy_all = target[:,:,1] / scale[0]
+    gw_all = target[:,:,4] / scale[0]
+    gh_all = target[:,:,3] / scale[0]
+    b, t = batch_targets(target_sizes, (gw_all!=0) & (gh_all!=0))
+    gx = gx_all[b,t]
+    gy = gy_all[b,t]
+    gw = gw_all[b,t]
+    gh = gh_all[b,t]
+    gr = target[b,t,2]
+    nGT = b.size(0)
+    if nGT==0:
+        return 0, 0, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
+
+    # Get grid box indices
+    gi = gx.long().clamp(0,nW-1)
+    gj = gy.long().clamp(0,nH-1)
+    # Get shape of gt box, the points centered about the origin instead of BB location
+    gt_points = target[b,t,5:13] / scale[0]
+    gt_shapes = gt_points.clone()
+    gt_shapes[:,[0,2,4,6]]-=gx[:,None]
+    gt_shapes[:,[1,3,5,7]]-=gy[:,None]
+    gt_hws = (gh+gw)/2.0
+    # Find the best matching anchor box
+    anch_dists = bbox_dist(gt_shapes, gt_hws, anchor_points, anchor_hws)
+    best_n = torch.argmin(anch_dists,dim=1)
+    # Rotation
+    rot_diff = gr-anchors[best_n,2]
+    rot_diff = torch.where(rot_diff>math.pi, rot_diff-2*math.pi, torch.where(rot_diff<-math.pi, rot_diff+2*math.pi, rot_diff))
+
+    # Where the distance is smaller than threshold set mask to zero (ignore), masks, coordinates,
+    # rotation, width and height, and one-hot label
+    cells = (b[:,None]*nA + torch.arange(nA,device=device)[None,:])*nH*nW + gj[:,None]*nW + gi[:,None]
+    assign_targets(conf_mask, cells, best_n, anch_dists<ignore_thres,
+            [(mask,1), (tconf,1),
+             (tx,inv_tanh_all(gx - (gi.type(gx.dtype)+0.5))),
+             (ty,inv_tanh_all(gy - (gj.type(gy.dtype)+0.5))),
+             (tr,inv_tanh_all(rot_diff/(math.pi/2))),
+             (tw,(gw / anchors[best_n,0] + 1e-16).double().log()),
+             (th,(gh / anchors[best_n,1] + 1e-16).double().log()),
+             (tcls,target[b,t,13:])])
+
+    # Calculate distance between ground truth and best matching prediction
+    pred_point = pred_points[b,best_n,gj,gi]
+    pred_hw = pred_hws[b,best_n,gj,gi]
+    diff = gt_points-pred_point
+    dist = ((torch.norm(diff[:,0:2],2,1)+torch.norm(diff[:,2:4],2,1)+torch.norm(diff[:,4:6],2,1)+torch.norm(diff[:,6:8],2,1))/((gt_hws+pred_hw)/2.0))**2
+    pred_label = torch.argmax(pred_cls[b,best_n,gj,gi],dim=1)
+    score = pred_conf[b,best_n,gj,gi]
+    correct = (dist < 0.85) & (pred_label == torch.argmax(target[b,t,13:],dim=1)) & (score > 0.0)
+    nCorrect = int(correct.sum().item())
     #nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
     return nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
 
@@ -726,10 +773,10 @@ class LineLoss (nn.Module):
         #    target[:,:,[1,3]] /= self.scale[1]
 
         nGT, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls = self.build_targets_lines(
-            pred=pred.cpu().data,
-            pred_conf=pred_conf.cpu().data,
-            pred_cls=pred_cls.cpu().data,
-            target=target.cpu().data if target is not None else None,
+            pred=pred.data,
+            pred_conf=pred_conf.data,
+            pred_cls=pred_cls.data,
+            target=target.data if target is not None else None,
             target_sizes=target_sizes,
             grid_sizeH=nH,
             grid_sizeW=nW,
@@ -791,59 +838,48 @@ class LineLoss (nn.Module):
     def build_targets_lines(self,
         pred, pred_conf, pred_cls, target, target_sizes, grid_sizeH, grid_sizeW
     ):
+        #Batched as build_targets, with one "anchor"
         nB = pred.size(0)
         nC = self.num_classes
         nH = grid_sizeH
         nW = grid_sizeW
-        mask = torch.zeros(nB, nH, nW)
-        conf_mask = torch.ones(nB, nH, nW)
-        tx1 = torch.zeros(nB, nH, nW)
-        ty1 = torch.zeros(nB, nH, nW)
-        tx2 = torch.zeros(nB, nH, nW)
-        ty2 = torch.zeros(nB, nH, nW)
-        #th = torch.zeros(nB, nH, nW)
-        #tr = torch.zeros(nB, nH, nW)
-        tconf = torch.ByteTensor(nB, nH, nW).fill_(0)
-        tcls = torch.ByteTensor(nB, nH, nW, nC).fill_(0)
-
-        nGT = 0
-        for b in range(nB):
-            for t in range(target_sizes[b]): #range(target.shape[1]):
-                #if target[b, t].sum() == 0:
-                #    continue
-
-                # Convert to position relative to box
-                gx1 = target[b, t, 0] / scale[0]
-                gy1 = target[b, t, 1] / scale[1]
-                gx2 = target[b, t, 2] / scale[0]
-                gy2 = target[b, t, 3] / scale[1]
-                gx = (gx1+gx2)/2.0
-                gy = (gy1+gy2)/2.0
-                #if gh==0:
-                #    continue
-                nGT += 1
-                # Get grid box indices
-                gi = max(min(int(gx),conf_mask.size(2)-1),0)
-                gj = max(min(int(gy),conf_mask.size(1)-1),0)
-                # Masks
-                mask[b, gj, gi] = 1
-                conf_mask[b, gj, gi] = 1
-                # Coordinates
-                tx1[b, gj, gi] = gx1 - (gi+0.5) #inv_tanh(gx1 - (gi+0.5))
-                ty1[b, gj, gi] = gy1 - (gj+0.5) #inv_tanh(gy1 - (gj+0.5))
-                tx2[b, gj, gi] = gx2 - (gi+0.5) #inv_tanh(gx2 - (gi+0.5))
-                ty2[b, gj, gi] = gy2 - (gj+0.5) #inv_tanh(gy2 - (gj+0.5))
-                # One-hot encoding of label
-                #target_label = int(target[b, t, 0])
-                tcls[b, gj, gi] = target[b, t,5:]
-                tconf[b, gj, gi] = 1
-
-                # Calculate iou between ground truth and best matching prediction
-                #dist = bbox_dist(gt_points, (gh+gw)/2.0, pred_point, pred_hw)
-                #dist = 
-                #pred_label = torch.argmax(pred_cls[b, gj, gi])
-                #score = pred_conf[b, gj, gi]
-                #if dist < 0.85 and pred_label == torch.argmax(target[b,t,13:]) and score > 0.0:
-                #    nCorrect += 1
+        scale = self.scale
+        device = pred.device
+        mask = torch.zeros(nB, nH, nW, device=device)
+        conf_mask = torch.ones(nB, nH, nW, device=device)
+        tx1 = torch.zeros(nB, nH, nW, device=device)
+        ty1 = torch.zeros(nB, nH, nW, device=device)
+        tx2 = torch.zeros(nB, nH, nW, device=device)
+        ty2 = torch.zeros(nB, nH, nW, device=device)
+        tconf = torch.zeros(nB, nH, nW, dtype=torch.uint8, device=device)
+        tcls = torch.zeros(nB, nH, nW, nC, dtype=torch.uint8, device=device)
+
+        if target is None or nB==0 or sum(int(s) for s in target_sizes)==0:
+            return 0, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls
+
+        target = target.to(device)
+        b, t = batch_targets(target_sizes, torch.ones(target.size(0),target.size(1),dtype=torch.bool,device=device))
+        # Convert to position relative to box
+        gx1 = target[b, t, 0] / scale[0]
+        gy1 = target[b, t, 1] / scale[1]
+        gx2 = target[b, t, 2] / scale[0]
+        gy2 = target[b, t, 3] / scale[1]
+        gx = (gx1+gx2)/2.0
+        gy = (gy1+gy2)/2.0
+        nGT = b.size(0)
+        # Get grid box indices
+        gi = gx.long().clamp(0,nW-1)
+        gj = gy.long().clamp(0,nH-1)
+        gi_center = gi.type(gx.dtype)+0.5
+        gj_center = gj.type(gy.dtype)+0.5
+        # Masks, coordinates and one-hot label
+        cells = (b*nH + gj)*nW + gi
+        assign_targets(conf_mask, cells[:,None], torch.zeros_like(cells), torch.zeros_like(cells[:,None],dtype=torch.bool),
+                [(mask,1), (tconf,1),
+                 (tx1,gx1 - gi_center),
+                 (ty1,gy1 - gj_center),
+                 (tx2,gx2 - gi_center),
+                 (ty2,gy2 - gj_center),
+                 (tcls,target[b,t,5:])])
         #nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
         return nGT, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls
@@ -0,0 +1,55 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import torch
+
+#Shared by the parity tests: each compares a vectorized function against the loop it replaced (kept in the
+#test file) on a handful of seeded random cases plus a few targeted edge cases
+SEEDS = range(5)
+
+class Draws(object):
+    #the random draws of one case, all from one seeded generator
+    def __init__(self,seed):
+        self.gen = torch.Generator().manual_seed(seed)
+
+    def randint(self,low,high,size=None):
+        if size is None:
+            return torch.randint(low,high,(1,),generator=self.gen).item()
+        return torch.randint(low,high,size,generator=self.gen)
+
+    def rand(self,*size):
+        return torch.rand(*size,generator=self.gen)
+
+    def randn(self,*size):
+        return torch.randn(*size,generator=self.gen)
+
+    def randperm(self,n):
+        return torch.randperm(n,generator=self.gen)
+
+    def choice(self,options):
+        return options[self.randint(0,len(options))]
+
+def assertSame(expected,result,path=()):
+    #exactly equal, down through tuples and lists: tensors in value and dtype, None as None
+    if isinstance(expected,(tuple,list)):
+        assert isinstance(result,(tuple,list)) and len(expected)==len(result), path
+        for i,(x,y) in enumerate(zip(expected,result)):
+            assertSame(x,y,path+(i,))
+    elif expected is None:
+        assert result is None, path
+    elif torch.is_tensor(expected):
+        assert torch.is_tensor(result) and expected.dtype==result.dtype and torch.equal(expected,result), path
+    else:
+        assert expected==result, path
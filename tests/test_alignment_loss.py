@@ -0,0 +1,101 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+import pytest
+import torch
+
+from model.alignment_loss import sparse_assignment, hungarian_assignment, alignment_loss
+from model.loss import detect_alignment_loss
+from fixtures import SEEDS, Draws
+
+def randomCost(seed,case='random'):
+    #[locations,targets] costs, either uniform or as alignment_loss builds them from points. The cases: fewer
+    #locations than targets, as many, a single target and costs from a few levels (so many tie)
+    draw = Draws(seed)
+    n = draw.randint(2,60)
+    m = {'fewer_locations':n+draw.randint(1,10),'square':n,'one_target':1}.get(case,draw.randint(1,60))
+    if seed%2==0:
+        cost = draw.rand(n,m).double()
+        if case=='tied':
+            cost = torch.floor(cost*3)
+        return cost.numpy()
+    pred = draw.rand(n,2).double()*10
+    targ = draw.rand(m,2).double()*10
+    conf = draw.rand(n).double()
+    if case=='tied':
+        pred,targ = pred.round(),targ.round()
+    cost = 500*((pred[:,None]-targ[None])**2).sum(2) - torch.log(conf+1e-10)[:,None] + torch.log(1-conf+1e-10)[:,None]
+    return cost.numpy()
+
+def optimumIsCandidate(cost, location_ind, target_ind, candidates, gate):
+    #whether every pair of the exact assignment is among the ones sparse_assignment considers
+    if cost.shape[0]<cost.shape[1]:
+        cost, more, fewer = cost.T, target_ind, location_ind
+    else:
+        more, fewer = location_ind, target_ind
+    if candidates>=cost.shape[0]:
+        return True
+    vals = cost[more,fewer]
+    inCand = (cost[:,fewer]<=vals[None,:]).sum(0)<=candidates
+    if gate is not None:
+        inCand &= vals<=cost.min(0)[fewer]+gate
+    return inCand.all()
+
+def assertValid(cost, location_ind, target_ind):
+    assert len(location_ind)==len(target_ind)==min(cost.shape)
+    assert len(set(location_ind.tolist()))==len(location_ind)
+    assert len(set(target_ind.tolist()))==len(target_ind)
+    assert (np.diff(target_ind)>0).all() #ordered by target
+
+@pytest.mark.parametrize('candidates',[1,2,4,8,16])
+@pytest.mark.parametrize('gate',[None,1.0,5.0])
+@pytest.mark.parametrize('case',['random','fewer_locations','square','one_target','tied'])
+def test_sparse_assignment_against_exact(candidates,gate,case):
+    for seed in SEEDS:
+        cost = randomCost(seed,case)
+        location_ind, target_ind = sparse_assignment(cost,candidates,gate)
+        assertValid(cost,location_ind,target_ind)
+        exact_location_ind, exact_target_ind = hungarian_assignment(cost)
+        sparseCost = cost[location_ind,target_ind].sum()
+        exactCost = cost[exact_location_ind,exact_target_ind].sum()
+        assert sparseCost >= exactCost-1e-9*max(1,abs(exactCost))
+        if optimumIsCandidate(cost,exact_location_ind,exact_target_ind,candidates,gate):
+            assert sparseCost == pytest.approx(exactCost,rel=1e-9,abs=1e-9)
+        #with every location a candidate it falls back to the dense solver
+        location_ind, target_ind = sparse_assignment(cost,max(cost.shape),gate)
+        assert cost[location_ind,target_ind].sum() == pytest.approx(exactCost,rel=1e-9,abs=1e-9)
+
+def test_sparse_assignment_retries_when_candidates_leave_no_assignment():
+    #every target's cheapest location is the same one, so one candidate (or a tight gate) can't assign them all
+    cost = np.arange(5)[:,None]*10.0 + np.random.RandomState(0).rand(5,3)
+    for candidates, gate in [(1,None),(2,0.1),(4,0.0)]:
+        location_ind, target_ind = sparse_assignment(cost,candidates,gate)
+        assertValid(cost,location_ind,target_ind)
+        exact = hungarian_assignment(cost)
+        assert cost[location_ind,target_ind].sum() == pytest.approx(cost[exact].sum())
+
+def test_alignment_loss_sparse_params():
+    torch.manual_seed(0)
+    predictions = torch.rand(2,40,5)
+    target = torch.rand(2,30,4)
+    label_sizes = [30,17]
+    exact = alignment_loss(predictions,target,label_sizes,return_alignment=True,assignment='hungarian')
+    sparse = alignment_loss(predictions,target,label_sizes,return_alignment=True,assignment='sparse',assignment_candidates=40,assignment_gate=None)
+    assert torch.allclose(exact[0],sparse[0])
+    for b in range(2):
+        assert (exact[1][b]==sparse[1][b]).all() and (exact[2][b]==sparse[2][b]).all()
+    gated = detect_alignment_loss(predictions,target,label_sizes,1000.0,100.0,assignment='sparse',assignment_candidates=2,assignment_gate=0.0)
+    assert gated >= exact[0]-1e-4*abs(exact[0])
@@ -0,0 +1,46 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import logging
+import torch
+
+from utils.graph_cache import GraphCache
+
+def test_key_depends_on_image_name():
+    bbs = torch.rand(10,5)
+    assert GraphCache.key('a',bbs,800,600) != GraphCache.key('b',bbs,800,600)
+    assert GraphCache.key('a',bbs,800,600) == GraphCache.key('a',bbs.clone(),800,600)
+
+def test_disk_entries_are_evicted_least_recently_used(tmp_path):
+    cache = GraphCache(2,str(tmp_path))
+    for key in ['a','b','c']:
+        cache.put(key,{'candidates':torch.zeros(0,2,dtype=torch.long)})
+    assert sorted(os.listdir(str(tmp_path))) == ['b.pt','c.pt']
+    #a later run picks up what is on disk
+    later = GraphCache(2,str(tmp_path))
+    assert later.get('b') is not None
+    later.put('d',{})
+    assert sorted(os.listdir(str(tmp_path))) == ['b.pt','d.pt']
+
+def test_bad_entry_is_rebuilt(tmp_path,caplog):
+    with open(os.path.join(str(tmp_path),'bad.pt'),'w') as f:
+        f.write('partially written')
+    cache = GraphCache(2,str(tmp_path))
+    with caplog.at_level(logging.WARNING):
+        assert cache.get('bad') is None
+    assert 'bad.pt' in caplog.text
+    cache.put('bad',{})
+    assert cache.get('bad') == {}
@@ -0,0 +1,50 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+import pytest
+import torch
+
+from evaluators.formsgraphpair_printer import countAbove
+from fixtures import SEEDS, Draws
+
+#the thresholds the printer sweeps (sweep_thresholds, _big and _small), its default and the one used when optimizing
+SWEEPS = [np.arange(0.1,1.0,0.05), np.arange(0,20.0,1), np.arange(0,0.1,0.01), [0.7], [0]]
+
+def randomScores(seed,case):
+    #float32 relationship scores as the model gives them. 'on_thresholds' puts many of them right on the swept
+    #thresholds (as float32), 'nan' makes some NaN (never above a threshold) and 'empty' has none
+    draw = Draws(seed)
+    n = 0 if case=='empty' else draw.randint(1,200)
+    scores = draw.rand(n)*1.2-0.1
+    if case=='on_thresholds':
+        sweep = torch.tensor(np.concatenate([np.asarray(s,dtype=np.float64) for s in SWEEPS]),dtype=torch.float32)
+        scores = torch.where(draw.rand(n)<0.5,sweep[draw.randint(0,len(sweep),(n,))],scores)
+    elif case=='nan':
+        scores[draw.rand(n)<0.2] = float('nan')
+    return scores
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('case',['random','on_thresholds','nan','empty'])
+def test_count_above_matches_loop(seed,case):
+    relPred = randomScores(seed,case)
+    #sorted once, without the NaNs, as the printer does for each kind of relationship
+    relConf = relPred.numpy()
+    sortedConf = np.sort(relConf[~np.isnan(relConf)])
+    for sweep in SWEEPS:
+        for rel_threshold_use in sweep:
+            #the printer's loop compared each score tensor to the threshold
+            expected = sum(1 for i in range(relPred.size(0)) if relPred[i]>rel_threshold_use)
+            assert countAbove(sortedConf,rel_threshold_use)==expected, rel_threshold_use
@@ -0,0 +1,147 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import types
+import numpy as np
+import pytest
+import torch
+
+from trainer.graph_pair_trainer import GraphPairTrainer
+from utils.yolo_tools import getTargIndexForPreds_iou, computeAP
+from fixtures import SEEDS, Draws, assertSame
+
+def loopAlignEdgePred(self,targetBoxes,adj,outputBoxes,relPred,relIndexes):
+    #GraphPairTrainer.alignEdgePred before it was tensorized (without the early returns, which it kept)
+    targetBoxes = targetBoxes.cpu()
+    numClasses = 2
+    targIndex, fullHit = getTargIndexForPreds_iou(targetBoxes[0],outputBoxes,0.4,numClasses,hard_thresh=False,fixed=self.fixedAlign)
+    rels = relIndexes
+    predsAll = relPred
+    sigPredsAll = torch.sigmoid(predsAll[:,-1])
+    predsPos = []
+    predsNeg = []
+    scores = []
+    matches=0
+    truePred=falsePred=badPred=0
+    for i,(n0,n1) in enumerate(rels):
+        t0 = targIndex[n0].item()
+        t1 = targIndex[n1].item()
+        if t0>=0 and t1>=0:
+            if (min(t0,t1),max(t0,t1)) in adj:
+                if fullHit[n0] and fullHit[n1]:
+                    matches+=1
+                    predsPos.append(predsAll[i])
+                    scores.append( (sigPredsAll[i],True) )
+                    if sigPredsAll[i]>self.thresh_rel:
+                        truePred+=1
+                else:
+                    scores.append( (sigPredsAll[i],False) ) #for the sake of scoring, this is a bad relationship
+            else:
+                predsNeg.append(predsAll[i])
+                scores.append( (sigPredsAll[i],False) )
+                if sigPredsAll[i]>self.thresh_rel:
+                    falsePred+=1
+        else:
+            if self.useBadBBPredForRelLoss:
+                if self.useBadBBPredForRelLoss=='full' or np.random.rand()<self.useBadBBPredForRelLoss:
+                    predsNeg.append(predsAll[i])
+            scores.append( (sigPredsAll[i],False) )
+            if sigPredsAll[i]>self.thresh_rel:
+                badPred+=1
+    for i in range(len(adj)-matches):
+        scores.append( (float('nan'),True) )
+
+    predsPos = torch.stack(predsPos) if len(predsPos)>0 else None
+    predsNeg = torch.stack(predsNeg) if len(predsNeg)>0 else None
+    recall = truePred/len(adj) if len(adj)>0 else 1
+    prec = truePred/(truePred+falsePred) if falsePred>0 else 1
+    fullPrec = truePred/(truePred+falsePred+badPred) if falsePred+badPred>0 else 1
+    return predsPos,predsNeg, recall, prec ,fullPrec, computeAP(scores), targIndex, fullHit
+
+def loopPrealignedEdgePred(self,adj,relPred,relIndexes):
+    #GraphPairTrainer.prealignedEdgePred before it was tensorized
+    sigPredsAll = torch.sigmoid(relPred[:,-1])
+    predsPos = []
+    predsNeg = []
+    scores = []
+    truePred=falsePred=0
+    for i,(n0,n1) in enumerate(relIndexes):
+        if (n0,n1) in adj:
+            predsPos.append(relPred[i])
+            scores.append( (sigPredsAll[i],True) )
+            if sigPredsAll[i]>self.thresh_rel:
+                truePred+=1
+        else:
+            predsNeg.append(relPred[i])
+            scores.append( (sigPredsAll[i],False) )
+            if sigPredsAll[i]>self.thresh_rel:
+                falsePred+=1
+    predsPos = torch.stack(predsPos) if len(predsPos)>0 else None
+    predsNeg = torch.stack(predsNeg) if len(predsNeg)>0 else None
+    recall = truePred/len(adj) if len(adj)>0 else 1
+    prec = truePred/(truePred+falsePred) if falsePred>0 else 1
+    return predsPos,predsNeg, recall, prec, prec, computeAP(scores)
+
+def randomAlignment(seed):
+    #target boxes [1,targets,(x,y,r,h,w,...,class one-hot)], predicted boxes (conf,x,y,r,h,w,neighbors,classes)
+    #of which some are near a target (of its class or not) and the others anywhere, the rels between the
+    #predictions with their scores and the target pairs (adj)
+    draw = Draws(seed)
+    numTargets = draw.randint(2,20)
+    numPreds = draw.randint(2,30)
+    targetBoxes = torch.zeros(1,numTargets,15)
+    targetBoxes[0,:,0] = draw.rand(numTargets)*500
+    targetBoxes[0,:,1] = draw.rand(numTargets)*500
+    targetBoxes[0,:,3] = draw.rand(numTargets)*10+5
+    targetBoxes[0,:,4] = draw.rand(numTargets)*40+5
+    targetBoxes[0,:,13:] = torch.nn.functional.one_hot(draw.randint(0,2,(numTargets,)),2).float()
+    outputBoxes = torch.zeros(numPreds,9)
+    outputBoxes[:,0] = draw.rand(numPreds)
+    near = draw.randint(0,numTargets,(numPreds,))
+    outputBoxes[:,1:6] = targetBoxes[0,near,:5]+draw.randn(numPreds,5)*torch.tensor([3,3,0,2,4])
+    far = draw.rand(numPreds)<0.3
+    outputBoxes[far,1:3] = draw.rand(int(far.sum()),2)*500
+    outputBoxes[:,6:] = draw.randn(numPreds,3)
+    rels = [tuple(pair) for pair in draw.randint(0,numPreds,(draw.randint(1,60),2)).tolist() if pair[0]!=pair[1]]
+    adj = set()
+    for a,b in draw.randint(0,numTargets,(draw.randint(0,25),2)).tolist():
+        if a!=b:
+            adj.add((min(a,b),max(a,b)))
+    relPred = draw.randn(len(rels),2)
+    return targetBoxes, adj, outputBoxes, relPred, rels
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('useBadBBPredForRelLoss',[False,'full',0.5])
+@pytest.mark.parametrize('fixedAlign',[True,False])
+def test_align_edge_pred_matches_loop(seed,useBadBBPredForRelLoss,fixedAlign):
+    trainer = types.SimpleNamespace(thresh_rel=0.5,useBadBBPredForRelLoss=useBadBBPredForRelLoss,fixedAlign=fixedAlign,
+            model=types.SimpleNamespace(rotation=False))
+    targetBoxes, adj, outputBoxes, relPred, rels = randomAlignment(seed)
+    np.random.seed(seed)
+    expected = loopAlignEdgePred(trainer,targetBoxes,adj,outputBoxes,relPred,rels)
+    np.random.seed(seed)
+    result = GraphPairTrainer.alignEdgePred(trainer,targetBoxes,adj,outputBoxes,relPred,rels)
+    assert (expected[6]>=0).any()
+    assertSame(expected,result)
+
+@pytest.mark.parametrize('seed',SEEDS)
+def test_prealigned_edge_pred_matches_loop(seed):
+    trainer = types.SimpleNamespace(thresh_rel=0.5)
+    _, _, _, relPred, rels = randomAlignment(seed)
+    #directed: only some of the rels are in it, some reversed, and pairs no rel has
+    adj = set(rels[::3]) | set((b,a) for a,b in rels[1::5]) | {(0,1000)}
+    assertSame(loopPrealignedEdgePred(trainer,adj,relPred,rels),GraphPairTrainer.prealignedEdgePred(trainer,adj,relPred,rels))
+    for adj in [set(),set(rels)]:
+        assertSame(loopPrealignedEdgePred(trainer,adj,relPred,rels),GraphPairTrainer.prealignedEdgePred(trainer,adj,relPred,rels))
@@ -0,0 +1,237 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+import pytest
+import torch
+from skimage import draw
+
+from utils.graph_tools import rasterizePolygons, pairShapeFeats, boxShapeFeats, graphEdges
+from fixtures import SEEDS, Draws
+
+NUM_BB_TYPES=2
+NORM_VERT=50.0
+NORM_HORZ=100.0
+NORM_DIST=(NORM_VERT+NORM_HORZ)/2
+HEIGHT=800
+WIDTH=600
+
+def layouts(numBBTypes):
+    #the two ixs layouts PairingGraph uses: old BinaryPairReal feature nets and everything else
+    real = [0,1,2,3,3+numBBTypes,3+numBBTypes,4+numBBTypes,5+numBBTypes,6+numBBTypes,6+2*numBBTypes,6+2*numBBTypes,7+2*numBBTypes]
+    other = [4,6,2,8,8+numBBTypes,5,7,3,8+numBBTypes,8+numBBTypes+numBBTypes,0,1]
+    return {'real':real,'other':other}
+
+def makeBoxes(n,extraPred,seed):
+    bbs = Draws(seed).rand(n,5+extraPred+NUM_BB_TYPES)
+    bbs[:,0]*=WIDTH
+    bbs[:,1]*=HEIGHT
+    bbs[:,2]=(bbs[:,2]-0.5)*math.pi
+    bbs[:,3]=bbs[:,3]*30+1
+    bbs[:,4]=bbs[:,4]*150+1
+    bbs[:,5:]=bbs[:,5:]*8-4
+    return bbs
+
+def corners(bbs):
+    x,y,r,h,w = bbs[:,0],bbs[:,1],bbs[:,2],bbs[:,3],bbs[:,4]
+    cos_r = torch.cos(r)
+    sin_r = torch.sin(r)
+    cornersX = torch.stack((-w*cos_r + -h*sin_r +x, w*cos_r + -h*sin_r +x, w*cos_r + h*sin_r +x, -w*cos_r + h*sin_r +x),dim=1)
+    cornersY = torch.stack((w*sin_r + -h*cos_r +y, -w*sin_r + -h*cos_r +y, -w*sin_r + h*cos_r +y, w*sin_r + h*cos_r +y),dim=1)
+    return cornersX,cornersY
+
+def randomQuads(seed,case,height,width):
+    #[n,4] vertices (y,x) of rotated boxes around the window, partly outside it. 'integer' puts the vertices on
+    #pixels (so pixels fall on edges and vertices) and 'flat' gives them no height
+    draw = Draws(seed)
+    bbs = makeBoxes(30,0,seed)
+    bbs[:,0] = draw.rand(30)*width*1.4-0.2*width
+    bbs[:,1] = draw.rand(30)*height*1.4-0.2*height
+    bbs[:,3] = bbs[:,3]/30*height/2
+    bbs[:,4] = bbs[:,4]/150*width/2
+    if case=='flat':
+        bbs[:,3] = 0
+    cornersX,cornersY = corners(bbs)
+    if case=='integer':
+        cornersX,cornersY = cornersX.round(),cornersY.round()
+    return cornersY,cornersX
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('case',['random','integer','flat'])
+@pytest.mark.parametrize('height,width',[(3,3),(7,11),(20,20)])
+def test_rasterize_polygons_matches_skimage(seed,case,height,width):
+    vertsY,vertsX = randomQuads(seed,case,height,width)
+    masks = rasterizePolygons(vertsY,vertsX,height,width)
+    assert masks.size()==(vertsY.size(0),height,width)
+    for i in range(vertsY.size(0)):
+        expected = torch.zeros(height,width)
+        rr, cc = draw.polygon(vertsY[i].tolist(),vertsX[i].tolist(),(height,width))
+        expected[rr,cc] = 1
+        assert torch.equal(masks[i],expected), i
+
+def loopPairShapeFeats(bbs,cornersX,cornersY,candidates,ixs,numShapeFeats,extraPred,cornerFeats,positionFeature):
+    #the per candidate loop PairingGraph.createGraph used before pairShapeFeats
+    tlX,trX,brX,blX = cornersX.unbind(1)
+    tlY,trY,brY,blY = cornersY.unbind(1)
+    shapeFeats = torch.zeros(len(candidates),numShapeFeats)
+    for i,(index1, index2) in enumerate(candidates):
+        shapeFeats[i,ixs[0]] = 2*bbs[index1,3]/NORM_VERT
+        shapeFeats[i,ixs[1]] = 2*bbs[index1,4]/NORM_HORZ
+        shapeFeats[i,ixs[2]] = bbs[index1,2]/math.pi
+        shapeFeats[i,ixs[3]:ixs[4]] = bbs[index1,extraPred+5:]
+
+        shapeFeats[i,ixs[5]] = 2*bbs[index2,3]/NORM_VERT
+        shapeFeats[i,ixs[6]] = 2*bbs[index2,4]/NORM_HORZ
+        shapeFeats[i,ixs[7]] = bbs[index2,2]/math.pi
+        shapeFeats[i,ixs[8]:ixs[9]] = bbs[index2,extraPred+5:]
+
+        shapeFeats[i,ixs[10]] = (bbs[index1,0]-bbs[index2,0])/NORM_HORZ
+        shapeFeats[i,ixs[11]] = (bbs[index1,1]-bbs[index2,1])/NORM_VERT
+        startCorners = 8+NUM_BB_TYPES+NUM_BB_TYPES
+        if cornerFeats:
+            shapeFeats[i,startCorners +0] = math.sqrt( (tlX[index1]-tlX[index2])**2 + (tlY[index1]-tlY[index2])**2 )/NORM_DIST
+            shapeFeats[i,startCorners +1] = math.sqrt( (trX[index1]-trX[index2])**2 + (trY[index1]-trY[index2])**2 )/NORM_DIST
+            shapeFeats[i,startCorners +3] = math.sqrt( (brX[index1]-brX[index2])**2 + (brY[index1]-brY[index2])**2 )/NORM_DIST
+            shapeFeats[i,startCorners +2] = math.sqrt( (blX[index1]-blX[index2])**2 + (blY[index1]-blY[index2])**2 )/NORM_DIST
+            startNN = startCorners+4
+        else:
+            startNN = startCorners
+        if extraPred:
+            shapeFeats[i,startNN +0] = bbs[index1,5]
+            shapeFeats[i,startNN +1] = bbs[index2,5]
+            startPos = startNN+2
+        else:
+            startPos = startNN
+        if positionFeature:
+            if positionFeature=='absolute':
+                shapeFeats[i,startPos +0] = (bbs[index1,0]-WIDTH/2)/(5*NORM_HORZ)
+                shapeFeats[i,startPos +1] = (bbs[index1,1]-HEIGHT/2)/(10*NORM_VERT)
+                shapeFeats[i,startPos +2] = (bbs[index2,0]-WIDTH/2)/(5*NORM_HORZ)
+                shapeFeats[i,startPos +3] = (bbs[index2,1]-HEIGHT/2)/(10*NORM_VERT)
+            else:
+                shapeFeats[i,startPos +0] = (bbs[index1,0]-WIDTH/2)/(WIDTH/2)
+                shapeFeats[i,startPos +1] = (bbs[index1,1]-HEIGHT/2)/(HEIGHT/2)
+                shapeFeats[i,startPos +2] = (bbs[index2,0]-WIDTH/2)/(WIDTH/2)
+                shapeFeats[i,startPos +3] = (bbs[index2,1]-HEIGHT/2)/(HEIGHT/2)
+    return shapeFeats
+
+def loopBoxShapeFeats(bbs,numShapeFeatsBB,extraPred,positionFeature):
+    bb_shapeFeats = torch.zeros(bbs.size(0),numShapeFeatsBB)
+    for i in range(bbs.size(0)):
+        bb_shapeFeats[i,0]= (bbs[i,2]+math.pi)/(2*math.pi)
+        bb_shapeFeats[i,1]=bbs[i,3]/NORM_VERT
+        bb_shapeFeats[i,2]=bbs[i,4]/NORM_HORZ
+        if extraPred:
+            bb_shapeFeats[i,3]=bbs[i,5]
+        bb_shapeFeats[i,3+extraPred:NUM_BB_TYPES+3+extraPred]=torch.sigmoid(bbs[i,5+extraPred:NUM_BB_TYPES+5+extraPred])
+        if positionFeature:
+            if positionFeature=='absolute':
+                bb_shapeFeats[i,NUM_BB_TYPES+3+extraPred] = (bbs[i,0]-WIDTH/2)/(5*NORM_HORZ)
+                bb_shapeFeats[i,NUM_BB_TYPES+4+extraPred] = (bbs[i,1]-HEIGHT/2)/(10*NORM_VERT)
+            else:
+                bb_shapeFeats[i,NUM_BB_TYPES+3+extraPred] = (bbs[i,0]-WIDTH/2)/(WIDTH/2)
+                bb_shapeFeats[i,NUM_BB_TYPES+4+extraPred] = (bbs[i,1]-HEIGHT/2)/(HEIGHT/2)
+    return bb_shapeFeats
+
+@pytest.mark.parametrize('layout',['real','other'])
+@pytest.mark.parametrize('cornerFeats',[True,False])
+@pytest.mark.parametrize('extraPred',[0,1])
+@pytest.mark.parametrize('positionFeature',[None,'absolute','relative'])
+def test_pair_shape_feats_match_loop(layout,cornerFeats,extraPred,positionFeature):
+    ixs = layouts(NUM_BB_TYPES)[layout]
+    #sized as PairingGraph.__init__ does
+    numShapeFeats = 8+2*NUM_BB_TYPES + (4 if cornerFeats else 0) + 2*extraPred + (4 if positionFeature else 0)
+    bbs = makeBoxes(40,extraPred,seed=len(layout)+2*extraPred)
+    cornersX,cornersY = corners(bbs)
+    indexes = Draws(1).randint(0,40,(120,2))
+    candidates = [tuple(pair) for pair in indexes.tolist()]
+    #both directions, as createGraph does for flip=='both'
+    for index,pairs in ((indexes,candidates),(indexes.flip(1),[(b,a) for a,b in candidates])):
+        shapeFeats = pairShapeFeats(bbs,cornersX,cornersY,index,ixs,numShapeFeats,NUM_BB_TYPES,extraPred,
+                NORM_VERT,NORM_HORZ,NORM_DIST,cornerFeats,positionFeature,HEIGHT,WIDTH)
+        expected = loopPairShapeFeats(bbs,cornersX,cornersY,pairs,ixs,numShapeFeats,extraPred,cornerFeats,positionFeature)
+        assert torch.equal(shapeFeats,expected)
+
+@pytest.mark.parametrize('extraPred',[0,1])
+@pytest.mark.parametrize('positionFeature',[None,'absolute','relative'])
+def test_box_shape_feats_match_loop(extraPred,positionFeature):
+    numShapeFeatsBB = 3+NUM_BB_TYPES+extraPred+(2 if positionFeature else 0)
+    bbs = makeBoxes(40,extraPred,seed=7)
+    bb_shapeFeats = boxShapeFeats(bbs,numShapeFeatsBB,NUM_BB_TYPES,extraPred,NORM_VERT,NORM_HORZ,positionFeature,HEIGHT,WIDTH)
+    assert torch.equal(bb_shapeFeats,loopBoxShapeFeats(bbs,numShapeFeatsBB,extraPred,positionFeature))
+
+def loopGraphEdges(candidates,numBB,relRelEdges):
+    #the loop PairingGraph.createGraph used before graphEdges, with the correctly indexed loop for 'shared_box'
+    numOfNeighbors = torch.ones(numBB+len(candidates))
+    edges=[]
+    i=0
+    for bb1,bb2 in candidates:
+        edges.append( (bb1,numBB+i) )
+        edges.append( (bb2,numBB+i) )
+        numOfNeighbors[bb1]+=1
+        numOfNeighbors[bb2]+=1
+        numOfNeighbors[numBB+i]+=2
+        i+=1
+    if relRelEdges:
+        relEdges=set()
+        i=0
+        for bb1,bb2 in candidates:
+            j=0
+            for bbA,bbB in candidates[i:]:
+                if relRelEdges=='shared_box':
+                    if j>0 and (bb1==bbA or bb1==bbB or bb2==bbA or bb2==bbB):
+                        relEdges.add( (numBB+i,numBB+i+j) )
+                elif i!=j and bb1==bbA or bb1==bbB or bb2==bbA or bb2==bbB:
+                    relEdges.add( (numBB+i,numBB+j) )
+                j+=1
+            i+=1
+        for r1, r2 in relEdges:
+            numOfNeighbors[r1]+=1
+            numOfNeighbors[r2]+=1
+        edges += list(relEdges)
+    edges+=[(y,x) for x,y in edges]
+    for i in range(numBB+len(candidates)):
+        edges.append((i,i))
+    return sorted(edges), numOfNeighbors
+
+def randomCandidates(numBB,numRel,seed):
+    draw = Draws(seed)
+    pairs = set()
+    while len(pairs)<numRel:
+        a,b = draw.randint(0,numBB,(2,)).tolist()
+        if a!=b:
+            pairs.add((min(a,b),max(a,b)))
+    pairs = list(pairs)
+    order = draw.randperm(len(pairs)).tolist()
+    return [pairs[i] for i in order]
+
+@pytest.mark.parametrize('relRelEdges',[False,True,'legacy','shared_box'])
+@pytest.mark.parametrize('numBB,numRel',[(2,0),(2,1),(3,3),(6,10),(30,60)])
+def test_graph_edges_match_loop(relRelEdges,numBB,numRel):
+    candidates = randomCandidates(numBB,numRel,numRel)
+    expectedEdges,expectedNeighbors = loopGraphEdges(candidates,numBB,relRelEdges)
+    edges,numOfNeighbors = graphEdges(torch.LongTensor(candidates).view(-1,2),numBB,relRelEdges)
+    assert sorted(map(tuple,edges.t().tolist()))==expectedEdges
+    assert torch.equal(numOfNeighbors,expectedNeighbors)
+
+def test_graph_edges_shared_box():
+    #rels 0 and 1 share box 1, rel 2 shares nothing; legacy links every rel to rel 0 instead
+    candidates = torch.LongTensor([[0,1],[1,2],[3,4]])
+    edges,_ = graphEdges(candidates,5,'shared_box')
+    relRel = {(a,b) for a,b in edges.t().tolist() if a>=5 and b>=5 and a!=b}
+    assert relRel=={(5,6),(6,5)}
+    edges,_ = graphEdges(candidates,5,'legacy')
+    relRel = {(a,b) for a,b in edges.t().tolist() if a>=5 and b>=5 and a!=b}
+    assert relRel=={(5,6),(6,5),(5,7),(7,5)}
@@ -0,0 +1,107 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import types
+import numpy as np
+import pytest
+import torch
+from skimage import draw
+
+from utils.line_of_sight import PerimeterIndex, candidateRays, raySteps, rayEnds, rayCells, boxSteps
+
+from model.pairing_graph import PairingGraph
+
+#Saved box sets (x,y,r,h,w) with their page size: generated form layouts, tables, random, rotated,
+#degenerate (near zero height or width), integer (GT like) and boxes running off the page.
+#The training ones go through the distMul loop.
+with open(os.path.join(os.path.dirname(__file__),'data','candidate_boxes.json')) as f:
+    CORPUS = json.load(f)
+
+def candidates(engine,entry):
+    #selectCandidateEdges only looks at these attributes
+    graph = types.SimpleNamespace(training=entry['training'],useOldDecay=False,candidateEngine=engine)
+    bbs = torch.tensor(entry['boxes'],dtype=torch.float32)
+    return set(PairingGraph.selectCandidateEdges(graph,bbs,entry['image_height'],entry['image_width']))
+
+@pytest.mark.parametrize('entry',CORPUS,ids=[entry['name'] for entry in CORPUS])
+def test_vectorized_matches_walker(entry):
+    walked = candidates('walk',entry)
+    assert len(walked)>0
+    assert candidates('vectorized',entry)==walked
+
+def indexedPairs(tiles):
+    #a page of tiles*tiles 600x600 tiles of rows of boxes, so the density stays the same
+    size = 600*tiles
+    x,y = np.meshgrid(np.arange(50,size,150.0),np.arange(20,size,60.0))
+    x = x.ravel()
+    y = y.ravel()
+    w = np.full_like(x,40)
+    h = np.full_like(x,8)
+    corners = (x-w,y-h,x+w,y-h,x+w,y+h,x-w,y+h)
+    index = PerimeterIndex(np.zeros((size,size),dtype=int),*corners)
+    rayBox,startX,startY,angles = candidateRays(*corners,np.zeros_like(x),w.astype(np.float32),h.astype(np.float32))
+    xSteps,ySteps = raySteps(angles)
+    endStep = rayEnds(index,startX,startY,xSteps,ySteps,300.0,100.0)
+    ray,cell = rayCells(index,startX,startY,xSteps,ySteps,endStep)
+    #the (ray,box) pairs boxSteps intersects
+    return x.shape[0], index.cellCount[cell].sum()
+
+def test_indexed_pairs_scale_linearly():
+    boxes,pairs = indexedPairs(2)
+    moreBoxes,morePairs = indexedPairs(8)
+    assert moreBoxes==16*boxes
+    #every ray against every box would be 256 times as many
+    assert morePairs < 1.5*16*pairs
+
+def randomPage(seed,numBoxes,rows,cols):
+    #rotated, thin and page clipped boxes, drawn as selectCandidateEdges draws them
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(0,cols,numBoxes)
+    y = rng.uniform(0,rows,numBoxes)
+    r = rng.normal(0,0.4,numBoxes)*(rng.rand(numBoxes)<0.5)
+    h = rng.uniform(0.1,15,numBoxes)
+    w = rng.uniform(0.1,80,numBoxes)
+    c = np.cos(r)
+    s = np.sin(r)
+    corners = (x-w*c-h*s, y+w*s-h*c, x+w*c-h*s, y-w*s-h*c, x+w*c+h*s, y-w*s+h*c, x-w*c+h*s, y+w*s+h*c)
+    tlX,tlY,trX,trY,brX,brY,blX,blY = corners
+    boxesDrawn = np.zeros((rows,cols),dtype=int)
+    for i in range(numBoxes):
+        rr,cc = draw.polygon_perimeter([int(tlY[i]),int(trY[i]),int(brY[i]),int(blY[i])],[int(tlX[i]),int(trX[i]),int(brX[i]),int(blX[i])],boxesDrawn.shape,True)
+        boxesDrawn[rr,cc]=i+1
+    return boxesDrawn, corners, r, (2*w).astype(np.float32), (2*h).astype(np.float32)
+
+@pytest.mark.parametrize('seed',range(3))
+def test_box_steps_match_stepping(seed):
+    #the steps the edge intersection finds are exactly the ones on a box when every step is looked at
+    boxesDrawn,corners,r,w,h = randomPage(seed,150,400,500)
+    index = PerimeterIndex(boxesDrawn,*corners)
+    rayBox,startX,startY,angles = candidateRays(*corners,r,w,h)
+    xSteps,ySteps = raySteps(angles)
+    endStep = rayEnds(index,startX,startY,xSteps,ySteps,600.0,200.0)
+    ray,step,pix = boxSteps(index,startX,startY,xSteps,ySteps,endStep)
+
+    allRay = np.repeat(np.arange(startX.shape[0]),endStep)
+    allStep = np.arange(endStep.sum())-np.repeat(np.cumsum(endStep)-endStep,endStep)
+    x = np.rint(startX[allRay]+allStep*xSteps[allRay])
+    y = np.rint(startY[allRay]+allStep*ySteps[allRay])
+    allPix = (y*boxesDrawn.shape[1]+x).astype(np.int64)
+    onBox = boxesDrawn.ravel()[allPix]>0
+    assert onBox.any()
+    assert np.array_equal(ray,allRay[onBox])
+    assert np.array_equal(step,allStep[onBox])
+    assert np.array_equal(pix,allPix[onBox])
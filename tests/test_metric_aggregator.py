@@ -0,0 +1,61 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import numpy as np
+
+from utils.metric_aggregator import MetricAggregator
+
+def test_add_results_matches_numpy():
+    rand = np.random.RandomState(0)
+    images = [{'ap':rand.rand(), 'recall':{'text':list(rand.rand(3)),'field':list(rand.rand(2))}, 'missing':None}
+              for i in range(50)]
+    aggregator = MetricAggregator()
+    for results in images:
+        aggregator.addResults(results)
+    ap = [results['ap'] for results in images]
+    text = [v for results in images for v in results['recall']['text']]
+    field = [v for results in images for v in results['recall']['field']]
+    assert np.allclose(aggregator.mean(('ap',)),np.mean(ap))
+    assert np.allclose(aggregator.std(('ap',)),np.std(ap))
+    assert np.allclose(aggregator.mean(('recall','text')),np.mean(text))
+    #each named list is also added to the type
+    assert aggregator.count(('recall',))==len(text)+len(field)
+    assert np.allclose(aggregator.std(('recall',)),np.std(text+field))
+    assert ('missing',) not in aggregator.keys()
+
+def test_merged_shards_match_one_pass(tmp_path):
+    rand = np.random.RandomState(1)
+    values = list(rand.rand(300)*3)
+    vectors = [list(v) for v in rand.rand(300,2)]
+    whole = MetricAggregator()
+    whole.add(('ap',),values)
+    whole.add(('class','ap'),vectors)
+    merged = None
+    for i,(start,end) in enumerate([(0,20),(20,210),(210,300)]):
+        shard = MetricAggregator(50,seed=i)
+        shard.add(('ap',),values[start:end])
+        shard.add(('class','ap'),vectors[start:end])
+        path = os.path.join(str(tmp_path),'shard{}.json'.format(i))
+        shard.save(path)
+        if merged is None:
+            merged = MetricAggregator.load(path)
+        else:
+            merged.merge(MetricAggregator.load(path))
+    for key in [('ap',),('class','ap')]:
+        assert merged.count(key)==whole.count(key)
+        assert np.allclose(merged.mean(key),whole.mean(key))
+        assert np.allclose(merged.std(key),whole.std(key))
+    assert len(merged.stats[('ap',)][3])==50
@@ -0,0 +1,98 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import types
+import pytest
+import torch
+from torch import nn
+
+from model.pairing_graph import PairingGraph
+from fixtures import SEEDS, Draws
+
+NUM_BB_TYPES=2
+HEIGHT=400
+WIDTH=300
+CHANNELS=4
+
+def cropPool(poolH,poolW):
+    #stands in for RoIAlign: the average of each roi's pixels over a poolH x poolW grid
+    def pool(features,rois):
+        windows = []
+        for roi in rois.long().tolist():
+            _,x1,y1,x2,y2 = roi
+            windows.append(nn.functional.adaptive_avg_pool2d(features[0,:,y1:y2+1,x1:x2+1],(poolH,poolW)))
+        return torch.stack(windows,dim=0)
+    return pool
+
+def graphStub(useShapeFeats,context):
+    #the attributes of a PairingGraph that createGraph reads, with small seeded featurizers
+    torch.manual_seed(0)
+    poolH,poolW,poolBBH,poolBBW = 5,7,3,4
+    numMasks = 3 if context is not None else 2
+    numShapeFeats = 8+2*NUM_BB_TYPES+(4 if useShapeFeats!='old' else 0)+2+4
+    numShapeFeatsBB = 3+NUM_BB_TYPES+1+2
+    visual = 0 if useShapeFeats=='only' else 6
+    graph = types.SimpleNamespace(training=False,useOldDecay=False,candidateEngine='vectorized',graphCache=None,
+            includeRelRelEdges='shared_box',debug=False,rotation=False,splitFeatures=False,
+            detector=types.SimpleNamespace(predNumNeighbors=True),pairer=None,
+            useShapeFeats=useShapeFeats,usePositionFeature='absolute',numBBTypes=NUM_BB_TYPES,
+            numShapeFeats=numShapeFeats,numShapeFeatsBB=numShapeFeatsBB,
+            normalizeVert=50,normalizeHorz=400,normalizeDist=225,
+            expandedRelContext=context,expandedBBContext=context,use_fixed_masks=True,
+            pool2_h=poolH,pool2_w=poolW,poolBB2_h=poolBBH,poolBB2_w=poolBBW,
+            roi_align=cropPool(poolH,poolW),roi_alignMask=cropPool(poolH,poolW),
+            roi_alignBB=cropPool(poolBBH,poolBBW),roi_alignBBMask=cropPool(poolBBH,poolBBW),
+            relFeaturizerConv=nn.Conv2d(CHANNELS+numMasks,6,(poolH,poolW)),
+            relFeaturizerFC=nn.Linear(visual+numShapeFeats,5),
+            useBBVisualFeats=True,
+            bbFeaturizerConv=nn.Conv2d(CHANNELS+(2 if context else 0),6,(poolBBH,poolBBW)),
+            bbFeaturizerFC=nn.Linear(visual+numShapeFeatsBB,5))
+    graph.selectCandidateEdges = types.MethodType(PairingGraph.selectCandidateEdges,graph)
+    return graph
+
+def randomPage(seed):
+    #[n,(x,y,r,h,w,neighbors,class scores)] boxes in rows, as a form would have them
+    draw = Draws(seed)
+    n = 25
+    bbs = torch.zeros(n,6+NUM_BB_TYPES)
+    bbs[:,0] = draw.rand(n)*(WIDTH-60)+30
+    bbs[:,1] = draw.randint(0,12,(n,)).float()*30+20+draw.rand(n)*4
+    bbs[:,2] = (draw.rand(n)-0.5)*0.1
+    bbs[:,3] = draw.rand(n)*6+4
+    bbs[:,4] = draw.rand(n)*30+5
+    bbs[:,5:] = draw.randn(n,1+NUM_BB_TYPES)
+    return bbs, draw.rand(1,CHANNELS,HEIGHT,WIDTH)
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('useShapeFeats',['corner','old','only'])
+@pytest.mark.parametrize('context',[150,None])
+def test_create_graph_both_matches_two_directions(seed,useShapeFeats,context):
+    graph = graphStub(useShapeFeats,context)
+    bbs, features = randomPage(seed)
+    with torch.no_grad():
+        unflipped = PairingGraph.createGraph(graph,bbs,features,None,HEIGHT,WIDTH,flip=False)
+        flipped = PairingGraph.createGraph(graph,bbs,features,None,HEIGHT,WIDTH,flip=True)
+        both = PairingGraph.createGraph(graph,bbs,features,None,HEIGHT,WIDTH,flip='both')
+    feats, (adjacency,numOfNeighbors), numBB, numRel, relIndexes = both
+    assert numRel>0
+    assert (numBB,numRel,relIndexes)==unflipped[2:]==flipped[2:]
+    assert torch.equal(adjacency.to_dense(),unflipped[1][0].to_dense())
+    assert torch.equal(numOfNeighbors,unflipped[1][1])
+    #the boxes, then the unflipped rels, then the flipped ones
+    assert feats.size(0)==numBB+2*numRel
+    assert torch.allclose(feats[:numBB+numRel],unflipped[0],atol=1e-5)
+    assert torch.allclose(feats[numBB+numRel:],flipped[0][numBB:],atol=1e-5)
+    if useShapeFeats!='only':
+        assert not torch.allclose(unflipped[0][numBB:],flipped[0][numBB:],atol=1e-5)
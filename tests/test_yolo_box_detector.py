@@ -0,0 +1,118 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import math
+import pytest
+import torch
+
+from model.yolo_box_detector import YoloBoxDetector
+from fixtures import Draws
+
+ROOT = os.path.join(os.path.dirname(__file__),'..')
+
+def loopDecode(self,y,img):
+    #YoloBoxDetector.forward's decoding as it was: priors built per call, boxes decoded one anchor at a time
+    priors_0 = torch.arange(0,y.size(2)).type_as(img.data)[None,:,None]
+    priors_0 = (priors_0 + 0.5) * self.scale[1]
+    priors_0 = priors_0.expand(y.size(0), priors_0.size(1), y.size(3))
+    priors_0 = priors_0[:,None,:,:].to(img.device)
+    priors_1 = torch.arange(0,y.size(3)).type_as(img.data)[None,None,:]
+    priors_1 = (priors_1 + 0.5) * self.scale[0]
+    priors_1 = priors_1.expand(y.size(0), y.size(2), priors_1.size(2))
+    priors_1 = priors_1[:,None,:,:].to(img.device)
+
+    anchor = self.anchors
+    pred_boxes=[]
+    pred_offsets=[]
+    for i in range(self.numAnchors):
+        offset = i*(self.numBBParams+self.numBBTypes)
+        if self.rotation:
+            rot_dif = (math.pi/2)*torch.tanh(y[:,3+offset:4+offset,:,:])
+        else:
+            rot_dif = torch.zeros_like(y[:,3+offset:4+offset,:,:])
+        stackedPred = [
+            torch.sigmoid(y[:,0+offset:1+offset,:,:]),
+            torch.tanh(y[:,1+offset:2+offset,:,:])*self.scale[0] + priors_1,
+            torch.tanh(y[:,2+offset:3+offset,:,:])*self.scale[1] + priors_0,
+            rot_dif + anchor[i]['rot'],
+            torch.exp(y[:,4+offset:5+offset,:,:]) * anchor[i]['height'],
+            torch.exp(y[:,5+offset:6+offset,:,:]) * anchor[i]['width'],
+        ]
+        if self.predNumNeighbors:
+            stackedPred.append(1+y[:,6+offset:7+offset,:,:])
+            extra=1
+        else:
+            extra=0
+        for j in range(self.numBBTypes):
+            stackedPred.append(torch.sigmoid(y[:,6+j+extra+offset:7+j+extra+offset,:,:]))
+        pred_boxes.append(torch.cat(stackedPred, dim=1))
+        pred_offsets.append(y[:,offset:offset+self.numBBParams+self.numBBTypes,:,:])
+    bbPredictions = torch.stack(pred_boxes, dim=1)
+    offsetPredictions = torch.stack(pred_offsets, dim=1)
+    bbPredictions = bbPredictions.transpose(2,4).contiguous()
+    bbPredictions = bbPredictions.view(bbPredictions.size(0),bbPredictions.size(1),-1,bbPredictions.size(4))
+    bbPredictions = bbPredictions.view(bbPredictions.size(0),-1,bbPredictions.size(3))
+    offsetPredictions = offsetPredictions.permute(0,1,3,4,2).contiguous()
+
+    linePreds=[]
+    for i in range(self.predLineCount):
+        offset = i*(self.numLineParams+self.numBBTypes) + self.numAnchors*(self.numBBParams+self.numBBTypes)
+        stackedPred=[
+            torch.sigmoid(y[:,0+offset:1+offset,:,:]),
+            torch.tanh(y[:,1+offset:2+offset,:,:])*self.scale[0] + priors_1,
+            torch.tanh(y[:,2+offset:3+offset,:,:])*self.scale[1] + priors_0,
+            (math.pi)*torch.tanh(y[:,3+offset:4+offset,:,:]),
+            torch.exp(y[:,4+offset:5+offset,:,:])*self.meanH
+        ]
+        for j in range(self.numBBTypes):
+            stackedPred.append(y[:,5+j+offset:6+j+offset,:,:])
+        predictions = torch.cat(stackedPred, dim=1)
+        predictions = predictions.transpose(1,3).contiguous()
+        linePreds.append(predictions.view(predictions.size(0),-1,predictions.size(3)))
+    pointPreds=[]
+    for i in range(self.predPointCount):
+        offset = i*3 + self.numAnchors*(self.numBBParams+self.numBBTypes)
+        predictions = torch.cat([
+            torch.sigmoid(y[:,0+offset:1+offset,:,:]),
+            y[:,1+offset:2+offset,:,:] + priors_1,
+            y[:,2+offset:3+offset,:,:] + priors_0
+        ], dim=1)
+        predictions = predictions.transpose(1,3).contiguous()
+        pointPreds.append(predictions.view(predictions.size(0),-1,3))
+    return bbPredictions, offsetPredictions, linePreds, pointPreds
+
+@pytest.mark.parametrize('rotation,anchors',[(True,'test_anchors.json'),(False,'anchors_noRot_new_25.json')])
+@pytest.mark.parametrize('heads',[{},{'pred_num_neighbors':True,'number_of_line_types':2,'number_of_point_types':1}])
+def test_decode_matches_per_anchor_loop(rotation,anchors,heads):
+    torch.manual_seed(0)
+    config = dict(number_of_box_types=2,anchors_file=os.path.join(ROOT,anchors),rotation=rotation,norm_type='group_norm',
+            down_layers_cfg=[3,8,'M',8,'M',16],decode_grid_cache_size=2,**heads)
+    detector = YoloBoxDetector(config)
+    detector.eval()
+    draw = Draws(0)
+    #a page size seen before (so its grid is cached), other ones and one pushed out of the cache again
+    for height,width in [(64,96),(80,48),(64,96),(32,32),(48,80),(32,32)]:
+        img = draw.randn(2,3,height,width)
+        with torch.no_grad():
+            bbPredictions, offsetPredictions, linePreds, offsetLinePreds, pointPreds, pixelPreds = detector(img)
+            expected = loopDecode(detector,detector._hack_down(img),img)
+        #the batched sigmoid/tanh/exp can round differently in the last bit than the per-anchor slices
+        assert torch.allclose(bbPredictions,expected[0]) and torch.equal(offsetPredictions,expected[1])
+        assert len(linePreds)==len(expected[2]) and len(pointPreds)==len(expected[3])
+        for result,loop in zip(linePreds+pointPreds,expected[2]+expected[3]):
+            assert torch.allclose(result,loop)
+    #only the two most recently used feature map sizes stay cached
+    assert [key[:2] for key in detector.decodeGrids]==[(12,20),(8,8)]
@@ -0,0 +1,312 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+import numpy as np
+import pytest
+import torch
+
+from model.yolo_loss import YoloLoss, build_targets, build_targets_dist, LineLoss, bbox_iou, bbox_dist, inv_tanh, get_closest_anchor_iou
+from utils.yolo_tools import anchorAssignment
+from fixtures import SEEDS, Draws, assertSame
+
+#the old loop (and get_closest_anchor_iou) pass tensors through numpy
+pytestmark = pytest.mark.filterwarnings('ignore::DeprecationWarning')
+
+def loopBuildTargets(pred_boxes, pred_conf, pred_cls, target, target_sizes, anchors, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale, target_num_neighbors=None):
+    #build_targets as it was, assigning one target at a time (so the last target in a cell wins)
+    nB = pred_boxes.size(0)
+    nA = num_anchors
+    nC = num_classes
+    nH = grid_sizeH
+    nW = grid_sizeW
+    mask = torch.zeros(nB, nA, nH, nW)
+    conf_mask = torch.ones(nB, nA, nH, nW)
+    tx = torch.zeros(nB, nA, nH, nW)
+    ty = torch.zeros(nB, nA, nH, nW)
+    tw = torch.zeros(nB, nA, nH, nW)
+    th = torch.zeros(nB, nA, nH, nW)
+    tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
+    tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
+    if target_num_neighbors is not None:
+        tneighbors = torch.FloatTensor(nB, nA, nH, nW).fill_(0)
+    else:
+        tneighbors=None
+
+    nGT = 0
+    nCorrect = 0
+    for b in range(nB):
+        for t in range(target_sizes[b]):
+            gx = target[b, t, 0] / scale[0]
+            gy = target[b, t, 1] / scale[1]
+            gw = target[b, t, 4] / scale[0]
+            gh = target[b, t, 3] / scale[1]
+            if gw==0 or gh==0:
+                continue
+            nGT += 1
+            gi = max(min(int(gx),conf_mask.size(3)-1),0)
+            gj = max(min(int(gy),conf_mask.size(2)-1),0)
+            best_n, anch_ious = get_closest_anchor_iou(anchors,gh,gw)
+            conf_mask[b, anch_ious > ignore_thres, gj, gi] = 0
+            gt_box = torch.FloatTensor(np.array([gx, gy, gw, gh])).unsqueeze(0)
+            pred_box = pred_boxes[b, best_n, gj, gi].unsqueeze(0)
+            mask[b, best_n, gj, gi] = 1
+            conf_mask[b, best_n, gj, gi] = 1
+            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
+            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
+            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
+            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
+            tcls[b, best_n, gj, gi] = target[b, t,13:]
+            if target_num_neighbors is not None:
+                tneighbors[b, best_n, gj, gi] = target_num_neighbors[b, t]
+            tconf[b, best_n, gj, gi] = 1
+            iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
+            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
+            score = pred_conf[b, best_n, gj, gi]
+            if iou > 0.5 and pred_label == torch.argmax(target[b,t,13:]) and score > 0:
+                nCorrect += 1
+
+    return nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, None, None
+
+CASES = ['random','shared_cells','zero_size','empty_batch']
+
+def randomTargets(seed,case='random'):
+    #a batch of rotated targets (with their corner points) and lines on a small grid, with the predictions for
+    #them, as the arguments of build_targets, build_targets_dist and build_targets_lines. Some are off the grid or
+    #have no height. 'shared_cells' puts them all on the borders of a 2x2 grid with a repeated anchor shape, so many
+    #share a cell and anchor (and the last one wins), 'zero_size' gives half of them no height or width and
+    #'empty_batch' has no targets at all (or no target tensor) or images without any between ones with them.
+    #The rotated losses need a square scale, they get scale[0] for both
+    draw = Draws(seed)
+    nB = draw.randint(1,4)
+    nA = draw.randint(2,6)
+    nH,nW = (2,2) if case=='shared_cells' else (draw.randint(1,8),draw.randint(1,8))
+    nC = draw.randint(1,4)
+    scale = [float(draw.randint(4,17)),float(draw.randint(4,17))]
+    if seed%2==0:
+        scale[1] = scale[0]
+    anchors = draw.rand(nA,3)*4+0.5
+    anchors[:,2] = (draw.rand(nA)-0.5)*2*math.pi
+    if case=='shared_cells':
+        anchors[-1]=anchors[0]
+    T = draw.randint(10,30) if case=='shared_cells' else draw.randint(1,30)
+    target_sizes = [draw.randint(0,T+1) for b in range(nB)]
+    if case=='empty_batch':
+        if seed%2:
+            T = 0
+        target_sizes = [T if b%2 else 0 for b in range(nB)]
+    target = torch.zeros(nB,T,13+nC)
+    lines = torch.zeros(nB,T,5+nC)
+    if case=='shared_cells':
+        target[:,:,0] = draw.randint(0,nW+1,(nB,T))*scale[0]
+        target[:,:,1] = draw.randint(0,nH+1,(nB,T))*scale[1]
+        lines[:,:,0:4] = draw.randint(0,3,(nB,T,4))*torch.tensor([scale[0],scale[1]]*2)
+    else:
+        target[:,:,0] = (draw.rand(nB,T)*1.2-0.1)*nW*scale[0]
+        target[:,:,1] = (draw.rand(nB,T)*1.2-0.1)*nH*scale[1]
+        lines[:,:,0:4] = (draw.rand(nB,T,4)*1.2-0.1)*torch.tensor([nW*scale[0],nH*scale[1]]*2)
+    target[:,:,2] = (draw.rand(nB,T)-0.5)*2*math.pi*1.3
+    target[:,:,3] = draw.rand(nB,T)*40
+    target[:,:,4] = draw.rand(nB,T)*60
+    if case=='zero_size':
+        target[:,:,3][draw.rand(nB,T)<0.25] = 0
+        target[:,:,4][draw.rand(nB,T)<0.25] = 0
+    else:
+        target[:,:,3][draw.rand(nB,T)<0.1] = 0
+    x,y,cos_r,sin_r,h,w = target[:,:,0],target[:,:,1],torch.cos(target[:,:,2]),torch.sin(target[:,:,2]),target[:,:,3],target[:,:,4]
+    target[:,:,5:13] = torch.stack([x-cos_r*w,y+sin_r*w,x+cos_r*w,y-sin_r*w,x-sin_r*h,y-cos_r*h,x+sin_r*h,y+cos_r*h],dim=2)+draw.randn(nB,T,8)
+    target[:,:,13:] = torch.nn.functional.one_hot(draw.randint(0,nC,(nB,T)),nC).float()
+    lines[:,:,5:] = target[:,:,13:]
+    target_num_neighbors = draw.randint(0,5,(nB,T)).float() if seed%2 else None
+    if case=='empty_batch' and seed%4==3:
+        target = lines = None
+
+    pred_boxes = draw.rand(nB,nA,nH,nW,4)*torch.tensor([nW,nH,5,5]).float()
+    pred_conf = draw.randn(nB,nA,nH,nW)
+    pred_cls = draw.randn(nB,nA,nH,nW,nC)
+    ignore_thres = 0.5 if seed%4 else 0.2
+    args = (pred_boxes,pred_conf,pred_cls,target,target_sizes,anchors[:,:2],nA,nC,nH,nW,ignore_thres,scale)
+
+    cos_r,sin_r,w,h = torch.cos(anchors[:,2]),torch.sin(anchors[:,2]),anchors[:,0],anchors[:,1]
+    anchor_points = torch.stack([-cos_r*w,sin_r*w,cos_r*w,-sin_r*w,-sin_r*h,-cos_r*h,sin_r*h,cos_r*h],dim=1)
+    anchor_hws = (w+h)/2
+    if seed%2 and T>0 and target is not None:
+        #close to a target, so some are correct
+        pred_points = target[0,0,5:13]/scale[0]+draw.randn(nB,nA,nH,nW,8)*0.2
+    else:
+        pred_points = draw.rand(nB,nA,nH,nW,8)*10
+    pred_hws = draw.rand(nB,nA,nH,nW)*4
+    distArgs = (pred_points,pred_hws,pred_conf,pred_cls,target,target_sizes,anchors,anchor_points,anchor_hws,nA,nC,nH,nW,[0.5,3,20][seed%3],[scale[0],scale[0]])
+    lineArgs = (draw.rand(nB,nH,nW,4),pred_conf[:,0],pred_cls[:,0],lines,target_sizes,nH,nW)
+    return {'args':args,'neighbors':target_num_neighbors,'distArgs':distArgs,'lineArgs':lineArgs,'numClasses':nC,'scale':scale}
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('case',CASES)
+def test_build_targets_matches_loop(seed,case):
+    batch = randomTargets(seed,case)
+    args, target_num_neighbors = batch['args'], batch['neighbors']
+    expected = loopBuildTargets(*args,target_num_neighbors=target_num_neighbors)
+    assertSame(expected,build_targets(*args,target_num_neighbors=target_num_neighbors))
+
+def loopBuildTargetsDist(pred_points, pred_hws, pred_conf, pred_cls, target, target_sizes, anchors, anchor_points, anchor_hws, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale):
+    #build_targets_dist as it was
+    nB = pred_points.size(0)
+    nA = num_anchors
+    nC = num_classes
+    nH = grid_sizeH
+    nW = grid_sizeW
+    mask = torch.zeros(nB, nA, nH, nW)
+    conf_mask = torch.ones(nB, nA, nH, nW)
+    tx = torch.zeros(nB, nA, nH, nW)
+    ty = torch.zeros(nB, nA, nH, nW)
+    tw = torch.zeros(nB, nA, nH, nW)
+    th = torch.zeros(nB, nA, nH, nW)
+    tr = torch.zeros(nB, nA, nH, nW)
+    tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
+    tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
+
+    nGT = 0
+    nCorrect = 0
+    for b in range(nB):
+        for t in range(target_sizes[b]):
+            gx = target[b, t, 0] / scale[0]
+            gy = target[b, t, 1] / scale[0]
+            gw = target[b, t, 4] / scale[0]
+            gh = target[b, t, 3] / scale[0]
+            gr = target[b, t, 2]
+            if gw==0 or gh==0:
+                continue
+            nGT += 1
+            gi = max(min(int(gx),conf_mask.size(3)-1),0)
+            gj = max(min(int(gy),conf_mask.size(2)-1),0)
+            gt_points = target[b,t,5:13] / scale[0]
+            gt_points[[0,2,4,6]]-=gx #center the points about the origin instead of BB location
+            gt_points[[1,3,5,7]]-=gy
+            anch_dists = bbox_dist(gt_points, (gh+gw)/2.0, anchor_points, anchor_hws)
+            conf_mask[b, anch_dists < ignore_thres, gj, gi] = 0
+            best_n = np.argmin(anch_dists)
+            gt_points = target[b,t,5:13] / scale[0]
+            pred_point = pred_points[b, best_n, gj, gi]
+            pred_hw = pred_hws[b, best_n, gj, gi]
+            mask[b, best_n, gj, gi] = 1
+            conf_mask[b, best_n, gj, gi] = 1
+            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
+            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
+            rot_diff = gr-anchors[best_n][2]
+            if rot_diff>math.pi:
+                rot_diff-=2*math.pi
+            elif rot_diff<-math.pi:
+                rot_diff+=2*math.pi
+            tr[b, best_n, gj, gi] = inv_tanh(rot_diff/(math.pi/2))
+            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
+            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
+            tcls[b, best_n, gj, gi] = target[b, t,13:]
+            tconf[b, best_n, gj, gi] = 1
+            dist = bbox_dist(gt_points, (gh+gw)/2.0, pred_point, pred_hw)
+            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
+            score = pred_conf[b, best_n, gj, gi]
+            if dist < 0.85 and pred_label == torch.argmax(target[b,t,13:]) and score > 0.0:
+                nCorrect += 1
+    return nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
+
+def loopBuildTargetsLines(self, pred, pred_conf, pred_cls, target, target_sizes, grid_sizeH, grid_sizeW):
+    #LineLoss.build_targets_lines as it was, but with scale taken from self (it was an undefined name)
+    nB = pred.size(0)
+    nC = self.num_classes
+    nH = grid_sizeH
+    nW = grid_sizeW
+    mask = torch.zeros(nB, nH, nW)
+    conf_mask = torch.ones(nB, nH, nW)
+    tx1 = torch.zeros(nB, nH, nW)
+    ty1 = torch.zeros(nB, nH, nW)
+    tx2 = torch.zeros(nB, nH, nW)
+    ty2 = torch.zeros(nB, nH, nW)
+    tconf = torch.ByteTensor(nB, nH, nW).fill_(0)
+    tcls = torch.ByteTensor(nB, nH, nW, nC).fill_(0)
+
+    nGT = 0
+    for b in range(nB):
+        for t in range(target_sizes[b]):
+            scale = self.scale
+            gx1 = target[b, t, 0] / scale[0]
+            gy1 = target[b, t, 1] / scale[1]
+            gx2 = target[b, t, 2] / scale[0]
+            gy2 = target[b, t, 3] / scale[1]
+            gx = (gx1+gx2)/2.0
+            gy = (gy1+gy2)/2.0
+            nGT += 1
+            gi = max(min(int(gx),conf_mask.size(2)-1),0)
+            gj = max(min(int(gy),conf_mask.size(1)-1),0)
+            mask[b, gj, gi] = 1
+            conf_mask[b, gj, gi] = 1
+            tx1[b, gj, gi] = gx1 - (gi+0.5)
+            ty1[b, gj, gi] = gy1 - (gj+0.5)
+            tx2[b, gj, gi] = gx2 - (gi+0.5)
+            ty2[b, gj, gi] = gy2 - (gj+0.5)
+            tcls[b, gj, gi] = target[b, t,5:]
+            tconf[b, gj, gi] = 1
+    return nGT, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('case',CASES)
+def test_build_targets_dist_matches_loop(seed,case):
+    distArgs = randomTargets(seed,case)['distArgs']
+    assertSame(loopBuildTargetsDist(*distArgs),build_targets_dist(*distArgs))
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('case',CASES)
+def test_build_targets_lines_matches_loop(seed,case):
+    batch = randomTargets(seed,case)
+    lineLoss = LineLoss(batch['numClasses'],[batch['scale'][0]]*2,1)
+    lineArgs = batch['lineArgs']
+    assertSame(loopBuildTargetsLines(lineLoss,*lineArgs),lineLoss.build_targets_lines(*lineArgs))
+
+def anchorDicts(sizes,scale):
+    #anchors as the model config has them, and scaled as YoloLoss gives them to build_targets
+    anchors = [{'width':w,'height':h} for w,h in sizes]
+    return anchors, torch.FloatTensor([(a['width'] / scale[0], a['height']/ scale[1]) for a in anchors])
+
+@pytest.mark.parametrize('seed',SEEDS)
+def test_build_targets_with_anchor_assignment(seed):
+    batch = randomTargets(seed)
+    args, target_num_neighbors = list(batch['args']), batch['neighbors']
+    target,scale,ignore_thres = args[3],args[11],args[10]
+    anchors, args[5] = anchorDicts((args[5]*torch.tensor(scale)).round().tolist(),scale)
+    assignment = anchorAssignment(target,anchors,scale,ignore_thres)
+    expected = build_targets(*args,target_num_neighbors=target_num_neighbors)
+    assertSame(expected,build_targets(*args,target_num_neighbors=target_num_neighbors,anchor_assignment=assignment))
+
+def test_yolo_loss_checks_assignment_anchors(capsys):
+    scale = [8,8]
+    anchors,_ = anchorDicts([(20,10),(50,12),(90,20)],scale)
+    #an anchors_file with the same number of anchors, but other sizes
+    otherAnchors,_ = anchorDicts([(90,20),(20,10),(50,12)],scale)
+    gen = torch.Generator().manual_seed(0)
+    prediction = torch.randn(2,3,6,8,8,generator=gen)
+    target = torch.zeros(2,5,15)
+    target[:,:,0] = torch.rand(2,5,generator=gen)*60
+    target[:,:,1] = torch.rand(2,5,generator=gen)*45
+    target[:,:,3] = torch.rand(2,5,generator=gen)*20+2
+    target[:,:,4] = torch.rand(2,5,generator=gen)*80+2
+    target[:,:,13] = 1
+    yolo_loss = YoloLoss(2,False,scale,anchors)
+    expected = yolo_loss(prediction,target,[5,3])
+
+    assert yolo_loss(prediction,target,[5,3],anchor_assignment=anchorAssignment(target,anchors,scale,0.5))==expected
+    assert 'Warning' not in capsys.readouterr().out
+    other = anchorAssignment(target,otherAnchors,scale,0.5)
+    assert not torch.equal(other['best_anchor'],anchorAssignment(target,anchors,scale,0.5)['best_anchor'])
+    assert yolo_loss(prediction,target,[5,3],anchor_assignment=other)==expected
+    assert 'Warning' in capsys.readouterr().out
@@ -0,0 +1,280 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+import numpy as np
+import pytest
+import torch
+
+import utils.yolo_tools
+from utils.yolo_tools import computeAP, computeAPArrays, non_max_sup_iou, non_max_sup_dist, confident_boxes, max_intersection, dist_neg
+from utils.yolo_tools import nativeOps, pairwiseBest, allIOU, allIOU_, allDist, allBoxDistNeg, allBoxDistNeg_, bestIOU, bestBoxDistNeg
+from fixtures import SEEDS, Draws
+
+def loopComputeAP(scores):
+    #computeAP before it was vectorized
+    rank=[]
+    missed=0
+    for conf,rel in scores:
+        if rel:
+            if math.isnan(conf):
+                missed+=1
+            else:
+                better=0
+                equal=-1 # as we'll iterate over this instance here
+                for conf2,rel2 in scores:
+                    if conf2>conf:
+                        better+=1
+                    elif conf2==conf:
+                        equal+=1
+                rank.append(better+math.ceil(equal/2.0))
+    if len(rank)==0:
+        if missed>0:
+            return 0
+        return None
+    rank.sort()
+    ap=0.0
+    for i in range(len(rank)):
+        ap += float(i+1)/(rank[i]+1)
+    ap/=(len(rank)+missed)
+    return ap
+
+def randomScores(seed,case='random'):
+    #sizes up to 400, heavily tied confidences (few levels) and NaNs (missed instances).
+    #The cases fix the size, tie or NaN rate at an edge: no scores, one, all NaN, all tied and nothing relevant
+    draw = Draws(seed)
+    n = {'empty':0,'single':1}.get(case,draw.choice([2,20,100,400]))
+    levels = 1 if case=='all_tied' else draw.choice([2,4,10,None])
+    nanRate = 1 if case=='all_nan' else draw.choice([0,0.1,0.5])
+    relRate = 0 if case=='no_relevant' else draw.choice([0.1,0.5,0.9])
+    conf = draw.rand(n).double()
+    if levels is not None:
+        conf = torch.floor(conf*levels)/levels
+    conf[draw.rand(n)<nanRate] = float('nan')
+    rel = draw.rand(n)<relRate
+    return list(zip(conf.tolist(),rel.tolist()))
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('case',['random','empty','single','all_nan','all_tied','no_relevant'])
+def test_compute_ap_matches_loop(seed,case):
+    scores = randomScores(seed,case)
+    expected = loopComputeAP(scores)
+    assert computeAP(scores)==expected
+    conf = np.array([c for c,r in scores],dtype=np.float64)
+    rel = np.array([r for c,r in scores],dtype=bool)
+    assert computeAPArrays(conf,rel)==expected
+
+def test_compute_ap_ties():
+    #a relevant instance tied with two others is ranked as if one of them were ahead (ceil(2/2))
+    assert computeAP([(0.5,True),(0.5,False),(0.5,False)])==loopComputeAP([(0.5,True),(0.5,False),(0.5,False)])==0.5
+    #tied with one: ceil(1/2) also puts one ahead
+    assert computeAP([(0.5,True),(0.5,False)])==0.5
+
+def test_compute_ap_missed():
+    #relevant instances with a NaN score count in the denominator only
+    assert computeAP([(0.9,True),(float('nan'),True)])==0.5
+    assert computeAP([(float('nan'),True),(0.3,False)])==0
+    assert computeAP([(float('nan'),False),(0.3,False)]) is None
+    assert computeAP([]) is None
+
+def loopNonMaxSup(pred_boxes,thresh_conf,thresh_loc,loc_metric,hard_limit):
+    #non_max_sup_ before it was batched (loc_metric compares one box against a list of them)
+    to_return=[]
+    for b in range(pred_boxes.shape[0]):
+        above_thresh = []
+        for i in range(pred_boxes.shape[1]):
+            if pred_boxes[b,i,0]>thresh_conf:
+                above_thresh.append( (pred_boxes[b,i,0], i) )
+        above_thresh.sort(key=lambda a: a[0], reverse=True)
+        above_thresh = above_thresh[:hard_limit]
+        li = 0
+        while li<len(above_thresh)-1:
+            i=above_thresh[li][1]
+            loc_measures = loc_metric(pred_boxes[b,i,1:6],pred_boxes[b,[x[1] for x in above_thresh[li+1:]],1:6])
+            to_remove=[]
+            for lj in range(len(above_thresh)-1,li,-1):
+                if loc_measures[lj-(li+1)] > thresh_loc:
+                    to_remove.append(lj)
+            for index in to_remove:
+                del above_thresh[index]
+            li+=1
+        to_return.append(pred_boxes[b,[x[1] for x in above_thresh],:])
+    return to_return
+
+def randomPredictions(seed,levels):
+    #[batch,instances,(conf,x,y,r,h,w,class)], the confidences drawn from a few levels when levels is given, so many tie
+    draw = Draws(seed)
+    batchSize,numBoxes = 3,60
+    conf = draw.rand(batchSize,numBoxes)
+    if levels is not None:
+        conf = torch.floor(conf*levels)/levels
+    #the last image has nothing above the threshold
+    conf[-1] = conf[-1]*0.4
+    x = draw.rand(batchSize,numBoxes)*200
+    y = draw.rand(batchSize,numBoxes)*200
+    r = (draw.rand(batchSize,numBoxes)-0.5)*0.4
+    h = draw.rand(batchSize,numBoxes)*20+2
+    w = draw.rand(batchSize,numBoxes)*40+2
+    cls = draw.rand(batchSize,numBoxes)
+    return torch.stack((conf,x,y,r,h,w,cls),dim=2)
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('levels',[None,4])
+@pytest.mark.parametrize('hard_limit',[300,10])
+def test_non_max_sup_matches_loop(seed,levels,hard_limit):
+    pred_boxes = randomPredictions(seed,levels)
+    for nms,loc_metric,thresh_loc in [(non_max_sup_iou,max_intersection,0.5),(non_max_sup_dist,dist_neg,-0.9)]:
+        if nms is non_max_sup_iou:
+            kept = nms(pred_boxes,0.5,thresh_loc,hard_limit)
+        else:
+            kept = nms(pred_boxes,0.5,-thresh_loc,hard_limit)
+        expected = loopNonMaxSup(pred_boxes,0.5,thresh_loc,loc_metric,hard_limit)
+        assert len(kept)==len(expected)
+        for b in range(len(expected)):
+            assert torch.equal(kept[b],expected[b])
+        assert kept[-1].size(0)==0
+
+def test_non_max_sup_ties_keep_index_order():
+    #three identical boxes of the same confidence: the first one suppresses the others
+    box = [0.7,50,50,0,10,20,0]
+    far = [0.7,500,500,0,10,20,1]
+    pred_boxes = torch.tensor([[far,box,box,box]])
+    for nms in (non_max_sup_iou,non_max_sup_dist):
+        kept = nms(pred_boxes,0.5)[0]
+        assert torch.equal(kept,pred_boxes[0,:2])
+        #the hard limit cuts the ties by index too
+        assert torch.equal(nms(pred_boxes,0.5,hard_limit=1)[0],pred_boxes[0,:1])
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('levels',[None,4])
+@pytest.mark.parametrize('hard_limit',[300,10,1])
+def test_confident_boxes_keep_nms_result(seed,levels,hard_limit):
+    #the pre-filter as the trainers and PairingGraph run it, against NMS of all the predictions
+    pred_boxes = randomPredictions(seed,levels)
+    for nms,thresh_loc in [(non_max_sup_iou,0.4),(non_max_sup_dist,2.5)]:
+        for thresh_conf in [0.5,0.9,1.0]:
+            expected = nms(pred_boxes,thresh_conf,thresh_loc,hard_limit)
+            kept = nms(confident_boxes(pred_boxes,thresh_conf,hard_limit),thresh_conf,thresh_loc,hard_limit)
+            assert len(kept)==len(expected)
+            for b in range(len(expected)):
+                assert torch.equal(kept[b],expected[b])
+
+def test_confident_boxes_pads_and_breaks_ties_by_index():
+    pred_boxes = torch.tensor([[[0.6,1],[0.9,2],[0.6,3],[0.2,4],[0.6,5]],
+                               [[0.1,1],[0.7,2],[0.3,3],[0.2,4],[0.1,5]]])
+    best = confident_boxes(pred_boxes,0.5,hard_limit=2)
+    #the two most confident, the tie going to the lower index, in their original order
+    assert torch.equal(best[0],pred_boxes[0,:2])
+    #padded with -inf confidence
+    assert torch.equal(best[1,0],pred_boxes[1,1]) and best[1,1,0]==-float('inf')
+    assert confident_boxes(pred_boxes,0.95).size()==(2,0,2)
+
+def randomBoxes(draw,n):
+    #[n,(x,y,r,h,w)], close enough that many overlap
+    boxes = draw.rand(n,5)
+    boxes[:,:2] *= 100
+    boxes[:,2] = (boxes[:,2]-0.5)*0.4
+    boxes[:,3] = boxes[:,3]*20+2
+    boxes[:,4] = boxes[:,4]*40+2
+    return boxes
+
+#the numbers of boxes2 per block the budgets below give: one per block, blocks not dividing them evenly,
+#one short of all of them, all of them and no limit
+BLOCKS = [1,3,10,29,30,None]
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('block',BLOCKS)
+def test_pairwise_best_matches_full_matrix(seed,block):
+    draw = Draws(seed)
+    boxes1 = randomBoxes(draw,7)
+    boxes2 = randomBoxes(draw,30)
+    budget = None if block is None else block*boxes1.size(0)*64*boxes1.element_size()
+    #rounded, so there are ties for the first index to break
+    for getLoc in [lambda b1,b2: (allIOU_(b1,b2,[0,1,4,3])*10).round(), allBoxDistNeg_]:
+        full = getLoc(boxes1,boxes2)
+        for dim in [0,1]:
+            for largest in [True,False]:
+                expected = full.max(dim=dim) if largest else full.min(dim=dim)
+                value,index = pairwiseBest(getLoc,boxes1,boxes2,dim,largest,budget)
+                assert torch.equal(value,expected[0]) and torch.equal(index,expected[1]), (dim,largest)
+
+@pytest.mark.parametrize('seed',SEEDS)
+@pytest.mark.parametrize('block',BLOCKS)
+def test_best_and_blocked_pairwise_match_full_matrix(seed,block,monkeypatch):
+    draw = Draws(seed)
+    boxes1 = randomBoxes(draw,7)
+    boxes2 = randomBoxes(draw,30)
+    fullIOU = allIOU(boxes1,boxes2)
+    fullDist = allDist(boxes1,boxes2)
+    fullBoxDist = allBoxDistNeg(boxes1,boxes2)
+    #the budgets are per pair of boxes, the blocks of bestIOU and bestBoxDistNeg follow those of pairwiseBest
+    monkeypatch.setattr(utils.yolo_tools,'pairwise_memory_budget',None if block is None else block*boxes1.size(0)*64*boxes1.element_size())
+    for dim in [0,1]:
+        for best,full in [(bestIOU,fullIOU),(bestBoxDistNeg,fullBoxDist)]:
+            value,index = best(boxes1,boxes2,dim)
+            expected = full.max(dim=dim)
+            assert torch.allclose(value,expected[0]) and torch.equal(index,expected[1]), (best,dim)
+    if block is not None:
+        monkeypatch.setattr(utils.yolo_tools,'pairwise_memory_budget',block*boxes1.size(0)*4*boxes1.element_size())
+    assert torch.equal(allDist(boxes1,boxes2),fullDist)
+    if block is not None:
+        monkeypatch.setattr(utils.yolo_tools,'pairwise_memory_budget',block*boxes1.size(0)*12*boxes1.element_size())
+    assert torch.equal(allIOU(boxes1,boxes2),fullIOU)
+
+def nativeKernels():
+    native = nativeOps()
+    if native is None:
+        pytest.skip('model._C is not built with the box kernels (python setup.py build develop)')
+    return native
+
+@pytest.mark.parametrize('seed',SEEDS)
+def test_native_best_kernels_match_torch(seed):
+    native = nativeKernels()
+    draw = Draws(seed)
+    boxes1 = randomBoxes(draw,20)
+    boxes2 = randomBoxes(draw,45)
+    #repeated boxes, so the best is tied and the first index has to be kept
+    boxes2[30:] = boxes2[:15]
+    boxes1[10:] = boxes1[:10]
+    assert torch.allclose(native.box_dist_neg(boxes1,boxes2),allBoxDistNeg_(boxes1,boxes2),rtol=1e-5)
+    for dim in [0,1]:
+        value,index = native.box_dist_neg_best(boxes1,boxes2,dim)
+        expected = pairwiseBest(allBoxDistNeg_,boxes1,boxes2,dim)
+        assert torch.allclose(value,expected[0],rtol=1e-5) and torch.equal(index,expected[1]), dim
+        #the layout of boxes1 (x,y,half width,half height columns) as YoloLoss and getTargIndexForPreds use it
+        for boxes1XYWH in [[0,1,4,3],[0,1,2,3]]:
+            value,index = native.iou_best(boxes1,boxes2,dim,*boxes1XYWH)
+            expected = pairwiseBest(lambda b1,b2: allIOU_(b1,b2,boxes1XYWH),boxes1,boxes2,dim)
+            assert torch.allclose(value,expected[0],atol=1e-6) and torch.equal(index,expected[1]), (dim,boxes1XYWH)
+
+@pytest.mark.skipif(not torch.cuda.is_available(),reason='needs CUDA')
+def test_native_callers_fall_back_to_torch_on_the_gpu():
+    #the kernels throw on CUDA tensors, every caller has to use the torch version for them
+    draw = Draws(0)
+    pred_boxes = randomPredictions(0,4)
+    boxes1 = randomBoxes(draw,20)
+    boxes2 = randomBoxes(draw,45)
+    for nms in (non_max_sup_iou,non_max_sup_dist):
+        kept = nms(pred_boxes.cuda(),0.5)
+        expected = nms(pred_boxes,0.5)
+        assert len(kept)==len(expected)
+        for b in range(len(expected)):
+            assert kept[b].is_cuda and torch.allclose(kept[b].cpu(),expected[b])
+    assert torch.allclose(allBoxDistNeg(boxes1.cuda(),boxes2.cuda()).cpu(),allBoxDistNeg(boxes1,boxes2),rtol=1e-4)
+    for dim in [0,1]:
+        for best in (bestIOU,bestBoxDistNeg):
+            value,index = best(boxes1.cuda(),boxes2.cuda(),dim)
+            expected = best(boxes1,boxes2,dim)
+            assert torch.allclose(value.cpu(),expected[0],rtol=1e-4) and torch.equal(index.cpu(),expected[1])
@@ -20,7 +20,7 @@ import timeit
 from utils import util
 from collections import defaultdict
 from evaluators import FormsBoxDetect_printer
-from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist
+from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, confident_boxes
 from datasets.testforms_box import display
 
 
@@ -192,10 +192,11 @@ class BoxDetectTrainer(BaseTrainer):
         #    this_loss, position_loss, conf_loss, class_loss, recall, precision = lossC
         #else:
         data, targetBoxes, targetBoxes_sizes, targetLines, targetLines_sizes, targetPoints, targetPoints_sizes, targetPixels,target_num_neighbors = self._to_tensor(thisInstance)
+        anchorAssignment = thisInstance['anchor_assignment'] if 'anchor_assignment' in thisInstance else None
         outputBoxes, outputOffsets, outputLines, outputOffsetLines, outputPoints, outputPixels = self.model(data)
 
         if 'box' in self.loss:
-            this_loss, position_loss, conf_loss, class_loss, nn_loss, recall, precision = self.loss['box'](outputOffsets,targetBoxes,targetBoxes_sizes,target_num_neighbors)
+            this_loss, position_loss, conf_loss, class_loss, nn_loss, recall, precision = self.loss['box'](outputOffsets,targetBoxes,targetBoxes_sizes,target_num_neighbors,anchorAssignment)
 
             this_loss*=self.loss_weight['box']
             loss+=this_loss
@@ -336,6 +337,7 @@ class BoxDetectTrainer(BaseTrainer):
                 if not self.model.predNumNeighbors:
                     del instance['num_neighbors']
                 data, targetBoxes, targetBoxes_sizes, targetLines, targetLines_sizes, targetPoints, targetPoints_sizes, targetPixels,target_num_neighbors = self._to_tensor(instance)
+                anchorAssignment = instance['anchor_assignment'] if 'anchor_assignment' in instance else None
                 batchSize = data.size(0)
                 #print('data: {}'.format(data.size()))
                 outputBoxes,outputOffsets, outputLines, outputOffsetsLines, outputPoints, outputPixels = self.model(data)
@@ -344,7 +346,7 @@ class BoxDetectTrainer(BaseTrainer):
                 index=0
                 
                 if 'box' in self.loss:
-                    this_loss, position_loss, conf_loss, class_loss, nn_loss, recall, precision = self.loss['box'](outputOffsets,targetBoxes,targetBoxes_sizes,target_num_neighbors)
+                    this_loss, position_loss, conf_loss, class_loss, nn_loss, recall, precision = self.loss['box'](outputOffsets,targetBoxes,targetBoxes_sizes,target_num_neighbors,anchorAssignment)
                     loss+=this_loss*self.loss_weight['box']
                     total_position_loss+=position_loss
                     total_conf_loss+=conf_loss
@@ -354,9 +356,9 @@ class BoxDetectTrainer(BaseTrainer):
                 
                     threshConf = max(self.thresh_conf*outputBoxes[:,:,0].max().item(),0.5)
                     if self.model.rotation:
-                        outputBoxes = non_max_sup_dist(outputBoxes.cpu(),threshConf,1.2/self.thresh_intersect)
+                        outputBoxes = non_max_sup_dist(confident_boxes(outputBoxes,threshConf).cpu(),threshConf,1.2/self.thresh_intersect)
                     else:
-                        outputBoxes = non_max_sup_iou(outputBoxes.cpu(),threshConf,self.thresh_intersect)
+                        outputBoxes = non_max_sup_iou(confident_boxes(outputBoxes,threshConf).cpu(),threshConf,self.thresh_intersect)
                     if targetBoxes is not None:
                         targetBoxes = targetBoxes.cpu()
                     for b in range(batchSize):
@@ -20,7 +20,8 @@ import timeit
 from utils import util
 from collections import defaultdict
 from evaluators import FormsBoxDetect_printer
-from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, getTargIndexForPreds_dist, computeAP
+from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, getTargIndexForPreds_dist, computeAPArrays
+from utils.graph_tools import pairsInAdj
 from datasets.testforms_graph_pair import display
 import random
 
@@ -188,6 +189,7 @@ class GraphPairTrainer(BaseTrainer):
         else:
             threshIntur = None
         image, targetBoxes, adj, target_num_neighbors = self._to_tensor(thisInstance)
+        anchorAssignment = thisInstance['anchor_assignment'] if 'anchor_assignment' in thisInstance else None
         useGT = self.useGT(iteration)
         if useGT:
             outputBoxes, outputOffsets, relPred, relIndexes, bbPred = self.model(image,targetBoxes,target_num_neighbors,True,
@@ -305,7 +307,7 @@ class GraphPairTrainer(BaseTrainer):
             else:
                 targSize =0 
             #import pdb;pdb.set_trace()
-            boxLoss, position_loss, conf_loss, class_loss, nn_loss, recall, precision = self.loss['box'](outputOffsets,targetBoxes,[targSize],target_num_neighbors)
+            boxLoss, position_loss, conf_loss, class_loss, nn_loss, recall, precision = self.loss['box'](outputOffsets,targetBoxes,[targSize],target_num_neighbors,anchorAssignment)
             boxLoss *= self.lossWeights['box']
             if relLoss is not None:
                 loss = relLoss + boxLoss
@@ -472,8 +474,9 @@ class GraphPairTrainer(BaseTrainer):
                     print('iter:{} valid batch: {}/{}'.format(self.iteration,batch_idx,len(self.valid_data_loader)), end='\r')
 
                 image, targetBoxes, adjM, target_num_neighbors = self._to_tensor(instance)
+                anchorAssignment = instance['anchor_assignment'] if 'anchor_assignment' in instance else None
 
-                outputBoxes, outputOffsets, relPred, relIndexes, bbPred, = self.model(image, hard_detect_limit=self.val_hard_detect_limit)
+                outputBoxes, outputOffsets, relPred, relIndexes, bbPred, = self.model(image, hard_detect_limit=self.val_hard_detect_limit, imageName=instance['imgName'])
                 #loss = self.loss(output, target)
                 loss = 0
                 index=0
@@ -500,7 +503,7 @@ class GraphPairTrainer(BaseTrainer):
                 #else:
                 #    relLoss = relLoss.cpu()
                 if not self.model.detector_frozen:
-                    boxLoss, position_loss, conf_loss, class_loss, nn_loss, recallX, precisionX = self.loss['box'](outputOffsets,targetBoxes,[targetBoxes.size(1)],target_num_neighbors)
+                    boxLoss, position_loss, conf_loss, class_loss, nn_loss, recallX, precisionX = self.loss['box'](outputOffsets,targetBoxes,[targetBoxes.size(1)],target_num_neighbors,anchorAssignment)
                     loss = relLoss*self.lossWeights['rel'] + boxLoss*self.lossWeights['box']
                 else:
                     boxLoss=torch.tensor(0.0)
@@ -674,51 +677,43 @@ class GraphPairTrainer(BaseTrainer):
 
         #Create gt vector to match relPred.values()
 
-        rels = relIndexes #relPred._indices().cpu()
+        rels = torch.LongTensor(relIndexes).view(-1,2) #relPred._indices().cpu()
         predsAll = relPred #relPred._values()
-        sigPredsAll = torch.sigmoid(predsAll[:,-1])
-        predsPos = []
-        predsNeg = []
-        scores = []
-        matches=0
-        truePred=falsePred=badPred=0
-        for i,(n0,n1) in enumerate(rels):
-            t0 = targIndex[n0].item()
-            t1 = targIndex[n1].item()
-            if t0>=0 and t1>=0:
-                if (min(t0,t1),max(t0,t1)) in adj:
-                    #if self.useBadBBPredForRelLoss!='fixed' or (fullHit[n0] and fullHit[n1]):
-                    if fullHit[n0] and fullHit[n1]:
-                        matches+=1
-                        predsPos.append(predsAll[i])
-                        scores.append( (sigPredsAll[i],True) )
-                        if sigPredsAll[i]>self.thresh_rel:
-                            truePred+=1
-                    else:
-                        scores.append( (sigPredsAll[i],False) ) #for the sake of scoring, this is a bad relationship
-                else:
-                    predsNeg.append(predsAll[i])
-                    scores.append( (sigPredsAll[i],False) )
-                    if sigPredsAll[i]>self.thresh_rel:
-                        falsePred+=1
+        sigPredsAll = torch.sigmoid(predsAll[:,-1]).detach().cpu()
+        above = sigPredsAll>self.thresh_rel
+
+        #the targets each rel's boxes are aligned to
+        t0 = targIndex[rels[:,0]]
+        t1 = targIndex[rels[:,1]]
+        aligned = (t0>=0) & (t1>=0)
+        inAdj = aligned & pairsInAdj(torch.stack((torch.min(t0,t1),torch.max(t0,t1)),dim=1),adj)
+        #if self.useBadBBPredForRelLoss!='fixed' or (fullHit[n0] and fullHit[n1]):
+        hit = fullHit.cpu().bool()
+        pos = inAdj & hit[rels[:,0]] & hit[rels[:,1]] #otherwise, for the sake of scoring, this is a bad relationship
+        neg = aligned & ~inAdj
+        bad = ~aligned
+        matches = pos.sum().item()
+        truePred = (pos&above).sum().item()
+        falsePred = (neg&above).sum().item()
+        badPred = (bad&above).sum().item()
+        #if self.useBadBBPredForRelLoss=='fixed' or (self.useBadBBPredForRelLoss and (predsWithNoIntersection[n0] or predsWithNoIntersection[n1])):
+        if self.useBadBBPredForRelLoss:
+            if self.useBadBBPredForRelLoss=='full':
+                neg = neg | bad
             else:
-                #if self.useBadBBPredForRelLoss=='fixed' or (self.useBadBBPredForRelLoss and (predsWithNoIntersection[n0] or predsWithNoIntersection[n1])):
-                if self.useBadBBPredForRelLoss:
-                    if self.useBadBBPredForRelLoss=='full' or np.random.rand()<self.useBadBBPredForRelLoss:
-                        predsNeg.append(predsAll[i])
-                scores.append( (sigPredsAll[i],False) )
-                if sigPredsAll[i]>self.thresh_rel:
-                    badPred+=1
-        #Add score 0 for instances we didn't predict
-        for i in range(len(adj)-matches):
-            scores.append( (float('nan'),True) )
+                neg[bad] = torch.from_numpy(np.random.rand(bad.sum().item())<self.useBadBBPredForRelLoss)
+
+        #Add score nan for instances we didn't predict
+        numMissed = max(len(adj)-matches,0)
+        scoreConf = np.concatenate((sigPredsAll.numpy(),np.full(numMissed,float('nan'))))
+        scoreRel = np.concatenate((pos.numpy(),np.ones(numMissed,dtype=bool)))
     
-        if len(predsPos)>0:
-            predsPos = torch.stack(predsPos).to(relPred.device)
+        if matches>0:
+            predsPos = predsAll[pos.to(relPred.device)]
         else:
             predsPos = None
-        if len(predsNeg)>0:
-            predsNeg = torch.stack(predsNeg).to(relPred.device)
+        if neg.any():
+            predsNeg = predsAll[neg.to(relPred.device)]
         else:
             predsNeg = None
 
@@ -734,7 +729,7 @@ class GraphPairTrainer(BaseTrainer):
             fullPrec = truePred/(truePred+falsePred+badPred)
         else:
             fullPrec = 1
-        return predsPos,predsNeg, recall, prec ,fullPrec, computeAP(scores), targIndex, fullHit
+        return predsPos,predsNeg, recall, prec ,fullPrec, computeAPArrays(scoreConf,scoreRel), targIndex, fullHit
 
 
     def prealignedEdgePred(self,adj,relPred,relIndexes):
@@ -749,38 +744,23 @@ class GraphPairTrainer(BaseTrainer):
             prec=1
 
             return torch.tensor([]),torch.tensor([]),recall,prec,prec,ap
-        rels = relIndexes #relPred._indices().cpu().t()
+        rels = torch.LongTensor(relIndexes).view(-1,2) #relPred._indices().cpu().t()
         predsAll = relPred
-        sigPredsAll = torch.sigmoid(predsAll[:,-1])
-
-        #gt = torch.empty(len(rels))#rels.size(0))
-        predsPos = []
-        predsNeg = []
-        scores = []
-        truePred=falsePred=0
-        for i,(n0,n1) in enumerate(rels):
-            #n0 = rels[i,0]
-            #n1 = rels[i,1]
-            #gt[i] = int((n0,n1) in adj) #(adjM[ n0, n1 ])
-            if (n0,n1) in adj:
-                predsPos.append(predsAll[i])
-                scores.append( (sigPredsAll[i],True) )
-                if sigPredsAll[i]>self.thresh_rel:
-                    truePred+=1
-            else:
-                predsNeg.append(predsAll[i])
-                scores.append( (sigPredsAll[i],False) )
-                if sigPredsAll[i]>self.thresh_rel:
-                    falsePred+=1
+        sigPredsAll = torch.sigmoid(predsAll[:,-1]).detach().cpu()
+        above = sigPredsAll>self.thresh_rel
+
+        pos = pairsInAdj(rels,adj)
+        truePred = (pos&above).sum().item()
+        falsePred = (~pos&above).sum().item()
     
         #return gt.to(relPred.device), relPred._values().view(-1).view(-1)
         #return gt.to(relPred[1].device), relPred[1].view(-1)
-        if len(predsPos)>0:
-            predsPos = torch.stack(predsPos).to(relPred.device)
+        if pos.any():
+            predsPos = predsAll[pos.to(relPred.device)]
         else:
             predsPos = None
-        if len(predsNeg)>0:
-            predsNeg = torch.stack(predsNeg).to(relPred.device)
+        if not pos.all():
+            predsNeg = predsAll[~pos.to(relPred.device)]
         else:
             predsNeg = None
         if len(adj)>0:
@@ -791,4 +771,4 @@ class GraphPairTrainer(BaseTrainer):
             prec = truePred/(truePred+falsePred)
         else:
             prec = 1
-        return predsPos,predsNeg, recall, prec, prec, computeAP(scores)
+        return predsPos,predsNeg, recall, prec, prec, computeAPArrays(sigPredsAll.numpy(),pos.numpy())
@@ -0,0 +1,97 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import pickle
+import hashlib
+import logging
+from collections import OrderedDict
+import torch
+from utils.util import ensure_dir
+
+
+class GraphCache(object):
+    """
+    LRU cache of the graph structure (candidate relationships, RoIs and edges) built for a set of boxes.
+    Evaluation often builds the graph for the same boxes again (saved detections, GT boxes,
+    several checkpoints), this lets those runs skip it.
+    Entries are kept in memory, and also written to cacheDir (if given) so later runs can reuse them.
+    At most maxEntries are kept in each, the least recently used are dropped first.
+    """
+
+    def __init__(self,maxEntries,cacheDir=None):
+        self.maxEntries=maxEntries
+        self.cacheDir=cacheDir
+        self.entries=OrderedDict()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #index of the entries on disk, least recently used first. The directory is only listed here
+        self.diskEntries=OrderedDict()
+        if cacheDir is not None:
+            ensure_dir(cacheDir)
+            files = [f for f in os.listdir(cacheDir) if f.endswith('.pt')]
+            files.sort(key=lambda f: os.path.getmtime(os.path.join(cacheDir,f)))
+            for f in files:
+                self.diskEntries[f[:-3]]=None
+
+    @staticmethod
+    def key(imageName,bbs,imageHeight,imageWidth,*settings):
+        """
+        imageName can be None, bbs are the box geometry (x,y,r,h,w); settings are anything else the graph depends on.
+        """
+        h = hashlib.sha1(bbs.detach().cpu().contiguous().numpy().tobytes())
+        h.update(repr((imageName,tuple(bbs.size()),imageHeight,imageWidth)+settings).encode())
+        return h.hexdigest()
+
+    def _path(self,key):
+        return os.path.join(self.cacheDir,key+'.pt')
+
+    def get(self,key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if key in self.diskEntries:
+            try:
+                value = torch.load(self._path(key))
+            except (OSError,EOFError,RuntimeError,pickle.UnpicklingError) as e:
+                #removed, partially written or from an incompatible version, it will be rebuilt
+                self.logger.warning('Could not load graph cache entry {}: {}'.format(self._path(key),e))
+                del self.diskEntries[key]
+                return None
+            os.utime(self._path(key)) #mark as recently used for later runs
+            self.diskEntries.move_to_end(key)
+            self._remember(key,value)
+            return value
+        return None
+
+    def put(self,key,value):
+        self._remember(key,value)
+        if self.cacheDir is not None:
+            tmpPath = self._path(key)+'.tmp'
+            torch.save(value,tmpPath)
+            os.replace(tmpPath,self._path(key))
+            self.diskEntries[key]=None
+            self.diskEntries.move_to_end(key)
+            while len(self.diskEntries)>self.maxEntries:
+                oldKey,_ = self.diskEntries.popitem(last=False)
+                try:
+                    os.remove(self._path(oldKey))
+                except FileNotFoundError:
+                    pass #another run already removed it
+
+    def _remember(self,key,value):
+        self.entries[key]=value
+        self.entries.move_to_end(key)
+        while len(self.entries)>self.maxEntries:
+            self.entries.popitem(last=False)
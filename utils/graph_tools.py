@@ -0,0 +1,345 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import torch
+import numpy as np
+import math
+
+#Batched geometry used by PairingGraph.createGraph. Everything stays on the device of the boxes.
+#Corners are kept as two [N,4] tensors (x and y) in the order tl, tr, br, bl.
+
+MASK_WINDOW_PIXELS=2**20 #pixels rasterized at once by occupancyMask
+
+def pairRois(cornersX,cornersY,indexes,context,imageHeight,imageWidth):
+    """
+    Axis aligned rectangle around both boxes of each candidate, padded by context and clipped to the image.
+    indexes is a [E,2] LongTensor of box indexes.
+    Returns [E,5] (batchIndex,x1,y1,x2,y2) as expected by ROI Align
+    """
+    xs = torch.cat((cornersX[indexes[:,0]],cornersX[indexes[:,1]]),dim=1)
+    ys = torch.cat((cornersY[indexes[:,0]],cornersY[indexes[:,1]]),dim=1)
+    minX = xs.min(dim=1)[0]
+    maxX = xs.max(dim=1)[0]
+    minY = ys.min(dim=1)[0]
+    maxY = ys.max(dim=1)[0]
+    if context is not None:
+        maxX = torch.clamp(maxX+context,max=imageWidth-1)
+        minX = torch.clamp(minX-context,min=0)
+        maxY = torch.clamp(maxY+context,max=imageHeight-1)
+        minY = torch.clamp(minY-context,min=0)
+    return torch.stack((torch.zeros_like(minX),minX,minY,maxX,maxY),dim=1)
+
+def boxRois(cornersX,cornersY,context,imageHeight,imageWidth):
+    """
+    Rounded axis aligned rectangle around each box, padded by context and clipped to the image.
+    Returns [N,5] (batchIndex,x1,y1,x2,y2) as expected by ROI Align
+    """
+    minX = torch.round(cornersX.min(dim=1)[0])
+    maxX = torch.round(cornersX.max(dim=1)[0])
+    minY = torch.round(cornersY.min(dim=1)[0])
+    maxY = torch.round(cornersY.max(dim=1)[0])
+    if context is not None:
+        maxX = torch.clamp(maxX+context,max=imageWidth-1)
+        minX = torch.clamp(minX-context,min=0)
+        maxY = torch.clamp(maxY+context,max=imageHeight-1)
+        minY = torch.clamp(minY-context,min=0)
+    return torch.stack((torch.zeros_like(minX),minX,minY,maxX,maxY),dim=1)
+
+def rasterizePolygons(vertsY,vertsX,height,width):
+    """
+    Batched skimage.draw.polygon: [B,height,width] masks (float, 1 inside) for [B,V] vertex tensors.
+    Each pixel is tested against the edges the same way skimage does (O'Rourke's crossing test,
+    with pixels on an edge or vertex counting as inside), just all pixels and polygons at once.
+    """
+    vertsY = vertsY.double()
+    vertsX = vertsX.double()
+    ys = torch.arange(height,dtype=torch.float64,device=vertsY.device)[None,:,None]
+    xs = torch.arange(width,dtype=torch.float64,device=vertsX.device)[None,None,:]
+    numVerts = vertsY.size(1)
+    #pixels right on a vertex count as inside
+    onVertex = torch.zeros(vertsY.size(0),height,width,dtype=torch.bool,device=vertsY.device)
+    vX = torch.round(vertsX)
+    vY = torch.round(vertsY)
+    exact = ((vertsX-vX).abs()<1e-12) & ((vertsY-vY).abs()<1e-12) & (vX>=0) & (vX<width) & (vY>=0) & (vY<height)
+    poly,vert = torch.nonzero(exact,as_tuple=True)
+    onVertex[poly,vY[poly,vert].long(),vX[poly,vert].long()] = True
+    rCross = torch.zeros_like(onVertex)
+    lCross = torch.zeros_like(onVertex)
+    x1 = vertsX[:,numVerts-1,None,None]-xs
+    y1 = vertsY[:,numVerts-1,None,None]-ys
+    for i in range(numVerts):
+        x0 = vertsX[:,i,None,None]-xs
+        y0 = vertsY[:,i,None,None]-ys
+        #only the sign of the crossing (x0*y1 - x1*y0)/(y1-y0) matters, so multiply by the sign of y1-y0 rather than divide
+        cross = (x0*y1 - x1*y0)*torch.sign(y1-y0)
+        rCross ^= ((y0>0)!=(y1>0)) & (cross>0)
+        lCross ^= ((y0<0)!=(y1<0)) & (cross<0)
+        x1 = x0
+        y1 = y0
+    return (onVertex | rCross | lCross).float()
+
+def occupancyMask(cornersX,cornersY,imageHeight,imageWidth,fill,device):
+    """
+    Page sized mask of every box (rasterized as skimage.draw.polygon would, see rasterizePolygons),
+    built on device as a [1,1,imageHeight,imageWidth] float tensor so it can be pooled with ROI Align.
+    Each box is only rasterized over a window around it, and boxes with similar sized windows are
+    done together. If fill is False the mask is left empty.
+    """
+    mask = torch.zeros(imageHeight,imageWidth,device=device)
+    if fill and cornersX.size(0)>0:
+        cornersX = cornersX.detach().to(device).double()
+        cornersY = cornersY.detach().to(device).double()
+        #the pixels skimage tests: the bounding box of the polygon, clipped to the page
+        x0 = cornersX.min(dim=1)[0].floor().clamp(0,imageWidth-1)
+        y0 = cornersY.min(dim=1)[0].floor().clamp(0,imageHeight-1)
+        x1 = cornersX.max(dim=1)[0].ceil().clamp(0,imageWidth-1)
+        y1 = cornersY.max(dim=1)[0].ceil().clamp(0,imageHeight-1)
+        winW = (x1-x0).long()+1
+        winH = (y1-y0).long()+1
+        order = torch.argsort(winW*winH)
+        sizes = (winW*winH)[order].tolist()
+        start=0
+        while start<len(sizes):
+            #each window in a chunk is the size of the biggest (last) one
+            end=start+1
+            while end<len(sizes) and sizes[end]*(end+1-start)<=MASK_WINDOW_PIXELS:
+                end+=1
+            boxes = order[start:end]
+            height = winH[boxes].max().item()
+            width = winW[boxes].max().item()
+            #the offsets are whole pixels, so the vertices stay exact
+            inside = rasterizePolygons(cornersY[boxes]-y0[boxes,None],cornersX[boxes]-x0[boxes,None],height,width)>0
+            box,row,col = torch.nonzero(inside,as_tuple=True)
+            row = row+y0[boxes][box].long()
+            col = col+x0[boxes][box].long()
+            onPage = (row<imageHeight) & (col<imageWidth)
+            mask[row[onPage],col[onPage]] = 1
+            start = end
+    return mask[None,None]
+def maskRois(rois):
+    """
+    The RoIs rounded to whole pixels and grown by half a pixel on each side. Pooling the occupancy
+    mask over these with one sample per bin gives the same values as bilinearly resizing the
+    inclusive crop of the mask.
+    """
+    return torch.round(rois) + rois.new_tensor([0,-0.5,-0.5,0.5,0.5])
+
+def pairShapeFeats(bbs,cornersX,cornersY,indexes,ixs,numShapeFeats,numBBTypes,extraPred,normalizeVert,normalizeHorz,normalizeDist,cornerFeats,positionFeature,imageHeight,imageWidth):
+    """
+    Shape features of every candidate pair, [E,numShapeFeats].
+    indexes is a [E,2] LongTensor of (index1,index2) box indexes.
+    ixs gives where the size, rotation, class and offset features go (the layout depends on the pairer).
+    cornerFeats adds the distances between matching corners, positionFeature ('absolute' or other) the box positions.
+    """
+    bbs1 = bbs[indexes[:,0]]
+    bbs2 = bbs[indexes[:,1]]
+    shapeFeats = torch.zeros(indexes.size(0),numShapeFeats,device=bbs.device)
+    shapeFeats[:,ixs[0]] = 2*bbs1[:,3]/normalizeVert #bb preds half height/width
+    shapeFeats[:,ixs[1]] = 2*bbs1[:,4]/normalizeHorz
+    shapeFeats[:,ixs[2]] = bbs1[:,2]/math.pi
+    shapeFeats[:,ixs[3]:ixs[4]] = bbs1[:,extraPred+5:]
+
+    shapeFeats[:,ixs[5]] = 2*bbs2[:,3]/normalizeVert
+    shapeFeats[:,ixs[6]] = 2*bbs2[:,4]/normalizeHorz
+    shapeFeats[:,ixs[7]] = bbs2[:,2]/math.pi
+    shapeFeats[:,ixs[8]:ixs[9]] = bbs2[:,extraPred+5:]
+
+    shapeFeats[:,ixs[10]] = (bbs1[:,0]-bbs2[:,0])/normalizeHorz
+    shapeFeats[:,ixs[11]] = (bbs1[:,1]-bbs2[:,1])/normalizeVert
+    startCorners = 8+numBBTypes+numBBTypes
+    if cornerFeats:
+        #corners are tl,tr,br,bl but the features are ordered tl,tr,bl,br
+        diffX = cornersX[indexes[:,0]]-cornersX[indexes[:,1]]
+        diffY = cornersY[indexes[:,0]]-cornersY[indexes[:,1]]
+        dists = (diffX**2 + diffY**2).double().sqrt()/normalizeDist
+        shapeFeats[:,startCorners:startCorners+4] = dists[:,[0,1,3,2]].float()
+        startNN = startCorners+4
+    else:
+        startNN = startCorners
+    if extraPred:
+        shapeFeats[:,startNN +0] = bbs1[:,5]
+        shapeFeats[:,startNN +1] = bbs2[:,5]
+        startPos = startNN+2
+    else:
+        startPos = startNN
+    if positionFeature:
+        if positionFeature=='absolute':
+            shapeFeats[:,startPos +0] = (bbs1[:,0]-imageWidth/2)/(5*normalizeHorz)
+            shapeFeats[:,startPos +1] = (bbs1[:,1]-imageHeight/2)/(10*normalizeVert)
+            shapeFeats[:,startPos +2] = (bbs2[:,0]-imageWidth/2)/(5*normalizeHorz)
+            shapeFeats[:,startPos +3] = (bbs2[:,1]-imageHeight/2)/(10*normalizeVert)
+        else:
+            shapeFeats[:,startPos +0] = (bbs1[:,0]-imageWidth/2)/(imageWidth/2)
+            shapeFeats[:,startPos +1] = (bbs1[:,1]-imageHeight/2)/(imageHeight/2)
+            shapeFeats[:,startPos +2] = (bbs2[:,0]-imageWidth/2)/(imageWidth/2)
+            shapeFeats[:,startPos +3] = (bbs2[:,1]-imageHeight/2)/(imageHeight/2)
+    return shapeFeats
+
+def boxShapeFeats(bbs,numShapeFeatsBB,numBBTypes,extraPred,normalizeVert,normalizeHorz,positionFeature,imageHeight,imageWidth):
+    """
+    Shape features of every box, [N,numShapeFeatsBB]: rotation, size, neighbor count, class and position.
+    """
+    bb_shapeFeats = torch.zeros(bbs.size(0),numShapeFeatsBB,device=bbs.device)
+    bb_shapeFeats[:,0] = (bbs[:,2]+math.pi)/(2*math.pi)
+    bb_shapeFeats[:,1] = bbs[:,3]/normalizeVert
+    bb_shapeFeats[:,2] = bbs[:,4]/normalizeHorz
+    if extraPred:
+        bb_shapeFeats[:,3] = bbs[:,5]
+    bb_shapeFeats[:,3+extraPred:numBBTypes+3+extraPred] = torch.sigmoid(bbs[:,5+extraPred:numBBTypes+5+extraPred])
+    if positionFeature:
+        if positionFeature=='absolute':
+            bb_shapeFeats[:,numBBTypes+3+extraPred] = (bbs[:,0]-imageWidth/2)/(5*normalizeHorz)
+            bb_shapeFeats[:,numBBTypes+4+extraPred] = (bbs[:,1]-imageHeight/2)/(10*normalizeVert)
+        else:
+            bb_shapeFeats[:,numBBTypes+3+extraPred] = (bbs[:,0]-imageWidth/2)/(imageWidth/2)
+            bb_shapeFeats[:,numBBTypes+4+extraPred] = (bbs[:,1]-imageHeight/2)/(imageHeight/2)
+    return bb_shapeFeats
+
+def graphEdges(candIndexes,numBB,relRelEdges):
+    """
+    COO indexes ([2,M], with reverse and self edges) of the graph of boxes and relationships, and the
+    number of neighbors of each node (counting itself). candIndexes is the [E,2] LongTensor of candidates,
+    relationship i is node numBB+i.
+    relRelEdges is which edges are added between relationships:
+     'shared_box': between every two relationships which share a box
+     'legacy' (or True): the ones the original loop built, which the released models were trained with. It compared
+         rel i against each rel k>=i but indexed the second rel by its offset j=k-i (so it linked rel i to rel k-i, and
+         every rel to rel 0 as it matches itself), and only required i!=j for a shared first box
+     False/None: none
+    Rel-rel edges are found from the relationships incident to each box, so the work is proportional
+    to the number of pairs of relationships sharing a box rather than E^2.
+    """
+    device = candIndexes.device
+    numRel = candIndexes.size(0)
+    relIds = torch.arange(numRel,device=device)
+    bbRel = torch.stack((candIndexes,(numBB+relIds)[:,None].expand(numRel,2)),dim=2).view(-1,2)
+    numOfNeighbors = torch.ones(numBB+numRel,device=device) #starts at one for yourself
+    numOfNeighbors[:numBB] += torch.bincount(candIndexes.view(-1),minlength=numBB)[:numBB].float()
+    numOfNeighbors[numBB:] += 2
+    edges = [bbRel]
+    if relRelEdges:
+        assert relRelEdges in (True,'legacy','shared_box'), 'unknown rel-rel edges: {}'.format(relRelEdges)
+        #incidences (which end of which rel touches a box), grouped by box
+        boxOf = candIndexes.reshape(-1)
+        order = torch.argsort(boxOf)
+        rel = relIds.repeat_interleave(2)[order]
+        end = torch.arange(2,device=device).repeat(numRel)[order]
+        counts = torch.bincount(boxOf[order])
+        counts = counts[counts>0]
+        groupStart = torch.cumsum(counts,dim=0)-counts
+        #pair every incidence with every incidence of its box
+        size = counts.repeat_interleave(counts)
+        start = groupStart.repeat_interleave(counts)
+        first = torch.arange(boxOf.size(0),device=device).repeat_interleave(size)
+        second = start.repeat_interleave(size) + torch.arange(size.sum().item(),device=device) - (torch.cumsum(size,dim=0)-size).repeat_interleave(size)
+        i = rel[first]
+        k = rel[second]
+        if relRelEdges=='shared_box':
+            keep = k>i
+            j = k[keep]
+        else:
+            keep = (k>=i) & ~((end[first]==0) & (end[second]==0) & (k==2*i))
+            j = k[keep]-i[keep]
+        i = i[keep]
+        pairIds = torch.unique(i*numRel+j)
+        relRel = torch.stack((pairIds//numRel,pairIds%numRel),dim=1)+numBB
+        numOfNeighbors += torch.bincount(relRel.view(-1),minlength=numBB+numRel).float()
+        edges.append(relRel)
+    edges = torch.cat(edges,dim=0)
+    #add reverse edges and the diagonal (self edges)
+    nodes = torch.arange(numBB+numRel,device=device)
+    edges = torch.cat((edges,edges.flip(1),torch.stack((nodes,nodes),dim=1)),dim=0)
+    return edges.t(), numOfNeighbors
+
+def pairsInAdj(pairs,adj):
+    """
+    Which rows of the LongTensor pairs [n,(a,b)] are in adj, a set of (a,b) tuples.
+    The pairs of adj are encoded as sorted keys and searched for all at once.
+    """
+    if len(adj)==0 or pairs.size(0)==0:
+        return torch.zeros(pairs.size(0),dtype=torch.bool)
+    adjPairs = torch.LongTensor(list(adj))
+    pairs = pairs.cpu()
+    base = max(adjPairs.max().item(),pairs.max().item())+1
+    keys = np.sort((adjPairs[:,0]*base+adjPairs[:,1]).numpy())
+    query = (pairs[:,0]*base+pairs[:,1]).numpy()
+    loc = np.searchsorted(keys,query).clip(max=len(keys)-1)
+    return torch.from_numpy((keys[loc]==query) & (pairs>=0).all(dim=1).numpy())
+
+if __name__ == "__main__":
+    #per image time of the batched RoIs against the per candidate loops they replaced: python -m utils.graph_tools
+    import timeit
+    import random
+
+    def loopRois(cornersX,cornersY,candidates,relContext,bbContext,imageHeight,imageWidth,device):
+        #as createGraph used to build them
+        tlX,trX,brX,blX = cornersX.cpu().t()
+        tlY,trY,brY,blY = cornersY.cpu().t()
+        rois = torch.zeros((len(candidates),5))
+        for i,(index1, index2) in enumerate(candidates):
+            maxX = max(tlX[index1],tlX[index2],trX[index1],trX[index2],blX[index1],blX[index2],brX[index1],brX[index2])
+            minX = min(tlX[index1],tlX[index2],trX[index1],trX[index2],blX[index1],blX[index2],brX[index1],brX[index2])
+            maxY = max(tlY[index1],tlY[index2],trY[index1],trY[index2],blY[index1],blY[index2],brY[index1],brY[index2])
+            minY = min(tlY[index1],tlY[index2],trY[index1],trY[index2],blY[index1],blY[index2],brY[index1],brY[index2])
+            maxX = min(maxX.item()+relContext,imageWidth-1)
+            minX = max(minX.item()-relContext,0)
+            maxY = min(maxY.item()+relContext,imageHeight-1)
+            minY = max(minY.item()-relContext,0)
+            rois[i,1]=minX
+            rois[i,2]=minY
+            rois[i,3]=maxX
+            rois[i,4]=maxY
+        relRois = rois.to(device)
+        rois = torch.zeros((cornersX.size(0),5))
+        for i in range(cornersX.size(0)):
+            minY = round(min(tlY[i].item(),trY[i].item(),blY[i].item(),brY[i].item()))
+            maxY = round(max(tlY[i].item(),trY[i].item(),blY[i].item(),brY[i].item()))
+            minX = round(min(tlX[i].item(),trX[i].item(),blX[i].item(),brX[i].item()))
+            maxX = round(max(tlX[i].item(),trX[i].item(),blX[i].item(),brX[i].item()))
+            maxX = min(maxX+bbContext,imageWidth-1)
+            minX = max(minX-bbContext,0)
+            maxY = min(maxY+bbContext,imageHeight-1)
+            minY = max(minY-bbContext,0)
+            rois[i,1]=minX
+            rois[i,2]=minY
+            rois[i,3]=maxX
+            rois[i,4]=maxY
+        return relRois, rois.to(device)
+
+    def batchedRois(cornersX,cornersY,candidates,relContext,bbContext,imageHeight,imageWidth,device):
+        candIndexes = torch.LongTensor(candidates).to(device)
+        return pairRois(cornersX,cornersY,candIndexes,relContext,imageHeight,imageWidth), boxRois(cornersX,cornersY,bbContext,imageHeight,imageWidth)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    random.seed(0)
+    imageHeight,imageWidth = 2200,1700
+    context = 150 #expand_rel_context and expand_bb_context in cf_pairing.json
+    for numBoxes in [100,300,600]:
+        x = torch.rand(numBoxes,device=device)*imageWidth
+        y = torch.rand(numBoxes,device=device)*imageHeight
+        r = torch.randn(numBoxes,device=device)*0.1
+        h = torch.rand(numBoxes,device=device)*20+2
+        w = torch.rand(numBoxes,device=device)*150+5
+        cos_r = torch.cos(r)
+        sin_r = torch.sin(r)
+        cornersX = torch.stack((-w*cos_r-h*sin_r+x, w*cos_r-h*sin_r+x, w*cos_r+h*sin_r+x, -w*cos_r+h*sin_r+x),dim=1)
+        cornersY = torch.stack((w*sin_r-h*cos_r+y, -w*sin_r-h*cos_r+y, -w*sin_r+h*cos_r+y, w*sin_r+h*cos_r+y),dim=1)
+        candidates = list({tuple(sorted(random.sample(range(numBoxes),2))) for i in range(4*numBoxes)})
+        args = (cornersX,cornersY,candidates,context,context,imageHeight,imageWidth,device)
+        same = all(torch.equal(a.cpu(),b.cpu()) for a,b in zip(loopRois(*args),batchedRois(*args)))
+        tLoop = timeit.timeit(lambda: loopRois(*args),number=3)/3
+        tBatched = timeit.timeit(lambda: batchedRois(*args),number=20)/20
+        print('{} boxes, {} candidates ({}): loop {:.1f}ms, batched {:.2f}ms{}'.format(numBoxes,len(candidates),device,tLoop*1000,tBatched*1000,'' if same else ' (RoIs differ!)'))
@@ -0,0 +1,443 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+import numpy as np
+
+#Batched version of the pathWalk/fan heuristic in PairingGraph.selectCandidateEdges.
+#Every ray is intersected with the edges of the boxes indexed in the grid cells it crosses to find
+#where it can meet a perimeter, and only those steps are looked up on the boxesDrawn canvas,
+#instead of walking one pixel at a time.
+#The walker overwrites the perimeter pixels of its own box as it passes over them, which
+#later boxes then can't see. That makes the result depend on the box order, so we
+#iterate: resolve the hits, find which perimeter pixels got erased, resolve again with those
+#hidden from boxes that come after the owner, until nothing changes.
+
+CHUNK_ELEMENTS=2000000
+#A step lands on the pixel nearest its position and the perimeters are pixel lines between the
+#(integer) corners, so a step can only land on an edge's pixels within this distance of the edge
+EDGE_TOL=2.0
+#half width of the window of steps checked around the estimated end of a ray
+END_WINDOW=3
+#size (in pixels) of the cells of the grid the box edges are indexed in
+GRID_CELL=32
+
+def candidateRays(tlX,tlY,trX,trY,brX,brY,blX,blY,r,w,h,minWidth=30,minHeight=20,numFan=5):
+    """
+    Build every ray pathWalk would be called with.
+    Corners and r are float64 numpy arrays, w and h are the (float32) box sizes.
+    Returns (boxIndex, startX, startY, angle) arrays.
+    """
+    numBoxes = tlX.shape[0]
+    boxes=[]
+    startX=[]
+    startY=[]
+    angles=[]
+
+    def edgeRays(aX,aY,bX,bY,div,*edgeAngles):
+        idx = np.repeat(np.arange(numBoxes),div)
+        offsets = np.cumsum(div)-div
+        j = (np.arange(idx.shape[0])-np.repeat(offsets,div)).astype(np.float64)
+        den = (div-1)[idx].astype(np.float64)
+        single = den==0
+        bW = np.divide(j,den,out=np.full_like(j,0.5),where=~single)
+        aW = np.where(single,0.5,1-bW)
+        x = aX[idx]*aW+bX[idx]*bW
+        y = aY[idx]*aW+bY[idx]*bW
+        for angle in edgeAngles:
+            boxes.append(idx)
+            startX.append(x)
+            startY.append(y)
+            angles.append(angle[idx])
+
+    horzDiv = 1+np.ceil(w/np.float32(minWidth)).astype(np.int64)
+    vertDiv = 1+np.ceil(h/np.float32(minHeight)).astype(np.int64)
+    edgeRays(tlX,tlY,trX,trY,horzDiv,r+90,r-90)
+    edgeRays(tlX,tlY,blX,blY,vertDiv,r+180)
+    edgeRays(trX,trY,brX,brY,vertDiv,r)
+
+    idx = np.arange(numBoxes)
+    deg = 90/(numFan+1)
+    for cX,cY,offset in ((tlX,tlY,135),(trX,trY,45),(blX,blY,225),(brX,brY,315)):
+        curDeg = (r+offset)-45+deg
+        for i in range(numFan):
+            boxes.append(idx)
+            startX.append(cX)
+            startY.append(cY)
+            angles.append(curDeg)
+            curDeg = curDeg+deg
+
+    return np.concatenate(boxes), np.concatenate(startX), np.concatenate(startY), np.concatenate(angles)
+
+def raySteps(angles):
+    """Per-ray x and y step, computed exactly as pathWalk does."""
+    xSteps = np.empty(angles.shape[0])
+    ySteps = np.empty(angles.shape[0])
+    #math.tan is used (rather than np.tan) so the rounding of the steps matches the walker bit for bit
+    for i,angle in enumerate(angles.tolist()):
+        if angle<-180:
+            angle+=360
+        if angle>180:
+            angle-=360
+        if (angle>45 and angle<135) or (angle>-135 and angle<-45):
+            yStep=-1
+            xStep=1/math.tan(math.pi*angle/180.0)
+        else:
+            xStep=1
+            yStep=-math.tan(math.pi*angle/180.0)
+        if angle>=135 or angle<-45:
+            xStep*=-1
+            yStep*=-1
+        xSteps[i]=xStep
+        ySteps[i]=yStep
+    return xSteps, ySteps
+
+class PerimeterIndex(object):
+    """
+    The box perimeters of a page. boxesDrawn is the canvas with box i's perimeter drawn as i+1
+    (polygon_perimeter through the int() of the corners) and the corners are float64 numpy arrays.
+    The edges between the integer corners are kept as segments to intersect rays with, and the
+    canvas to look up exactly which box a step lands on.
+    The edges are indexed in a uniform grid of GRID_CELL pixel cells, each cell listing the boxes
+    with an edge (padded by EDGE_TOL) in it, so a ray only has to look at the boxes in the cells it crosses.
+    """
+    def __init__(self,boxesDrawn,tlX,tlY,trX,trY,brX,brY,blX,blY):
+        self.boxesDrawn = boxesDrawn
+        self.flat = boxesDrawn.ravel()
+        self.rows,self.cols = boxesDrawn.shape
+        cornersX = np.trunc(np.stack((tlX,trX,brX,blX),axis=1))
+        cornersY = np.trunc(np.stack((tlY,trY,brY,blY),axis=1))
+        self.boxMinX = cornersX.min(axis=1)-EDGE_TOL
+        self.boxMinY = cornersY.min(axis=1)-EDGE_TOL
+        self.boxMaxX = cornersX.max(axis=1)+EDGE_TOL
+        self.boxMaxY = cornersY.max(axis=1)+EDGE_TOL
+        #polygon_perimeter clips to the canvas, which moves the corners and adds edges along the border,
+        #so boxes touching the border are matched by their whole bounding box
+        self.clipped = (cornersX.min(axis=1)<=0) | (cornersY.min(axis=1)<=0) | (cornersX.max(axis=1)>=self.cols-1) | (cornersY.max(axis=1)>=self.rows-1)
+        #edges tl-tr, tr-br, br-bl, bl-tl of each box, [boxes,4]
+        self.aX = cornersX
+        self.aY = cornersY
+        self.bX = np.roll(cornersX,-1,axis=1)
+        self.bY = np.roll(cornersY,-1,axis=1)
+        length = np.sqrt((self.bX-self.aX)**2 + (self.bY-self.aY)**2)
+        #unit normal of each edge (zero for an edge of no length, which is then just its bounding box)
+        self.nX = np.divide(self.aY-self.bY,length,out=np.zeros_like(length),where=length>0)
+        self.nY = np.divide(self.bX-self.aX,length,out=np.zeros_like(length),where=length>0)
+
+        self.gridCols = max(1,int(math.ceil(self.cols/GRID_CELL)))
+        self.gridRows = max(1,int(math.ceil(self.rows/GRID_CELL)))
+        #the clipped boxes are indexed by their bounding box, the others by each of their edges
+        numBoxes = cornersX.shape[0]
+        clipped = np.nonzero(self.clipped)[0]
+        itemBox = np.concatenate((np.repeat(np.nonzero(~self.clipped)[0],4),clipped))
+        edges = ~self.clipped
+        minX = np.concatenate((np.minimum(self.aX,self.bX)[edges].ravel()-EDGE_TOL,self.boxMinX[clipped]))
+        minY = np.concatenate((np.minimum(self.aY,self.bY)[edges].ravel()-EDGE_TOL,self.boxMinY[clipped]))
+        maxX = np.concatenate((np.maximum(self.aX,self.bX)[edges].ravel()+EDGE_TOL,self.boxMaxX[clipped]))
+        maxY = np.concatenate((np.maximum(self.aY,self.bY)[edges].ravel()+EDGE_TOL,self.boxMaxY[clipped]))
+        cX0,cY0 = self.cellOf(minX,minY)
+        cX1,cY1 = self.cellOf(maxX,maxY)
+        spanX = cX1-cX0+1
+        count = spanX*(cY1-cY0+1)
+        item = np.repeat(np.arange(itemBox.shape[0]),count)
+        i = np.arange(count.sum())-np.repeat(np.cumsum(count)-count,count)
+        cell = (cY0[item]+i//spanX[item])*self.gridCols + cX0[item]+i%spanX[item]
+        #an edge can share a cell with the other edges of its box
+        cellBox = np.unique(cell*numBoxes+itemBox[item])
+        self.cellBoxes = cellBox%numBoxes if numBoxes>0 else cellBox
+        self.cellCount = np.bincount(cellBox//max(numBoxes,1),minlength=self.gridCols*self.gridRows)
+        self.cellStart = np.cumsum(self.cellCount)-self.cellCount
+
+    def cellOf(self,x,y):
+        """The (clamped) grid cell of each position"""
+        cX = np.clip(np.floor(x/GRID_CELL),0,self.gridCols-1).astype(np.int64)
+        cY = np.clip(np.floor(y/GRID_CELL),0,self.gridRows-1).astype(np.int64)
+        return cX, cY
+
+    def inBounds(self,x,y):
+        return (x>=0) & (y>=0) & (x<self.cols) & (y<self.rows)
+
+def inverse(v):
+    """1/v, with a huge number rather than inf for 0 so slab() gives no nans"""
+    return 1/np.where(v==0,1e-300,v)
+
+def slab(s,invV,lo,hi):
+    """Range of k for which lo<=s+k*v<=hi (empty if the first is greater than the second)"""
+    k0 = (lo-s)*invV
+    k1 = (hi-s)*invV
+    return np.minimum(k0,k1), np.maximum(k0,k1)
+
+def rayEnds(index,startX,startY,xSteps,ySteps,maxDist,maxDistY):
+    """
+    The number of steps each ray takes before pathWalk's loop stops it: at the first step off the
+    page, or after the first step which is too far from the start.
+    Once a ray (starting on the page) has stopped it would stay stopped, so the end is estimated
+    from the continuous ray and then found exactly by checking the steps around the estimate.
+    """
+    numRays = startX.shape[0]
+    if numRays==0:
+        return np.zeros(0,dtype=np.int64)
+    _,pageX = slab(startX,inverse(xSteps),-0.5,index.cols-0.5)
+    _,pageY = slab(startY,inverse(ySteps),-0.5,index.rows-0.5)
+    speed = np.sqrt(xSteps**2+ySteps**2)
+    absY = np.abs(ySteps)
+    #one past the step which breaks each limit (the page bound always exists, as one of the steps is 1)
+    guess = np.minimum(np.floor(np.minimum(pageX,pageY))+1,
+                       np.ceil(maxDist/speed)+1)
+    guess = np.minimum(guess,np.ceil(np.divide(maxDistY,absY,out=np.full_like(absY,np.inf),where=absY>0))+1)
+    guess = np.maximum(guess,0).astype(np.int64)
+
+    def notTaken(rays,k):
+        sx = startX[rays,None]
+        sy = startY[rays,None]
+        x = np.rint(sx + k*xSteps[rays,None])
+        y = np.rint(sy + k*ySteps[rays,None])
+        off = ~index.inBounds(x,y)
+        #the loop checks the distance of the previous step
+        pX = np.rint(sx + (k-1)*xSteps[rays,None])
+        pY = np.rint(sy + (k-1)*ySteps[rays,None])
+        far = (np.sqrt((pX-sx)**2 + (pY-sy)**2)>=maxDist) | (np.abs(pY-sy)>=maxDistY)
+        return off | ((k>0) & far)
+
+    endStep = np.zeros(numRays,dtype=np.int64)
+    lo = np.maximum(guess-END_WINDOW,0)
+    window = np.arange(2*END_WINDOW+1)[None,:]
+    #rays starting off the page stop right away
+    todo = np.nonzero(index.inBounds(np.rint(startX),np.rint(startY)))[0]
+    while todo.shape[0]>0:
+        k = lo[todo,None]+window
+        stop = notTaken(todo,k)
+        found = stop.any(axis=1)
+        first = stop.argmax(axis=1)
+        done = found & ((first>0) | (lo[todo]==0))
+        endStep[todo[done]] = lo[todo[done]]+first[done]
+        #the estimate is only off by a step or so, but move the window if the end isn't inside it
+        early = found & ~done
+        lo[todo[early]] = np.maximum(lo[todo[early]]-2*END_WINDOW,0)
+        late = ~found
+        lo[todo[late]] += 2*END_WINDOW+1
+        todo = todo[~done]
+    return endStep
+
+def rayCells(index,startX,startY,xSteps,ySteps,endStep):
+    """
+    The grid cells each ray passes through before endStep, as (ray,cell) arrays.
+    A ray moves a pixel a step along its major axis and at most that along the other, so in each
+    cell it crosses along the major axis it spans at most two cells on the other.
+    """
+    rays = np.nonzero(endStep>0)[0]
+    last = (endStep[rays]-1).astype(np.float64)
+    xMajor = np.abs(xSteps[rays])>=np.abs(ySteps[rays])
+    m0 = np.where(xMajor,startX[rays],startY[rays])
+    n0 = np.where(xMajor,startY[rays],startX[rays])
+    mStep = np.where(xMajor,xSteps[rays],ySteps[rays])
+    nStep = np.where(xMajor,ySteps[rays],xSteps[rays])
+    m1 = m0+last*mStep
+    c0 = np.floor(np.minimum(m0,m1)/GRID_CELL)
+    count = (np.floor(np.maximum(m0,m1)/GRID_CELL)-c0+1).astype(np.int64)
+    r = np.repeat(np.arange(rays.shape[0]),count)
+    c = np.repeat(c0,count)+np.arange(count.sum())-np.repeat(np.cumsum(count)-count,count)
+    #where the ray is in that major cell, and the minor cells it spans there
+    t0,t1 = slab(m0[r],inverse(mStep[r]),c*GRID_CELL,(c+1)*GRID_CELL)
+    t0 = np.clip(t0,0,last[r])
+    t1 = np.clip(t1,0,last[r])
+    nA = n0[r]+t0*nStep[r]
+    nB = n0[r]+t1*nStep[r]
+    d0 = np.floor(np.minimum(nA,nB)/GRID_CELL)
+    count = (np.floor(np.maximum(nA,nB)/GRID_CELL)-d0+1).astype(np.int64)
+    r = np.repeat(r,count)
+    c = np.repeat(c,count)*GRID_CELL
+    d = (np.repeat(d0,count)+np.arange(count.sum())-np.repeat(np.cumsum(count)-count,count))*GRID_CELL
+    cX,cY = index.cellOf(np.where(xMajor[r],c,d),np.where(xMajor[r],d,c))
+    return rays[r], cY*index.gridCols+cX
+
+def edgeSteps(index,rays,boxes,startX,startY,xSteps,ySteps,invX,invY,kLo,kHi):
+    """
+    Narrow the step ranges [kLo,kHi] of the (ray,box) pairs to where each ray crosses one of the box's edges.
+    Returns (ray,kLo,kHi) ranges, several per pair.
+    """
+    sx = startX[rays,None]
+    sy = startY[rays,None]
+    xs = xSteps[rays,None]
+    ys = ySteps[rays,None]
+    aX = index.aX[boxes]
+    aY = index.aY[boxes]
+    bX = index.bX[boxes]
+    bY = index.bY[boxes]
+    nX = index.nX[boxes]
+    nY = index.nY[boxes]
+    loX,hiX = slab(sx,invX[rays,None],np.minimum(aX,bX)-EDGE_TOL,np.maximum(aX,bX)+EDGE_TOL)
+    loY,hiY = slab(sy,invY[rays,None],np.minimum(aY,bY)-EDGE_TOL,np.maximum(aY,bY)+EDGE_TOL)
+    #distance to the edge's line
+    loD,hiD = slab(nX*(sx-aX)+nY*(sy-aY),inverse(nX*xs+nY*ys),-EDGE_TOL,EDGE_TOL)
+    lo = np.maximum(np.maximum(loX,loY),np.maximum(loD,kLo[:,None]))
+    hi = np.minimum(np.minimum(hiX,hiY),np.minimum(hiD,kHi[:,None]))
+    return np.repeat(rays,4), lo.ravel(), hi.ravel()
+
+def boxSteps(index,startX,startY,xSteps,ySteps,endStep):
+    """
+    Find the steps (before endStep) at which the rays land on a box pixel.
+    Each ray is only intersected with the boxes indexed in the grid cells it crosses: with their (padded)
+    bounding box, then with their edges, and only the steps in those ranges are looked up on the canvas.
+    Returns the box steps as (ray,step,pixel) arrays, sorted by ray then step.
+    """
+    numRays = startX.shape[0]
+    numBoxes = index.boxMinX.shape[0]
+    rangeRay=[]
+    rangeLo=[]
+    rangeHi=[]
+    invX = inverse(xSteps)
+    invY = inverse(ySteps)
+    cellRay,cell = rayCells(index,startX,startY,xSteps,ySteps,endStep)
+    #chunked by the number of (ray,box) pairs the cells give
+    pairs = np.cumsum(index.cellCount[cell])
+    bounds = np.searchsorted(pairs,np.arange(CHUNK_ELEMENTS,pairs[-1] if pairs.shape[0]>0 else 0,CHUNK_ELEMENTS))
+    for s,e in zip(np.concatenate(([0],bounds)),np.concatenate((bounds,[cell.shape[0]]))):
+        count = index.cellCount[cell[s:e]]
+        pos = np.repeat(index.cellStart[cell[s:e]]-np.cumsum(count)+count,count)+np.arange(count.sum())
+        ray = np.repeat(cellRay[s:e],count)
+        box = index.cellBoxes[pos]
+        loX,hiX = slab(startX[ray],invX[ray],index.boxMinX[box],index.boxMaxX[box])
+        loY,hiY = slab(startY[ray],invY[ray],index.boxMinY[box],index.boxMaxY[box])
+        lo = np.maximum(np.maximum(loX,loY),0)
+        hi = np.minimum(np.minimum(hiX,hiY),endStep[ray]-1)
+        keep = np.nonzero(np.ceil(lo)<=hi)[0]
+        #a ray crosses several cells of most of the boxes it passes
+        _,first = np.unique(ray[keep]*numBoxes+box[keep],return_index=True)
+        keep = keep[first]
+        ray = ray[keep]
+        box = box[keep]
+        lo = lo[keep]
+        hi = hi[keep]
+        clipped = index.clipped[box]
+        rangeRay.append(ray[clipped])
+        rangeLo.append(lo[clipped])
+        rangeHi.append(hi[clipped])
+        ray,lo,hi = edgeSteps(index,ray[~clipped],box[~clipped],startX,startY,xSteps,ySteps,invX,invY,lo[~clipped],hi[~clipped])
+        rangeRay.append(ray)
+        rangeLo.append(lo)
+        rangeHi.append(hi)
+
+    ray = np.concatenate(rangeRay)
+    first = np.ceil(np.concatenate(rangeLo))
+    last = np.floor(np.concatenate(rangeHi))
+    keep = first<=last
+    #the ranges as (ray,step) keys, which sort by ray then step
+    maxStep = int(endStep.max())+1 if numRays>0 else 1
+    first = ray[keep]*maxStep+first[keep].astype(np.int64)
+    last = ray[keep]*maxStep+last[keep].astype(np.int64)
+    order = np.argsort(first,kind='stable')
+    first = first[order]
+    last = last[order]
+    #the same step can be near several edges, so start each range after the ones before it
+    if first.shape[0]>0:
+        reached = np.maximum.accumulate(last)
+        first[1:] = np.maximum(first[1:],reached[:-1]+1)
+    counts = np.maximum(last-first+1,0)
+    key = np.repeat(first-np.cumsum(counts)+counts,counts)+np.arange(counts.sum())
+    ray = key//maxStep
+    step = key%maxStep
+
+    #exactly as pathWalk computes the position
+    x = np.rint(startX[ray] + step*xSteps[ray])
+    y = np.rint(startY[ray] + step*ySteps[ray])
+    pix = (y*index.cols+x).astype(np.int64)
+    onBox = index.flat[pix]>0
+    return ray[onBox], step[onBox], pix[onBox]
+
+def resolveHits(index,rayBox,evRay,evStep,evPix):
+    """
+    Apply the walker's rules to the box steps found by walkRays: a ray stops when it re-enters
+    a box it has already hit, and it overwrites its own box's perimeter, which hides those pixels
+    from the boxes after it.
+    Returns the (box,hitBox) index pairs.
+    """
+    numRays = rayBox.shape[0]
+    value = index.flat[evPix]
+    myId = rayBox[evRay]+1
+    own = value==myId
+    behind = value<myId
+    follows = np.zeros(evRay.shape[0],dtype=bool)
+    follows[1:] = (evRay[1:]==evRay[:-1]) & (evStep[1:]==evStep[:-1]+1) & (value[1:]==value[:-1])
+    pixels,pixId = np.unique(evPix,return_inverse=True)
+    key = evRay.astype(np.int64)*(index.flat.max()+1)+value
+
+    erased = np.zeros(pixels.shape[0],dtype=bool)
+    stopAt = np.full(numRays,np.iinfo(np.int64).max)
+    redo = np.ones(evRay.shape[0],dtype=bool)
+    while True:
+        visible = ~own & ~(erased[pixId] & behind)
+        enter = visible.copy()
+        enter[1:] &= ~(follows[1:] & visible[:-1])
+        #a ray stops at the first box it enters for a second time
+        sel = np.nonzero(visible & redo)[0]
+        stopAt[np.unique(evRay[redo])] = np.iinfo(np.int64).max
+        _,first = np.unique(key[sel],return_index=True)
+        again = enter[sel]
+        again[first] = False
+        np.minimum.at(stopAt,evRay[sel[again]],evStep[sel[again]])
+        live = evStep<stopAt[evRay]
+
+        newErased = np.zeros_like(erased)
+        newErased[pixId[own & live]] = True
+        changed = newErased!=erased
+        if not changed.any():
+            break
+        erased = newErased
+        #only the rays which look at a pixel that changed need resolving again
+        touched = np.zeros(numRays,dtype=bool)
+        touched[evRay[changed[pixId] & behind]] = True
+        redo = touched[evRay]
+
+    hit = visible & live
+    return np.stack((rayBox[evRay[hit]],value[hit]-1),axis=1)
+
+class LineOfSight(object):
+    """
+    Same candidate set as the pathWalk/fan loop in PairingGraph.selectCandidateEdges.
+    The rays are cast once with the loosest distance limits and every box step is kept along
+    with how far along its ray it is. Tighter limits (the distMul loop) then only need to find
+    where each ray now stops and filter the steps, rather than casting everything again.
+    index is a PerimeterIndex of the page, corners and r are float64 numpy arrays.
+    """
+    def __init__(self,index,tlX,tlY,trX,trY,brX,brY,blX,blY,r,w,h,maxDist,maxDistY,minWidth=30,minHeight=20,numFan=5):
+        self.index = index
+        self.maxDist = maxDist
+        self.maxDistY = maxDistY
+        self.rayBox,self.startX,self.startY,angles = candidateRays(tlX,tlY,trX,trY,brX,brY,blX,blY,r,w,h,minWidth,minHeight,numFan)
+        self.xSteps,self.ySteps = raySteps(angles)
+        self.endStep = rayEnds(index,self.startX,self.startY,self.xSteps,self.ySteps,maxDist,maxDistY)
+        self.evRay,self.evStep,self.evPix = boxSteps(index,self.startX,self.startY,self.xSteps,self.ySteps,self.endStep)
+
+    def candidates(self,maxDist=None,maxDistY=None):
+        """Candidate (i,j) pairs for limits no looser than the ones the rays were cast with"""
+        if maxDist is None:
+            maxDist = self.maxDist
+        if maxDistY is None:
+            maxDistY = self.maxDistY
+        assert maxDist<=self.maxDist and maxDistY<=self.maxDistY
+        evRay,evStep,evPix = self.evRay,self.evStep,self.evPix
+        if maxDist<self.maxDist or maxDistY<self.maxDistY:
+            endStep = rayEnds(self.index,self.startX,self.startY,self.xSteps,self.ySteps,maxDist,maxDistY)
+            keep = evStep<endStep[evRay]
+            evRay = evRay[keep]
+            evStep = evStep[keep]
+            evPix = evPix[keep]
+        hits = resolveHits(self.index,self.rayBox,evRay,evStep,evPix)
+
+        candidates=set()
+        for i,j in zip(np.minimum(hits[:,0],hits[:,1]).tolist(),np.maximum(hits[:,0],hits[:,1]).tolist()):
+            candidates.add((i,j))
+        return candidates
@@ -0,0 +1,141 @@
+"""
+    Copyright 2019 Brian Davis
+    Visual-Template-free-Form-Parsting is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Visual-Template-free-Form-Parsting is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Visual-Template-free-Form-Parsting.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+from collections import OrderedDict
+import numpy as np
+
+
+class MetricAggregator(object):
+    """
+    Running mean and std (Welford) of metrics fed one image at a time (by the printers), so eval doesn't keep every value.
+    A value can be a number or a list of numbers (e.g. per class), which are aggregated element-wise.
+    If reservoirSize>0, a uniform sample of up to that many values per metric is also kept for quantiles.
+    Aggregators of separate runs (e.g. eval shards) can be saved, loaded and merged.
+    """
+
+    def __init__(self,reservoirSize=0,seed=1234):
+        self.reservoirSize=reservoirSize
+        self.stats=OrderedDict() #key -> [count,mean,M2,reservoir]
+        #its own generator, so sampling doesn't change the global numpy random state
+        self.rand=np.random.RandomState(seed)
+
+    def add(self,key,values):
+        """
+        Add a list of values for key. key is a tuple, e.g. (type,) or (type,name).
+        """
+        for value in values:
+            value = np.asarray(value,dtype=np.float64)
+            if key not in self.stats:
+                self.stats[key]=[0,np.zeros_like(value),np.zeros_like(value),[]]
+            stat = self.stats[key]
+            stat[0]+=1
+            delta = value-stat[1]
+            stat[1] = stat[1]+delta/stat[0]
+            stat[2] = stat[2]+delta*(value-stat[1])
+            if self.reservoirSize>0:
+                if len(stat[3])<self.reservoirSize:
+                    stat[3].append(value)
+                else:
+                    replace = self.rand.randint(stat[0])
+                    if replace<self.reservoirSize:
+                        stat[3][replace]=value
+
+    def addResults(self,results):
+        """
+        Add the metrics of one image as the printers give them: {type: values} or {type: {name: values}}.
+        The second form is added both under (type,name) and under (type,) for all of the type.
+        """
+        for typ,typeLists in results.items():
+            if type(typeLists) == dict:
+                for name,lst in typeLists.items():
+                    self.add((typ,name),lst)
+                    self.add((typ,),lst)
+            else:
+                if type(typeLists) is float or type(typeLists) is int:
+                    typeLists = [typeLists]
+                if typeLists is not None:
+                    self.add((typ,),typeLists)
+
+    def keys(self):
+        return self.stats.keys()
+
+    def count(self,key):
+        return self.stats[key][0]
+
+    def mean(self,key):
+        return self.stats[key][1]
+
+    def std(self,key):
+        #population std, as np.std
+        return np.sqrt(self.stats[key][2]/self.stats[key][0])
+
+    def quantile(self,key,q):
+        if len(self.stats[key][3])==0:
+            return None
+        return np.percentile(np.stack(self.stats[key][3]),np.asarray(q)*100,axis=0)
+
+    def merge(self,other):
+        for key,(countB,meanB,M2B,resB) in other.stats.items():
+            if key not in self.stats:
+                self.stats[key]=[countB,meanB,M2B,list(resB)]
+                continue
+            countA,meanA,M2A,resA = self.stats[key]
+            count = countA+countB
+            delta = meanB-meanA
+            mean = meanA+delta*countB/count
+            M2 = M2A+M2B+delta**2*countA*countB/count
+            #keep the sample uniform by drawing from each in proportion to its count
+            reservoir=[]
+            if self.reservoirSize>0 and len(resA)+len(resB)>0:
+                size = min(self.reservoirSize,len(resA)+len(resB))
+                fromA = self.rand.binomial(size,countA/count)
+                fromA = min(max(fromA,size-len(resB)),len(resA))
+                reservoir = [resA[i] for i in self.rand.permutation(len(resA))[:fromA]] + \
+                            [resB[i] for i in self.rand.permutation(len(resB))[:size-fromA]]
+            self.stats[key]=[count,mean,M2,reservoir]
+
+    def summary(self,quantiles=(0.05,0.25,0.5,0.75,0.95)):
+        """
+        Compact, printable summary (json-able dict).
+        """
+        summary=OrderedDict()
+        for key in self.stats:
+            entry={'count':self.count(key), 'mean':self.mean(key).tolist(), 'std':self.std(key).tolist()}
+            if len(self.stats[key][3])>0:
+                entry['quantiles']={str(q):self.quantile(key,q).tolist() for q in quantiles}
+            summary[' '.join(str(k) for k in key)]=entry
+        return summary
+
+    def save(self,path):
+        """
+        Saves the summary and the state needed to merge with other runs.
+        """
+        state = [{'key':list(key), 'count':count, 'mean':mean.tolist(), 'M2':M2.tolist(), 'reservoir':[r.tolist() for r in reservoir]}
+                 for key,(count,mean,M2,reservoir) in self.stats.items()]
+        with open(path,'w') as f:
+            json.dump({'reservoirSize':self.reservoirSize, 'summary':self.summary(), 'state':state},f,indent=1)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            saved = json.load(f)
+        aggregator = MetricAggregator(saved['reservoirSize'])
+        for entry in saved['state']:
+            aggregator.stats[tuple(entry['key'])]=[entry['count'],
+                                                   np.asarray(entry['mean'],dtype=np.float64),
+                                                   np.asarray(entry['M2'],dtype=np.float64),
+                                                   [np.asarray(r,dtype=np.float64) for r in entry['reservoir']]]
+        return aggregator
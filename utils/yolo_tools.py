@@ -16,46 +16,119 @@
 import torch
 #from model.yolo_loss import bbox_iou
 import math
+import numpy as np
+
+_native=None
+def nativeOps(*tensors):
+    #The compiled extension (model/csrc, built with setup.py) if it has the box kernels, otherwise None.
+    #The kernels are CPU only, so it's also None if any of the tensors they'd be given is on the GPU
+    global _native
+    if _native is None:
+        try:
+            from model import _C
+            _native = _C if hasattr(_C,'nms_dist') else False
+        except ImportError:
+            _native = False
+    if _native is False or any(t.is_cuda for t in tensors):
+        return None
+    return _native
+
 
 def non_max_sup_iou(pred_boxes,thresh_conf=0.5, thresh_inter=0.5, hard_limit=300):
-    return non_max_sup_(pred_boxes,thresh_conf, thresh_inter, max_intersection, hard_limit)
+    return non_max_sup_(pred_boxes,thresh_conf, thresh_inter, allMaxIntersection, hard_limit)
 def non_max_sup_dist(pred_boxes,thresh_conf=0.5, thresh_dist=0.9, hard_limit=300):
-    return non_max_sup_(pred_boxes,thresh_conf, thresh_dist*-1, dist_neg, hard_limit)
-def non_max_sup_(pred_boxes,thresh_conf, thresh_loc, loc_metric, hard_limit):
-    #rearr = [0,1,2,5,4,3]
-    #for i in range(6,pred_boxes.shape[2]):
-    #    rearr.append(i)
-    #pred_boxes = pred_boxes[:,:,rearr]
-    to_return=[]
-    for b in range(pred_boxes.shape[0]):
-        
-        #allIOU = bbox_iou(
-        above_thresh = []
-        for i in range(pred_boxes.shape[1]):
-            if pred_boxes[b,i,0]>thresh_conf:
-                above_thresh.append( (pred_boxes[b,i,0], i) )
-        above_thresh.sort(key=lambda a: a[0], reverse=True)
-        above_thresh = above_thresh[:hard_limit]
-        li = 0
-        while li<len(above_thresh)-1:
-            i=above_thresh[li][1]
-            loc_measures = loc_metric(pred_boxes[b,i,1:6],pred_boxes[b,[x[1] for x in above_thresh[li+1:]],1:6])
-            #ious = bbox_iou(pred_boxes[b,i:i+1,1:5],pred_boxes[b,[x[1] for x in above_thresh[li+1:]],1:5], x1y1x2y2=False)
-            to_remove=[]
-            for lj in range(len(above_thresh)-1,li,-1):
-                j=above_thresh[lj][1]
-                #if bbox_iou( pred_boxes[b,i:i+1,1:5], pred_boxes[b,j:j+1,1:5], x1y1x2y2=False) > thresh_iou:
-                if loc_measures[lj-(li+1)] > thresh_loc:
-                    to_remove.append(lj)
-            #to_remove.reverse()
-            for index in to_remove:
-                del above_thresh[index]
-            li+=1
-
-        best = pred_boxes[b,[x[1] for x in above_thresh],:]
-        to_return.append(best)#[:,rearr])
-    return to_return
-
+    return non_max_sup_(pred_boxes,thresh_conf, thresh_dist*-1, allBoxDistNeg, hard_limit, 'nms_dist')
+def non_max_sup_(pred_boxes,thresh_conf, thresh_loc, loc_metric, hard_limit, native_nms=None):
+    #loc_metric gives the matrix of overlaps (between every pair of boxes), a box is suppressed
+    #by a more confident box it overlaps more than thresh_loc.
+    #native_nms names the compiled kernel doing the same (used for CPU tensors when it's built)
+    #The whole batch is thresholded, sorted and compared at once, each image padded to the longest one.
+    native = nativeOps(pred_boxes) if native_nms is not None else None
+    batchSize = pred_boxes.size(0)
+    conf = pred_boxes[:,:,0]
+    above_thresh = conf>thresh_conf
+    counts = above_thresh.sum(dim=1)
+    if hard_limit is not None:
+        counts = counts.clamp(max=hard_limit)
+    k = counts.max().item() if batchSize>0 else 0
+    #The boxes under the threshold go last and are padding. Equal confidences stay in index order: the sorted
+    #confidences are ranked (equal ones sharing a rank) and sorted again on rank then index (sort's stable
+    #argument needs PyTorch 1.9)
+    sortedConf,order = torch.sort(torch.where(above_thresh,conf,torch.full_like(conf,-float('inf'))).detach(),dim=1,descending=True)
+    rank = torch.cumsum((sortedConf[:,1:]!=sortedConf[:,:-1]).long(),dim=1)
+    rank = torch.cat((torch.zeros_like(order[:,:1]),rank),dim=1)
+    order = torch.sort(rank*conf.size(1)+order,dim=1)[0][:,:k] % conf.size(1)
+    valid = torch.arange(k,device=order.device)[None,:]<counts[:,None]
+
+    boxes = torch.gather(pred_boxes[:,:,1:6].detach(),1,order[:,:,None].expand(-1,-1,5))
+    if native is not None:
+        keep = np.zeros((batchSize,k),dtype=bool)
+        for b,count in enumerate(counts.tolist()):
+            keep[b,:count] = getattr(native,native_nms)(boxes[b,:count].contiguous(),thresh_loc).numpy().astype(bool)
+    else:
+        #[batch,k,k], the metrics broadcast over the batch
+        suppresses = (loc_metric(boxes,boxes) > thresh_loc).cpu().numpy()
+        keep = valid.cpu().numpy()
+        for li in range(k-1):
+            keep[:,li+1:] &= ~(suppresses[:,li,li+1:] & keep[:,li,None])
+
+    keep = torch.from_numpy(keep).to(order.device)
+    best = pred_boxes[torch.arange(batchSize,device=order.device)[:,None].expand_as(order)[keep],order[keep]]
+    return list(torch.split(best,keep.sum(dim=1).tolist()))
+
+
+def closestAnchors(gw,gh,anchors,ignore_thresh):
+    #For boxes of width gw and height gh (1D), the anchor (rows of (width,height)) with the best IOU by shape only
+    #(as if at the same location, as YoloLoss assigns them) and [N,numAnchors] whether each IOU is over ignore_thresh
+    inter_area = torch.clamp(torch.min(gw[:,None],anchors[None,:,0]) + 1, min=0) * torch.clamp(
+            torch.min(gh[:,None],anchors[None,:,1]) + 1, min=0)
+    b1_area = ((gw + 1) * (gh + 1))[:,None]
+    b2_area = ((anchors[:,0] + 1) * (anchors[:,1] + 1))[None,:]
+    anch_ious = inter_area / (b1_area + b2_area - inter_area + 1e-16)
+    return torch.argmax(anch_ious,dim=1), anch_ious>ignore_thresh
+
+def anchorAssignment(target,anchors,scale,ignore_thresh):
+    """
+    YoloLoss's assignment of targets ([batch,targets,params], as collated) to anchors, which only depends on
+    the target boxes, anchors (the model's, dicts with 'width' and 'height') and the detector's output scale.
+    This is meant to be computed by the DataLoader workers (see datasets.box_detect.AnchorAssignmentCollate)
+    and passed on to YoloLoss, which only uses it if the 'settings' (scale, ignore_thresh and scaled anchor sizes) match its own.
+    """
+    scaled_anchors = torch.FloatTensor([(a['width'] / scale[0], a['height']/ scale[1]) for a in anchors])
+    gw = target[:,:,4] / scale[0]
+    gh = target[:,:,3] / scale[1]
+    best, ignore = closestAnchors(gw.contiguous().view(-1),gh.contiguous().view(-1),scaled_anchors.type(gw.dtype),ignore_thresh)
+    return {
+            'best_anchor': best.view(target.size(0),target.size(1)),
+            'ignore': ignore.view(target.size(0),target.size(1),len(anchors)),
+            'settings': [list(scale),ignore_thresh,scaled_anchors.tolist()]
+            }
+
+def confident_boxes(pred_boxes,thresh_conf,hard_limit=300):
+    #The most confident boxes (at most hard_limit, above thresh_conf) of each image in [batch,instances,(conf,...)].
+    #This runs on the device of the predictions, so only these need to be moved for NMS.
+    #Ties are broken by index, as non_max_sup_ does, so NMS gives the same result on these as on all the predictions.
+    #Images keeping fewer boxes are padded with rows of -inf confidence.
+    conf = pred_boxes[:,:,0]
+    above = conf>thresh_conf
+    k = above.sum(dim=1).max().item()
+    if hard_limit is not None:
+        k = min(k,hard_limit)
+    if k==0:
+        return pred_boxes[:,:0]
+    kth = torch.where(above,conf,torch.full_like(conf,-float('inf'))).topk(k,dim=1)[0][:,-1:]
+    take = above & (conf>kth)
+    ties = above & (conf==kth)
+    need = k-take.sum(dim=1,keepdim=True)
+    take = take | (ties & (torch.cumsum(ties.long(),dim=1)<=need))
+
+    #indexes of the kept boxes in their original order, followed by the others
+    index = torch.arange(conf.size(1),device=conf.device)[None,:].expand_as(conf)
+    index = torch.sort(torch.where(take,index,index+conf.size(1)),dim=1)[0][:,:k] % conf.size(1)
+    valid = torch.gather(take,1,index)
+    best = torch.gather(pred_boxes,1,index[:,:,None].expand(-1,-1,pred_boxes.size(2))).clone()
+    best[:,:,0] = torch.where(valid,best[:,:,0],torch.full_like(best[:,:,0],-float('inf')))
+    return best
 
 def max_intersection(query_box, candidate_boxes):
     q_x1, q_x2 = query_box[0]-query_box[4], query_box[0]+query_box[4]
@@ -122,7 +195,60 @@ def dist_neg(query_box, candidate_boxes):
            )/normalization)**2
     return dist*-1
 
+#The pairwise matrices (allIOU, allDist, allBoxDistNeg) are computed over blocks of boxes2 so that the intermediates of
+#a block take about this many bytes at most. The full matrix is still returned (use pairwiseBest if only the best is needed).
+#None computes them in one go.
+pairwise_memory_budget = 256*1024*1024
+
+def setPairwiseMemoryBudget(budget):
+    global pairwise_memory_budget
+    pairwise_memory_budget = budget
+
+def pairwiseBlockSize(numRows,bytesPerPair,budget=None):
+    #how many columns of a [numRows,n] pairwise computation fit in the budget (None if it isn't limited)
+    if budget is None:
+        budget = pairwise_memory_budget
+    if budget is None:
+        return None
+    return max(1,int(budget//max(1,numRows*bytesPerPair)))
+
+def pairwiseBlocks(getLoc,boxes1,boxes2,perPair,budget=None):
+    #getLoc(boxes1,boxes2), computed over blocks of boxes2. perPair is about how many values getLoc has live for each pair
+    #The boxes can have leading batch dimensions ([...,n,5]) if getLoc broadcasts over them
+    block = pairwiseBlockSize(boxes1[...,0].numel(),perPair*boxes1.element_size(),budget)
+    if block is None or boxes2.size(-2)<=block:
+        return getLoc(boxes1,boxes2)
+    return torch.cat([getLoc(boxes1,boxes2[...,i:i+block,:]) for i in range(0,boxes2.size(-2),block)],dim=-1)
+
+def pairwiseBest(getLoc,boxes1,boxes2,dim,largest=True,budget=None):
+    #max (or min) and its index along dim of getLoc(boxes1,boxes2), streamed over blocks of boxes2 so
+    #the whole matrix is never held. On ties the first index is kept, as torch.max.
+    block = pairwiseBlockSize(boxes1.size(0),64*boxes1.element_size(),budget)
+    if block is None:
+        block = max(boxes2.size(0),1)
+    reduce = torch.max if largest else torch.min
+    if dim==0:
+        best = [reduce(getLoc(boxes1,boxes2[i:i+block]),dim=0) for i in range(0,boxes2.size(0),block)]
+        if len(best)==0:
+            return reduce(getLoc(boxes1,boxes2),dim=0)
+        return torch.cat([b[0] for b in best]), torch.cat([b[1] for b in best])
+    bestValue=bestIndex=None
+    for i in range(0,boxes2.size(0),block):
+        value,index = reduce(getLoc(boxes1,boxes2[i:i+block]),dim=1)
+        if bestValue is None:
+            bestValue,bestIndex = value,index
+        else:
+            better = value>bestValue if largest else value<bestValue
+            bestValue = torch.where(better,value,bestValue)
+            bestIndex = torch.where(better,index+i,bestIndex)
+    if bestValue is None:
+        return reduce(getLoc(boxes1,boxes2),dim=1)
+    return bestValue,bestIndex
+
 def allIOU(boxes1,boxes2, boxes1XYWH=[0,1,4,3]):
+    return pairwiseBlocks(lambda b1,b2: allIOU_(b1,b2,boxes1XYWH),boxes1,boxes2,12)
+
+def allIOU_(boxes1,boxes2, boxes1XYWH):
     b1_x1, b1_x2 = boxes1[:,boxes1XYWH[0]]-boxes1[:,boxes1XYWH[2]], boxes1[:,boxes1XYWH[0]]+boxes1[:,boxes1XYWH[2]]
     b1_y1, b1_y2 = boxes1[:,boxes1XYWH[1]]-boxes1[:,boxes1XYWH[3]], boxes1[:,boxes1XYWH[1]]+boxes1[:,boxes1XYWH[3]]
     b2_x1, b2_x2 = boxes2[:,0]-boxes2[:,4], boxes2[:,0]+boxes2[:,4]
@@ -152,7 +278,31 @@ def allIOU(boxes1,boxes2, boxes1XYWH=[0,1,4,3]):
     iou = inter_area / (b1_area + b2_area - inter_area + 1e-16)
     return iou
 
+def allMaxIntersection(boxes1,boxes2):
+    #intersection over the smaller area (as max_intersection), for every pair of boxes1 and boxes2
+    #(the last two dimensions, leading ones are broadcast)
+    b1_x1, b1_x2 = boxes1[...,0]-boxes1[...,4], boxes1[...,0]+boxes1[...,4]
+    b1_y1, b1_y2 = boxes1[...,1]-boxes1[...,3], boxes1[...,1]+boxes1[...,3]
+    b2_x1, b2_x2 = boxes2[...,0]-boxes2[...,4], boxes2[...,0]+boxes2[...,4]
+    b2_y1, b2_y2 = boxes2[...,1]-boxes2[...,3], boxes2[...,1]+boxes2[...,3]
+
+    inter_rect_x1 = torch.max(b1_x1[...,:,None], b2_x1[...,None,:])
+    inter_rect_x2 = torch.min(b1_x2[...,:,None], b2_x2[...,None,:])
+    inter_rect_y1 = torch.max(b1_y1[...,:,None], b2_y1[...,None,:])
+    inter_rect_y2 = torch.min(b1_y2[...,:,None], b2_y2[...,None,:])
+
+    inter_area = torch.clamp(inter_rect_x2 - inter_rect_x1 + 1, min=0) * torch.clamp(
+            inter_rect_y2 - inter_rect_y1 + 1, min=0 )
+
+    b1_area = (b1_x2 - b1_x1 + 1) * (b1_y2 - b1_y1 + 1)
+    b2_area = (b2_x2 - b2_x1 + 1) * (b2_y2 - b2_y1 + 1)
+    min_area = torch.min(b1_area[...,:,None],b2_area[...,None,:])
+    return inter_area/min_area
+
 def allDist(boxes1,boxes2):
+    return pairwiseBlocks(allDist_,boxes1,boxes2,4)
+
+def allDist_(boxes1,boxes2):
     b1_x = boxes1[:,0]
     b1_y = boxes1[:,1]
     b2_x = boxes2[:,0]
@@ -167,49 +317,74 @@ def allDist(boxes1,boxes2):
 
     return torch.sqrt( torch.pow(b1_x-b2_x,2) + torch.pow(b1_y-b2_y,2) )
 
+def nativePairwise(boxes1,boxes2,op):
+    #the compiled kernel op, if it's built and can be used for these boxes (CPU, no gradient needed)
+    native = nativeOps(boxes1,boxes2)
+    if (native is not None and hasattr(native,op) and boxes1.dim()==2 and boxes2.dim()==2 and boxes1.dtype==boxes2.dtype and
+            not (torch.is_grad_enabled() and (boxes1.requires_grad or boxes2.requires_grad))):
+        return getattr(native,op)
+    return None
+
+def bestIOU(boxes1,boxes2,dim,boxes1XYWH=[0,1,4,3]):
+    #max and its index along dim of allIOU(boxes1,boxes2,boxes1XYWH), without holding the whole matrix
+    native = nativePairwise(boxes1,boxes2,'iou_best')
+    if native is not None:
+        return native(boxes1,boxes2,dim,*boxes1XYWH)
+    return pairwiseBest(lambda b1,b2: allIOU_(b1,b2,boxes1XYWH),boxes1,boxes2,dim)
+
 def allBoxDistNeg(boxes1,boxes2):
+    native = nativePairwise(boxes1,boxes2,'box_dist_neg')
+    if native is not None:
+        return native(boxes1,boxes2)
+    return pairwiseBlocks(allBoxDistNeg_,boxes1,boxes2,20)
+
+def bestBoxDistNeg(boxes1,boxes2,dim):
+    #max and its index along dim of allBoxDistNeg(boxes1,boxes2), without holding the whole matrix
+    native = nativePairwise(boxes1,boxes2,'box_dist_neg_best')
+    if native is not None:
+        return native(boxes1,boxes2,dim)
+    return pairwiseBest(allBoxDistNeg_,boxes1,boxes2,dim)
+
+def allBoxDistNeg_(boxes1,boxes2):
+    #leading dimensions are broadcast, as in allMaxIntersection
     #convert boxes to points
-    sin_r = torch.sin(boxes1[:,2])
-    cos_r = torch.cos(boxes1[:,2])
-    clx = boxes1[:,0] - cos_r*boxes1[:,4]
-    cly = boxes1[:,1] + sin_r*boxes1[:,3]
-    crx = boxes1[:,0] + cos_r*boxes1[:,4]
-    cry = boxes1[:,1] - sin_r*boxes1[:,3]
-    ctx = boxes1[:,0] - cos_r*boxes1[:,4]
-    cty = boxes1[:,1] - sin_r*boxes1[:,3]
-    cbx = boxes1[:,0] + cos_r*boxes1[:,4]
-    cby = boxes1[:,1] + sin_r*boxes1[:,3]
-    boxes1_points = torch.stack([clx,cly,crx,cry,ctx,cty,cbx,cby],dim=1)
-    boxes1HW = (boxes1[:,4]+boxes1[:,3])/2
-
-
-    sin_r = torch.sin(boxes2[:,2])
-    cos_r = torch.cos(boxes2[:,2])
-    clx = boxes2[:,0] - cos_r*boxes2[:,4]
-    cly = boxes2[:,1] + sin_r*boxes2[:,3]
-    crx = boxes2[:,0] + cos_r*boxes2[:,4]
-    cry = boxes2[:,1] - sin_r*boxes2[:,3]
-    ctx = boxes2[:,0] - cos_r*boxes2[:,4]
-    cty = boxes2[:,1] - sin_r*boxes2[:,3]
-    cbx = boxes2[:,0] + cos_r*boxes2[:,4]
-    cby = boxes2[:,1] + sin_r*boxes2[:,3]
-    boxes2_points = torch.stack([clx,cly,crx,cry,ctx,cty,cbx,cby],dim=1)
-    boxes2HW = (boxes2[:,4]+boxes2[:,3])/2
+    sin_r = torch.sin(boxes1[...,2])
+    cos_r = torch.cos(boxes1[...,2])
+    clx = boxes1[...,0] - cos_r*boxes1[...,4]
+    cly = boxes1[...,1] + sin_r*boxes1[...,3]
+    crx = boxes1[...,0] + cos_r*boxes1[...,4]
+    cry = boxes1[...,1] - sin_r*boxes1[...,3]
+    ctx = boxes1[...,0] - cos_r*boxes1[...,4]
+    cty = boxes1[...,1] - sin_r*boxes1[...,3]
+    cbx = boxes1[...,0] + cos_r*boxes1[...,4]
+    cby = boxes1[...,1] + sin_r*boxes1[...,3]
+    boxes1_points = torch.stack([clx,cly,crx,cry,ctx,cty,cbx,cby],dim=-1)
+    boxes1HW = (boxes1[...,4]+boxes1[...,3])/2
+
+
+    sin_r = torch.sin(boxes2[...,2])
+    cos_r = torch.cos(boxes2[...,2])
+    clx = boxes2[...,0] - cos_r*boxes2[...,4]
+    cly = boxes2[...,1] + sin_r*boxes2[...,3]
+    crx = boxes2[...,0] + cos_r*boxes2[...,4]
+    cry = boxes2[...,1] - sin_r*boxes2[...,3]
+    ctx = boxes2[...,0] - cos_r*boxes2[...,4]
+    cty = boxes2[...,1] - sin_r*boxes2[...,3]
+    cbx = boxes2[...,0] + cos_r*boxes2[...,4]
+    cby = boxes2[...,1] + sin_r*boxes2[...,3]
+    boxes2_points = torch.stack([clx,cly,crx,cry,ctx,cty,cbx,cby],dim=-1)
+    boxes2HW = (boxes2[...,4]+boxes2[...,3])/2
     #candHW,_ = torch.min(candidate_boxes[:,3:5],dim=1)
     #compute distances
 
-    boxes1_points = boxes1_points[:,None,:].expand(boxes1.size(0),boxes2.size(0),8)
-    boxes2_points = boxes2_points[None,:,:].expand(boxes1.size(0),boxes2.size(0),8)
-    boxes1HW = boxes1HW[:,None].expand(boxes1.size(0),boxes2.size(0))
-    boxes2HW = boxes2HW[None,:].expand(boxes1.size(0),boxes2.size(0))
-    normalization = (boxes1HW+boxes2HW)/2.0
+    normalization = (boxes1HW[...,:,None]+boxes2HW[...,None,:])/2.0
 
-    deltas = boxes1_points - boxes2_points
+    deltas = boxes1_points[...,:,None,:] - boxes2_points[...,None,:,:]
     dist = ((
-        torch.norm(deltas[:,:,0:2],2,2) +
-        torch.norm(deltas[:,:,2:4],2,2) +
-        torch.norm(deltas[:,:,4:6],2,2) +
-        torch.norm(deltas[:,:,6:8],2,2)
+        torch.norm(deltas[...,0:2],2,-1) +
+        torch.norm(deltas[...,2:4],2,-1) +
+        torch.norm(deltas[...,4:6],2,-1) +
+        torch.norm(deltas[...,6:8],2,-1)
            )/normalization)**2
     return dist*-1
  
@@ -263,9 +438,8 @@ def AP_(target,pred,iou_thresh,numClasses,ignoreClasses,beforeCls,getLoc,getClas
         else:
             return 1, [1]*numClasses, [1]*numClasses
 
-    allScores=[]
-    classScores=[[] for i in range(numClasses)]
-    if len(pred.size())>1 and pred.size(0)>0:
+    hasPred = len(pred.size())>1 and pred.size(0)>0
+    if hasPred:
         #This is an alternate metric that computes AP of all classes together
         #Your only a hit if you have the same class
         allIOUs = getLoc(target[:,0:],pred[:,1:])
@@ -276,97 +450,68 @@ def AP_(target,pred,iou_thresh,numClasses,ignoreClasses,beforeCls,getLoc,getClas
         if predClasses.size(0)==0 or predClasses.size(1)==0:
             print('ERROR, zero sized predClasses: {}. pred is {}'.format(predClasses.size(),pred.size()))
         predClasses_index = torch.argmax(predClasses,dim=1)
-        targetClasses_index_ex = targetClasses_index[:,None].expand(targetClasses_index.size(0),predClasses_index.size(0))
-        predClasses_index_ex = predClasses_index[None,:].expand(targetClasses_index.size(0),predClasses_index.size(0))
-        matchingClasses = targetClasses_index_ex==predClasses_index_ex
-        validHits = allHits*matchingClasses
-
-        #add all the preds that didn't have a hit
-        hasHit,_ = validHits.max(dim=0) #which preds have hits
-        notHitScores = pred[~hasHit,0]
-        notHitClass = predClasses_index[~hasHit]
-        for i in range(notHitScores.shape[0]):
-            allScores.append( (notHitScores[i].item(), False) )
-            cls = notHitClass[i]
-            classScores[cls].append( (notHitScores[i].item(), False) )
+        validHits = allHits & (targetClasses_index[:,None]==predClasses_index[None,:])
+
+        #the preds that didn't have a hit are false positives
+        hasHit = validHits.any(dim=0)
 
         # if something has multiple hits, it gets paired to the closest (with matching class)
-        allIOUs[~validHits] -= 9999999 #Force these to be smaller
-        maxValidHitIndexes = torch.argmax(allIOUs,dim=0)
-        for i in range(maxValidHitIndexes.size(0)):
-            if validHits[maxValidHitIndexes[i],i]:
-                allScores.append( (pred[i,0].item(),True) )
-                #but now we've consumed this pred, so we'll zero its hit
-                validHits[maxValidHitIndexes[i],i]=0
-                cls = predClasses_index[i]
-                classScores[cls].append( (pred[i,0].item(),True) )
-
-        #add nan scores for missed targets
-        gotHit,gotHitIndex = torch.max(validHits,dim=1)
-        for i in range((gotHit==0).sum()):
-            allScores.append( (float('nan'),True) )
-            cls = targetClasses_index[i]
-            classScores[cls].append( (float('nan'),True) )
+        predIndexes = torch.arange(pred.size(0),device=pred.device)
+        maxValidHitIndexes = torch.argmax(torch.where(validHits,allIOUs,allIOUs-9999999),dim=0)
+        truePos = validHits[maxValidHitIndexes,predIndexes]
+        #but now we've consumed these preds, so we'll zero their hits
+        validHits[maxValidHitIndexes[truePos],predIndexes[truePos]]=0
+
+        #nan scores for missed targets (their classes are taken from the first numMissed targets)
+        numMissed = (~validHits.any(dim=1)).sum().item()
+
+        scoreConf = torch.cat([pred[~hasHit,0],pred[truePos,0],torch.full((numMissed,),float('nan'),dtype=pred.dtype,device=pred.device)])
+        scoreRel = torch.cat([torch.zeros((~hasHit).sum().item(),dtype=torch.bool),torch.ones(truePos.sum().item()+numMissed,dtype=torch.bool)])
+        scoreClass = torch.cat([predClasses_index[~hasHit],predClasses_index[truePos],targetClasses_index[:numMissed].to(pred.device)])
+        scoreConf = scoreConf.detach().cpu().numpy()
+        scoreRel = scoreRel.numpy()
+        scoreClass = scoreClass.cpu().numpy()
     else:
-        allScores.append( (float('nan'),True) )
-        classScores=[[(float('nan'),True)]]*numClasses
+        scoreConf = np.array([float('nan')])
+        scoreRel = np.array([True])
+        scoreClass = None #this missed for every class
 
 
     if ignoreClasses:
         numClasses=1
-    #by class
-    #import pdb; pdb.set_trace()
-    for cls in range(numClasses):
-        clsTargInd = target[:,cls+13]==1
-        if len(pred.size())>1 and pred.size(0)>0:
-            #print(pred.size())
-            clsPredInd = torch.argmax(pred[:,beforeCls+6:beforeCls+6+numClasses],dim=1)==cls
+    #by class, all at once
+    if ignoreClasses:
+        clsTargInds = torch.ones(1,target.size(0),dtype=torch.bool,device=target.device)
+        clsPredInds = torch.ones(1,pred.size(0) if hasPred else 0,dtype=torch.bool,device=target.device)
+    else:
+        clsTargInds = (target[:,13:13+numClasses]==1).t()
+        if hasPred:
+            predClasses_index = torch.argmax(pred[:,beforeCls+6:beforeCls+6+numClasses],dim=1)
+            clsPredInds = predClasses_index[None,:].to(target.device)==torch.arange(numClasses,device=target.device)[:,None]
         else:
-            clsPredInd = torch.empty(0,dtype=torch.uint8)
-        if (ignoreClasses and pred.size(0)>0) or (clsTargInd.any() and clsPredInd.any()):
-            if ignoreClasses:
-                clsTarg=target
-                clsPred=pred
-            else:
-                clsTarg = target[clsTargInd]
-                clsPred = pred[clsPredInd]
-            clsIOUs = getLoc(clsTarg[:,0:],clsPred[:,1:])
-            hits = clsIOUs>iou_thresh
-
-            clsIOUs *= hits.float()
-            ps = torch.argmax(clsIOUs,dim=1)
-            left_ps = torch.ones(clsPred.size(0),dtype=torch.uint8)
-            left_ps[ps]=0
-            truePos=0
-            for t in range(clsTarg.size(0)):
-                p=ps[t]
-                if hits[t,p]:
-                    #scores.append( (clsPred[p,0],True) )
-                    #hits[t,p]=0
-                    truePos+=1
-                #else:
-                    #scores.append( (float('nan'),True) )
-            
-            left_conf = clsPred[left_ps,0]
-            #for i in range(left_conf.size(0)):
-                #scores.append( (left_conf[i],False) )
-            
-            #ap = computeAP(scores)
-            #if ap is not None:
-            #    aps.append(ap)
-
-            precisions.append( truePos/max(clsPred.size(0),truePos) )
-            if precisions[-1]>1:
-                import pdb;pdb.set_trace()
-            recalls.append( truePos/clsTarg.size(0) )
+            clsPredInds = torch.zeros(numClasses,0,dtype=torch.bool,device=target.device)
+    numClsTarg = clsTargInds.sum(dim=1).tolist()
+    numClsPred = clsPredInds.sum(dim=1).tolist()
+    if hasPred:
+        hits = allIOUs>iou_thresh
+        #each target takes its best hitting pred of the class
+        clsIOUs = (allIOUs*hits.float())[None].expand(clsTargInds.size(0),-1,-1)
+        clsIOUs = torch.where(clsTargInds[:,:,None]&clsPredInds[:,None,:],clsIOUs,torch.full_like(clsIOUs,-float('inf')))
+        ps = torch.argmax(clsIOUs,dim=2)
+        clsTruePos = (hits[torch.arange(target.size(0),device=ps.device)[None,:],ps] & clsTargInds).sum(dim=1).tolist()
+    for cls in range(numClasses):
+        if (ignoreClasses and hasPred) or (numClsTarg[cls]>0 and numClsPred[cls]>0):
+            truePos = clsTruePos[cls]
+            precisions.append( truePos/max(numClsPred[cls],truePos) )
+            recalls.append( truePos/numClsTarg[cls] )
         elif ignoreClasses:
             #no pred
             #aps.append(0)
             precisions.append(0)
             recalls.append(0)
-        elif clsPredInd.any() or clsTargInd.any():
+        elif numClsPred[cls]>0 or numClsTarg[cls]>0:
             #aps.append(0)
-            if clsPredInd.any():
+            if numClsPred[cls]>0:
                 recalls.append(1)
                 precisions.append(0)
             else:
@@ -378,108 +523,118 @@ def AP_(target,pred,iou_thresh,numClasses,ignoreClasses,beforeCls,getLoc,getClas
             recalls.append(1)
     
     if getClassAP:
-        classAPs=[computeAP(scores) for scores in classScores]
+        if scoreClass is None:
+            classAPs=[computeAPArrays(scoreConf,scoreRel)]*numClasses
+        else:
+            classAPs=[computeAPArrays(scoreConf[scoreClass==cls],scoreRel[scoreClass==cls]) for cls in range(numClasses)]
         #for i in range(len(classAPs)):
         #    if classAPs[i] is None:
         #        classAPs[i]=1
-        return computeAP(allScores), precisions, recalls, classAPs
+        return computeAPArrays(scoreConf,scoreRel), precisions, recalls, classAPs
     else:
-        return computeAP(allScores), precisions, recalls
+        return computeAPArrays(scoreConf,scoreRel), precisions, recalls
 
 
 def getTargIndexForPreds_iou(target,pred,iou_thresh,numClasses,beforeCls=0,hard_thresh=True,fixed=True):
-    return getTargIndexForPreds(target,pred,iou_thresh,numClasses,beforeCls,allIOU,hard_thresh,fixed)
+    return getTargIndexForPreds(target,pred,iou_thresh,numClasses,beforeCls,bestIOU,hard_thresh,fixed)
 def getTargIndexForPreds_dist(target,pred,iou_thresh,numClasses,beforeCls=0,hard_thresh=True,fixed=True):
     raise NotImplemented('Checking if preds with no intersection not implemented for dist')
-    return getTargIndexForPreds(target,pred,iou_thresh,numClasses,beforeCls,allBoxDistNeg,hard_thresh,fixed)
+    return getTargIndexForPreds(target,pred,iou_thresh,numClasses,beforeCls,bestBoxDistNeg,hard_thresh,fixed)
 
-def getTargIndexForPreds(target,pred,iou_thresh,numClasses,beforeCls,getLoc, hard_thresh,fixed):
+def getTargIndexForPreds(target,pred,iou_thresh,numClasses,beforeCls,getBest, hard_thresh,fixed):
+    #getBest(boxes1,boxes2,dim) gives the best IOU (or other overlap) and its index along dim, so
+    #the target/pred matrix is never built
     targIndex = torch.LongTensor((pred.size(0)))
     targIndex[:] = -1
-    #mAP=0.0
-    aps=[]
-    precisions=[]
-    recalls=[]
 
     if len(target.size())<=1:
         return None, None
 
-    #by class
-    #import pdb; pdb.set_trace()
-    #first get all IOUs, then process by class
-    allIOUs = getLoc(target[:,0:],pred[:,1:])
     #This isn't going to work of dist as 0 is perfect
-    maxIOUsForPred,_ = allIOUs.max(dim=0)
+    maxIOUsForPred,targIndexes = getBest(target[:,0:],pred[:,1:],0)
     predsWithNoIntersection=maxIOUsForPred==0
+    fullHit = maxIOUsForPred>iou_thresh
 
-    hits = allIOUs>iou_thresh
-    if hard_thresh:
-        allIOUs *= hits.float()
-
-
-    for cls in range(numClasses):
-        scores=[]
-        clsTargInd = target[:,cls+13]==1
-        notClsTargInd = target[:,cls+13]!=1
-        if len(pred.size())>1 and pred.size(0)>0:
-            #print(pred.size())
-            #clsPredInd = torch.argmax(pred[:,beforeCls+6:],dim=1)==cls
-            clsPredInd = torch.argmax(pred[:,-numClasses:],dim=1)==cls
+    if len(pred.size())>1 and pred.size(0)>0:
+        if fixed:
+            #only targets of the predicted class can be matched (different class so no intersection)
+            predClasses_index = torch.argmax(pred[:,-numClasses:],dim=1)
+            val = torch.zeros_like(maxIOUsForPred)
+            for cls in range(numClasses):
+                predsOfCls = (predClasses_index==cls).nonzero()[:,0]
+                targsOfCls = (target[:,13+cls]==1).nonzero()[:,0]
+                if predsOfCls.size(0)==0 or targsOfCls.size(0)==0:
+                    continue
+                clsVal,clsIndex = getBest(target[targsOfCls],pred[predsOfCls,1:],0)
+                val[predsOfCls] = clsVal
+                targIndexes[predsOfCls] = targsOfCls[clsIndex]
+        else:
+            val = maxIOUsForPred
+        #assign -1 index to places that don't really have a match
+        if hard_thresh:
+            matched = val>iou_thresh
         else:
-            clsPredInd = torch.empty(0,dtype=torch.uint8)
-        if  clsPredInd.any():
-            if notClsTargInd.any() and fixed:
-                notClsTargIndX = notClsTargInd[:,None].expand(allIOUs.size())
-                clsPredIndX = clsPredInd[None,:].expand(allIOUs.size())
-                allIOUs[notClsTargIndX*clsPredIndX]=0 #set IOU for instances that are from different class than predicted to 0 (different class so no intersection)
-                #allIOUs[notClsTargInd][:,clsPredInd]=0 this doesn't work for some reason
-            val,targIndexes = torch.max(allIOUs[:,clsPredInd],dim=0)
-            #targIndexes has the target indexes for the predictions of cls
-
-            #assign -1 index to places that don't really have a match
-            #targIndexes[:] = torch.where(val==0,-torch.ones_like(targIndexes),targIndexes)
-            targIndexes[val==0] = -1
-            #targIndexes[notClsTargInd] = -1
-            #assert(notClsTargInd[targIndexes].sum()==0)
-            targIndex[clsPredInd] =  targIndexes
-
-    #debug
-    #for i in range(targIndex.size(0)):
-        #if targIndex[i]>=0:
-    #         assert(torch.argmax(pred[i,-numClasses:],dim=0) == torch.argmax(target[targIndex[i],-numClasses:],dim=0))
-            
-    #import pdb;pdb.set_trace()
+            matched = val!=0
+        targIndex[:] = torch.where(matched,targIndexes,torch.full_like(targIndexes,-1))
+
     if hard_thresh:
         return targIndex, predsWithNoIntersection
     else:
-        hits,_ = hits.max(dim=0) #since we always take max pred
-        return targIndex, hits
+        return targIndex, fullHit #since we always take max pred
 
 def computeAP(scores):
-    rank=[]
-    missed=0
-    for conf,rel in scores:
-        if rel:
-            if math.isnan(conf):
-                missed+=1
-            else:
-                better=0
-                equal=-1 # as we'll iterate over this instance here
-                for conf2,rel2 in scores:
-                    if conf2>conf:
-                        better+=1
-                    elif conf2==conf:
-                        equal+=1
-                rank.append(better+math.ceil(equal/2.0))
-    if len(rank)==0:
+    #scores is a list of (confidence,relevant).
+    return computeAPArrays(np.array([float(c) for c,r in scores],dtype=np.float64),
+                           np.array([bool(r) for c,r in scores],dtype=bool))
+
+def computeAPArrays(conf,rel):
+    #conf and rel are arrays of the confidences and whether each instance is relevant. The rank of a relevant
+    #instance counts the instances scored higher and half of those scored the same. Relevant instances with a
+    #NaN score were missed.
+    if len(conf)==0:
+        return None
+    conf = np.asarray(conf,dtype=np.float64)
+    rel = np.asarray(rel,dtype=bool)
+    nan = np.isnan(conf)
+    missed = int((rel&nan).sum())
+    relConf = conf[rel&~nan]
+    if len(relConf)==0:
         if missed>0:
             return 0
         return None
-    rank.sort()
-    ap=0.0
-    for i in range(len(rank)):
-        ap += float(i+1)/(rank[i]+1)
-    ap/=(len(rank)+missed)
+    sortedConf = np.sort(conf[~nan])
+    above = np.searchsorted(sortedConf,relConf,side='right')
+    better = len(sortedConf)-above
+    equal = above-np.searchsorted(sortedConf,relConf,side='left')-1 #not counting this instance
+    rank = np.sort(better+(equal+1)//2) #ceil(equal/2)
+    ap = np.cumsum(np.arange(1,len(rank)+1)/(rank+1.0))[-1] #summed in order, as a loop would
+    ap = float(ap)/(len(rank)+missed)
     if ap>1.0001:
-        raise ValueError('ap greater than 1({}), from {}'.format(ap,scores))
+        raise ValueError('ap greater than 1({}), from {}'.format(ap,list(zip(conf,rel))))
     return ap
+
+if __name__ == "__main__":
+    #benchmark the compiled rotated box kernels against the torch versions: python -m utils.yolo_tools
+    import timeit
+    torch.manual_seed(0)
+    preds = torch.rand(1,5000,8)
+    preds[:,:,1:3]*=1000
+    preds[:,:,3]=(preds[:,:,3]-0.5)*0.6
+    preds[:,:,4]=preds[:,:,4]*20+3
+    preds[:,:,5]=preds[:,:,5]*80+5
+    native = nativeOps()
+    if native is None:
+        print('model._C is not built (or is missing the box kernels), only timing the torch version')
+    for name in ['torch','native']:
+        if name=='native':
+            if native is None:
+                break
+            _native = native
+        else:
+            _native = False
+        t = timeit.timeit(lambda: non_max_sup_dist(preds,0.3,2.5,300),number=10)/10
+        print('{} non_max_sup_dist, 5000 preds: {:.4f}s'.format(name,t))
+        t = timeit.timeit(lambda: allBoxDistNeg(preds[0,:500,1:6],preds[0,:,1:6]),number=10)/10
+        print('{} allBoxDistNeg, 500x5000: {:.4f}s'.format(name,t))
+        t = timeit.timeit(lambda: bestBoxDistNeg(preds[0,:500,1:6],preds[0,:,1:6],0),number=10)/10
+        print('{} bestBoxDistNeg, 500x5000: {:.4f}s'.format(name,t))